@@ -0,0 +1,143 @@
+"""Measure frame times while the stroke width slider is dragged over a dense trace.
+
+The former GUI called setPen() on every path item for every slider value. The batched scene records the
+change in the shared PathStyle, applies it once per frame and renders again only as many tiles as fit in a
+frame. A frame is the slider values received within one frame interval followed by a repaint of the view.
+"update" is the time spent before the repaint. A few slow frames are the stutter a drag should not have, so
+the target is on the 95th percentile of the frame times of the drag, not only on their mean. Exits with
+status 1 if the batched scene misses it.
+
+Usage: python benchmarks/bench_frame_time.py [--shapes 5000] [--frames 30] [--ticks-per-frame 4] [--target-ms 16.7]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtCore import Qt  # noqa: E402
+from PyQt6.QtGui import QBrush, QColor, QPen  # noqa: E402
+from PyQt6.QtWidgets import QApplication, QGraphicsPathItem, QGraphicsScene, QGraphicsView  # noqa: E402
+
+from curves import CURVE_TO, CURVE_TO_DATA, MOVE_TO, CurveStore  # noqa: E402
+from scene_items import BatchedCurvesItem, PathStyle  # noqa: E402
+
+# Distance of the control points of a cubic quarter circle from its end points, relative to the radius
+KAPPA = 0.5522847498
+
+
+def circle(cx: np.ndarray, cy: np.ndarray, r: np.ndarray) -> np.ndarray:
+    """K x 13 x 2 points of K closed circles made of four cubic segments."""
+    unit = np.array(
+        [(1, 0), (1, KAPPA), (KAPPA, 1), (0, 1), (-KAPPA, 1), (-1, KAPPA), (-1, 0), (-1, -KAPPA), (-KAPPA, -1), (0, -1), (KAPPA, -1), (1, -KAPPA), (1, 0)]
+    )
+    return np.stack([cx, cy], axis=1)[:, None, :] + r[:, None, None] * unit
+
+
+def make_curves(count: int) -> CurveStore:
+    """Rings on a grid: every shape is an outer circle and a hole."""
+    columns = int(count**0.5) + 1
+    cx = (np.arange(count) % columns) * 10.0 + 5
+    cy = (np.arange(count) // columns) * 10.0 + 5
+    points = np.stack([circle(cx, cy, np.full(count, 4.0)), circle(cx, cy, np.full(count, 2.0))], axis=1).reshape(-1, 2)
+    codes = np.tile(np.array([MOVE_TO] + [CURVE_TO, CURVE_TO_DATA, CURVE_TO_DATA] * 4, np.uint8), 2 * count)
+    return CurveStore(codes, points, np.arange(2 * count) * 13, np.arange(count) * 2)
+
+
+def make_view(scene: QGraphicsScene) -> QGraphicsView:
+    view = QGraphicsView(scene)
+    view.resize(1000, 800)
+    view.fitInView(scene.itemsBoundingRect(), Qt.AspectRatioMode.KeepAspectRatio)
+    view.show()
+    view.viewport().grab()
+    return view
+
+
+def drag(view: QGraphicsView, set_width, frames: int, ticks_per_frame: int, max_width: int, flush=None) -> np.ndarray:
+    """(update ms, frame ms) of every frame of a drag from width 1 to max_width."""
+    times = []
+    ticks = frames * ticks_per_frame
+    for frame in range(frames):
+        start = time.perf_counter()
+        for tick in range(frame * ticks_per_frame, (frame + 1) * ticks_per_frame):
+            set_width(1 + tick * max_width // ticks)
+        if flush is not None:
+            # What the frame timer of the style does when it fires
+            flush()
+        updated = time.perf_counter()
+        view.viewport().grab()
+        times.append((updated - start, time.perf_counter() - start))
+    return np.array(times) * 1000
+
+
+def legacy_frame_times(curves: CurveStore, args) -> np.ndarray:
+    pen = QPen(QColor(Qt.GlobalColor.black))
+    scene = QGraphicsScene()
+    items = []
+    for path in curves.to_qt_paths():
+        item = QGraphicsPathItem(path)
+        item.setPen(pen)
+        item.setBrush(QBrush(QColor(Qt.GlobalColor.black)))
+        scene.addItem(item)
+        items.append(item)
+    view = make_view(scene)
+
+    def set_width(width):
+        pen.setWidth(width)
+        for item in items:
+            item.setPen(pen)
+
+    return drag(view, set_width, args.frames, args.ticks_per_frame, args.max_width)
+
+
+def batched_frame_times(curves: CurveStore, args) -> np.ndarray:
+    style = PathStyle(QPen(QColor(Qt.GlobalColor.black)), QBrush(QColor(Qt.GlobalColor.black)))
+    scene = QGraphicsScene()
+    batch = BatchedCurvesItem(style, 1.0)
+    batch.points_root.setVisible(False)
+    batch.add_curves(curves)
+    scene.addItem(batch)
+    style.changed.connect(batch.style_changed)
+    view = make_view(scene)
+
+    def flush():
+        # What the frame timers of the style and of the batch do when they fire
+        style.flush()
+        batch.refresh_stale_tiles()
+
+    return drag(view, style.set_pen_width, args.frames, args.ticks_per_frame, args.max_width, flush)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shapes", type=int, default=5000)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--ticks-per-frame", type=int, default=4, help="slider values received per frame")
+    parser.add_argument("--max-width", type=int, default=4, help="pen width at the end of the drag")
+    parser.add_argument("--target-ms", type=float, default=1000 / 60, help="95th percentile of the frame times the batched scene must meet")
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    curves = make_curves(args.shapes)
+    results = {"batched": batched_frame_times(curves, args)}
+    if not args.skip_legacy:
+        results["legacy"] = legacy_frame_times(curves, args)
+
+    print(f"{args.shapes} shapes, {args.ticks_per_frame} slider values per frame, {app.platformName()} platform")
+    print(f"{'scene':>8} {'update ms':>10} {'mean ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for name, times in results.items():
+        update_times, frame_times = times[:, 0], times[:, 1]
+        print(f"{name:>8} {update_times.mean():>10.2f} {frame_times.mean():>8.1f} {np.percentile(frame_times, 95):>8.1f} {frame_times.max():>8.1f}")
+    p95 = np.percentile(results["batched"][:, 1], 95)
+    print(f"target p95 {args.target_ms:.1f} ms: {'met' if p95 <= args.target_ms else 'MISSED'}")
+    sys.exit(0 if p95 <= args.target_ms else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Show how hole/outer nesting scales with the number of contours.
+
+Usage: python benchmarks/bench_nesting.py [--counts 256 1024 4096 16384] [--legacy-max 1024]
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import List
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from PyQt6.QtGui import QPainterPath  # noqa: E402
+
+from curves import CurveStore  # noqa: E402
+from nesting import nest_curves  # noqa: E402
+
+
+def square(x: float, y: float, size: float, clockwise: bool) -> QPainterPath:
+    path = QPainterPath()
+    corners = [(x, y), (x + size, y), (x + size, y + size), (x, y + size)]
+    if not clockwise:
+        corners.reverse()
+    path.moveTo(*corners[0])
+    for corner in corners[1:]:
+        path.lineTo(*corner)
+    path.closeSubpath()
+    return path
+
+
+def make_contours(count: int) -> List[QPainterPath]:
+    """Glyph-like cells on a grid: every cell holds a frame, its hole and an island inside the hole."""
+    cells = max(1, count // 3)
+    columns = int(cells**0.5) + 1
+    contours = []
+    for cell in range(cells):
+        x, y = (cell % columns) * 12.0, (cell // columns) * 12.0
+        contours.append(square(x, y, 10, True))
+        contours.append(square(x + 2, y + 2, 6, False))
+        contours.append(square(x + 4, y + 4, 2, True))
+    return contours
+
+
+def legacy_get_filled_path_list(path_list: List[QPainterPath]) -> List[QPainterPath]:
+    """The former quadratic implementation."""
+    filled_path_list = []
+    sorted_path_list = sorted(path_list, key=lambda x: x.boundingRect().x())
+    while sorted_path_list:
+        outer_path = sorted_path_list.pop(0)
+        hole_path_list = []
+        inner_path_list = [path for path in sorted_path_list if outer_path.contains(path)]
+        while inner_path_list:
+            hole_path = inner_path_list.pop(0)
+            for inner_path in inner_path_list[:]:
+                if hole_path.contains(inner_path):
+                    inner_path_list.remove(inner_path)
+            hole_path_list.append(hole_path)
+            sorted_path_list.remove(hole_path)
+        filled_path = QPainterPath(outer_path)
+        for hole_path in hole_path_list:
+            filled_path.addPath(hole_path)
+        filled_path_list.append(filled_path)
+    return filled_path_list
+
+
+def legacy_contour_counts(path_list: List[QPainterPath]) -> List[int]:
+    return sorted(sum(path.elementAt(i).type == QPainterPath.ElementType.MoveToElement for i in range(path.elementCount())) for path in path_list)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=int, nargs="+", default=[256, 1024, 4096, 16384])
+    parser.add_argument("--legacy-max", type=int, default=1024, help="largest contour count to run the quadratic version on")
+    args = parser.parse_args()
+
+    print(f"{'contours':>9} {'legacy ms':>10} {'indexed ms':>11} {'speedup':>8}")
+    for count in args.counts:
+        contours = make_contours(count)
+        indexed_time, indexed = timed(nest_curves, CurveStore.from_qt_paths(contours))
+        if len(contours) <= args.legacy_max:
+            legacy_time, legacy = timed(legacy_get_filled_path_list, contours)
+            assert legacy_contour_counts(legacy) == sorted(np.diff(np.append(indexed.shape_offsets, indexed.contour_count)).tolist())
+            print(f"{len(contours):>9} {legacy_time * 1000:>10.1f} {indexed_time * 1000:>11.1f} {legacy_time / indexed_time:>7.1f}x")
+        else:
+            print(f"{len(contours):>9} {'-':>10} {indexed_time * 1000:>11.1f} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
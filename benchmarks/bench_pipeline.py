@@ -0,0 +1,177 @@
+"""Time every stage of BezierTracing on synthetic bitmaps and compare against a stored baseline.
+
+The bitmaps are drawn with cv2, so no external data is needed: a grid of targets, each a stack of
+alternating black and white discs, for every combination of image size, contour count and nesting depth.
+A target of depth d adds d contours, every one of them inside the previous one. Every case is traced
+--repeat times without a cache and the median time of each stage is kept, along with the peak Python
+allocation of the stage and the peak RSS of the trace.
+
+With --save-baseline the results are written to the baseline file. Otherwise they are compared against it
+when it exists, and the script exits with status 1 if a stage got slower or allocated more than the
+tolerance allows, or if a case traced to a different number of shapes or contours. Baselines are only
+comparable on the same machine and potrace build, and with the same backend.
+
+benchmarks/pipeline_baseline.json is a reference baseline of the default cases with the "fitter" backend,
+which needs no potrace executable. It records the machine it was made on. Before comparing your changes,
+regenerate it on your machine from the unchanged tree:
+
+    python benchmarks/bench_pipeline.py --save-baseline
+
+Usage: python benchmarks/bench_pipeline.py [--sizes 512 1024] [--contours 64 512] [--depths 1 3] [--repeat 3] [--backend fitter]
+                                           [--baseline benchmarks/pipeline_baseline.json] [--save-baseline] [--tolerance 0.2] [--min-ms 5] [--min-mb 1]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import profiling  # noqa: E402
+from backends import POTRACE_BACKENDS  # noqa: E402
+from main import BezierTracing  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipeline_baseline.json")
+
+
+def make_bitmap(size: int, contours: int, depth: int) -> np.ndarray:
+    """size x size image with contours // depth targets of depth nested discs on a grid."""
+    targets = max(1, contours // depth)
+    columns = int(np.ceil(targets**0.5))
+    cell = size / columns
+    # Rings need at least 3 pixels each to survive the despeckle filter and the threshold
+    ring = (cell / 2 - 2) / depth
+    if ring < 3:
+        raise ValueError(f"{contours} contours of depth {depth} do not fit into {size}x{size} pixels")
+    image = np.full((size, size), 255, np.uint8)
+    for target in range(targets):
+        center = (int((target % columns + 0.5) * cell), int((target // columns + 0.5) * cell))
+        for level in range(depth):
+            cv2.circle(image, center, int(round(cell / 2 - 2 - level * ring)), 0 if level % 2 == 0 else 255, -1, cv2.LINE_8)
+    return image
+
+
+def case_name(size: int, contours: int, depth: int) -> str:
+    return f"{size}px-{contours}c-d{depth}"
+
+
+def run_case(image_path: str, repeat: int, backend: str) -> dict:
+    reports = []
+    for _ in range(repeat):
+        with profiling.TraceProfiler(image_path, memory=True) as profiler:
+            curves = BezierTracing(image_path, backend).curves
+        reports.append(profiler.report())
+    summary = profiling.aggregate(reports)
+    return {
+        "shapes": len(curves),
+        "contours": curves.contour_count,
+        "seconds": float(np.median([report["seconds"] for report in reports])),
+        "peak_rss_bytes": summary.get("max_peak_rss_bytes", 0),
+        "stages": {
+            name: {"seconds": stage["p50_seconds"], "python_peak_bytes": stage.get("max_python_peak_bytes", 0)} for name, stage in summary["stages"].items()
+        },
+    }
+
+
+def machine() -> dict:
+    """What the timings of a baseline depend on besides the code."""
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_ms: float, min_mb: float) -> list:
+    """Descriptions of the regressions of results against the cases of baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        reference = baseline[name]
+        for key in ("shapes", "contours"):
+            if result[key] != reference[key]:
+                regressions.append(f"{name}: {result[key]} {key}, baseline {reference[key]}")
+        for stage, record in result["stages"].items():
+            if stage not in reference["stages"]:
+                continue
+            before = reference["stages"][stage]
+            # Small stages are dominated by noise, so they also need to slow down by min_ms or grow by min_mb
+            if record["seconds"] > before["seconds"] * (1 + tolerance) and (record["seconds"] - before["seconds"]) * 1000 > min_ms:
+                regressions.append(f"{name} {stage}: {record['seconds'] * 1000:.1f} ms, baseline {before['seconds'] * 1000:.1f} ms")
+            growth = record["python_peak_bytes"] - before["python_peak_bytes"]
+            if record["python_peak_bytes"] > before["python_peak_bytes"] * (1 + tolerance) and growth / 1e6 > min_mb:
+                regressions.append(f"{name} {stage}: {record['python_peak_bytes'] / 1e6:.1f} MB allocated, baseline {before['python_peak_bytes'] / 1e6:.1f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024])
+    parser.add_argument("--contours", type=int, nargs="+", default=[64, 512])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 3])
+    parser.add_argument("--repeat", type=int, default=3, help="traces per case, of which the median is kept")
+    parser.add_argument("--backend", choices=sorted(POTRACE_BACKENDS), default="fitter", help="potrace backend")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file to compare against or to save")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown and allocation growth")
+    parser.add_argument("--min-ms", type=float, default=5.0, help="smallest slowdown of a stage counted as a regression")
+    parser.add_argument("--min-mb", type=float, default=1.0, help="smallest allocation growth of a stage counted as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            for contours in args.contours:
+                for depth in args.depths:
+                    name = case_name(size, contours, depth)
+                    try:
+                        image = make_bitmap(size, contours, depth)
+                    except ValueError as e:
+                        print(f"skipping {name}: {e}")
+                        continue
+                    image_path = os.path.join(directory, name + ".png")
+                    cv2.imwrite(image_path, image)
+                    results[name] = run_case(image_path, args.repeat, args.backend)
+
+    stages = sorted({stage for result in results.values() for stage in result["stages"]})
+    print(f"{'case':>18} {'shapes':>7} {'contours':>8} {'total ms':>9} " + " ".join(f"{stage:>18}" for stage in stages) + f" {'peak RSS MB':>11}")
+    for name, result in results.items():
+        times = " ".join(f"{result['stages'][stage]['seconds'] * 1000:>18.1f}" if stage in result["stages"] else f"{'-':>18}" for stage in stages)
+        print(f"{name:>18} {result['shapes']:>7} {result['contours']:>8} {result['seconds'] * 1000:>9.1f} {times} {result['peak_rss_bytes'] / 1e6:>11.1f}")
+
+    if args.save_baseline:
+        with open(args.baseline, mode="w", encoding="utf-8") as f:
+            json.dump({"backend": args.backend, "machine": machine(), "cases": results}, f, indent=2)
+            f.write("\n")
+        print(f"saved baseline to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --save-baseline to store one")
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["backend"] != args.backend:
+        sys.exit(f"{args.baseline} was made with the {baseline['backend']} backend, compare with --backend {baseline['backend']} or save a new baseline")
+    if baseline["machine"] != machine():
+        print(f"{args.baseline} was made on another machine or environment, regenerate it with --save-baseline to compare timings:")
+        print("  " + ", ".join(f"{key} {value}" for key, value in baseline["machine"].items()))
+    compared = [name for name in results if name in baseline["cases"]]
+    regressions = compare(results, baseline["cases"], args.tolerance, args.min_ms, args.min_mb)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regressions in {len(compared)} of {len(results)} cases against {args.baseline}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
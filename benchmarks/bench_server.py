@@ -0,0 +1,135 @@
+"""Load test the HTTP tracing service of src/server.py on localhost.
+
+Starts the server in a child process on a free port, unless --url points at a running one, and sends
+--requests traces of a synthetic PNG from --concurrency clients, each on its own keep-alive connection.
+Rejected requests (503) are counted and not retried. Prints the throughput and the client side latency
+percentiles, followed by the server's /stats.
+
+Usage: python benchmarks/bench_server.py [--requests 200] [--concurrency 16] [--size 256] [--contours 16]
+                                         [--workers 4] [--queue-size 64] [--batch-size 8] [--batch-window-ms 5] [--url URL]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bench_pipeline import make_bitmap  # noqa: E402
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+async def http_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, target: str, body: bytes = b"") -> tuple:
+    """Send one request on a keep-alive connection and return the status and the response body."""
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, await reader.readexactly(int(headers.get("content-length", 0)))
+
+
+async def client(host: str, port: int, target: str, image: bytes, count: int, results: list):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            status, _ = await http_request(reader, writer, "POST", target, image)
+            results.append((status, time.perf_counter() - start))
+    finally:
+        writer.close()
+
+
+async def load(host: str, port: int, target: str, image: bytes, requests: int, concurrency: int) -> tuple:
+    results = []
+    counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, target, image, count, results) for count in counts if count))
+    elapsed = time.perf_counter() - start
+    reader, writer = await asyncio.open_connection(host, port)
+    _, stats = await http_request(reader, writer, "GET", "/stats")
+    writer.close()
+    return results, elapsed, json.loads(stats)
+
+
+def check_workers_exited(group: int, timeout: float = 5.0):
+    """Fail if a process of the server's process group is still running timeout seconds after the server exited."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            os.killpg(group, 0)
+        except ProcessLookupError:
+            return
+        if time.perf_counter() > deadline:
+            os.killpg(group, signal.SIGKILL)
+            sys.exit("server worker processes outlived the server and were killed")
+        time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16, help="clients sending requests at once")
+    parser.add_argument("--size", type=int, default=256, help="width and height of the traced image")
+    parser.add_argument("--contours", type=int, default=16, help="contours in the traced image")
+    parser.add_argument("--query", default="", help="trace options, e.g. turdsize=10&format=pdf")
+    parser.add_argument("--url", default=None, help="server to test instead of starting one, e.g. http://127.0.0.1:8000")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--batch-window-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    _, image = cv2.imencode(".png", make_bitmap(args.size, args.contours, 1))
+    image = image.tobytes()
+    target = "/trace" + (f"?{args.query}" if args.query else "")
+
+    server = None
+    if args.url is None:
+        command = [sys.executable, "server.py", "--port", "0", "--queue-size", str(args.queue_size), "--batch-size", str(args.batch_size)]
+        command += ["--batch-window-ms", str(args.batch_window_ms)] + (["--workers", str(args.workers)] if args.workers else [])
+        # In a session of its own, so that worker processes outliving the server can be found by process group
+        server = subprocess.Popen(command, cwd=SRC_DIR, stdout=subprocess.PIPE, text=True, start_new_session=True)
+        # "Listening on http://127.0.0.1:<port> with <n> workers", once every worker is warm
+        url = server.stdout.readline().split()[2]
+    else:
+        url = args.url
+    host, port = urlsplit(url).hostname, urlsplit(url).port
+    try:
+        results, elapsed, stats = asyncio.run(load(host, port, target, image, args.requests, args.concurrency))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            check_workers_exited(server.pid)
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = np.array([seconds for status, seconds in results if status == 200]) * 1000
+    print(f"{len(results)} requests of {len(image) / 1024:.1f} KB in {elapsed:.2f} s, {statuses.get(200, 0) / elapsed:.1f} traces/s")
+    print("status counts: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+    if len(latencies):
+        print("client latency ms: " + " ".join(f"p{q}={np.percentile(latencies, q):.1f}" for q in (50, 90, 99)) + f" max={latencies.max():.1f}")
+    print(f"server: {stats['batches']} batches, mean batch size {stats['mean_batch_size']:.2f}, {stats['rejected']} rejected")
+    for name in ("latency_ms", "queue_ms", "trace_ms"):
+        print(f"server {name}: " + " ".join(f"{key}={value:.1f}" for key, value in stats[name].items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Measure the node reduction of simplify_curves() at several tolerances and the time it saves after the trace.
+
+An image is traced once, or a synthetic scan when none is given: blurred noise cut at a threshold, which traces
+into many small, irregular contours. The trace is simplified at every tolerance, and the simplified curves are
+nested, converted to QPainterPaths (what the scene and the point overlays are built from) and written to SVG.
+Times are in ms, the median of --repeat runs. "deviation" is the largest distance of the simplified outline from
+the trace in pixels, as reported by simplify_curves(). Tolerance 0 only merges exactly collinear lines and
+drops the sub-pixel contours.
+
+Usage: python benchmarks/bench_simplify.py [image] [--size 2048] [--backend fitter] [--tolerances 0 0.25 0.5 1 2] [--repeat 3]
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from backends import POTRACE_BACKENDS  # noqa: E402
+from export import WRITERS  # noqa: E402
+from main import BezierTracing  # noqa: E402
+from nesting import nest_curves  # noqa: E402
+from simplify import node_count, simplify_curves  # noqa: E402
+
+
+def make_scan(size: int, seed: int = 0) -> np.ndarray:
+    """size x size blotches with ragged edges and specks, like a noisy scan."""
+    noise = np.random.default_rng(seed).random((size, size)).astype(np.float32)
+    blurred = cv2.GaussianBlur(noise, (0, 0), size / 256)
+    blurred = (blurred - blurred.min()) / (blurred.max() - blurred.min())
+    return np.where(blurred > 0.55, np.uint8(0), np.uint8(255))
+
+
+def median_ms(function, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times)), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", nargs="?", default=None, help="image to trace. Defaults to a synthetic scan")
+    parser.add_argument("--size", type=int, default=2048, help="size of the synthetic scan")
+    parser.add_argument("--backend", choices=sorted(POTRACE_BACKENDS), default="fitter")
+    parser.add_argument("--tolerances", type=float, nargs="+", default=[0, 0.25, 0.5, 1, 2])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        image_path = args.image
+        if image_path is None:
+            image_path = os.path.join(directory, "scan.png")
+            cv2.imwrite(image_path, make_scan(args.size))
+        bezier_tracing = BezierTracing(image_path, args.backend)
+        # Traced once, simplified and nested like BezierTracing.run_potrace() does
+        traced = bezier_tracing.trace_bitmap(bezier_tracing.opencv_image)
+        width, height = bezier_tracing.image_size
+
+    print(f"{os.path.basename(image_path)} {width}x{height}, {args.backend} backend, {traced.contour_count} contours")
+    columns = ["tolerance", "nodes", "reduction", "deviation", "dropped", "simplify", "nesting", "qt paths", "svg", "total"]
+    print(" ".join(f"{column:>10}" for column in columns))
+    for tolerance in [None] + args.tolerances:
+        if tolerance is None:
+            simplify_ms, (curves, stats) = 0.0, (traced, None)
+        else:
+            simplify_ms, (curves, stats) = median_ms(lambda: simplify_curves(traced, tolerance), args.repeat)
+        nesting_ms, shapes = median_ms(lambda: nest_curves(curves), args.repeat)
+        paths_ms, _ = median_ms(shapes.to_qt_paths, args.repeat)
+        svg_ms, _ = median_ms(lambda: WRITERS[".svg"](shapes, width, height, io.StringIO()), args.repeat)
+        row = [
+            "off" if tolerance is None else f"{tolerance:g}",
+            f"{node_count(curves)}",
+            f"{stats['reduction']:.1%}" if stats else "",
+            f"{stats['max_deviation']:.3f}" if stats else "",
+            f"{stats['dropped_contours']}" if stats else "",
+            f"{simplify_ms:.1f}",
+            f"{nesting_ms:.1f}",
+            f"{paths_ms:.1f}",
+            f"{svg_ms:.1f}",
+            f"{simplify_ms + nesting_ms + paths_ms + svg_ms:.1f}",
+        ]
+        print(" ".join(f"{value:>10}" for value in row))
+
+
+if __name__ == "__main__":
+    main()
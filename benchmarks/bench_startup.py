@@ -0,0 +1,104 @@
+"""Measure the startup time of the GUI and of the headless tools, each in fresh interpreters.
+
+"cli import" imports batch.py, "cli --help" runs it to its help text and "gui" imports main_gui.py, creates
+the main window and shows it, all timed from the start of the child process. A headless trace of a
+synthetic image is also run, untiled and in tiles whose seams cut through the shape, to check that it never
+imports Qt. Exits with status 1 if it does.
+
+Usage: python benchmarks/bench_startup.py [--repeat 5] [--skip-gui]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+CLI_IMPORT = """
+import time
+start = time.perf_counter()
+import batch
+print(time.perf_counter() - start)
+"""
+
+GUI_LAUNCH = """
+import time
+start = time.perf_counter()
+import sys
+from PyQt6.QtWidgets import QApplication
+import main_gui
+app = QApplication(sys.argv)
+window = main_gui.MainWindow()
+window.show()
+app.processEvents()
+print(time.perf_counter() - start)
+"""
+
+HEADLESS_TRACE = """
+import sys
+import cv2
+import numpy as np
+from main import BezierTracing
+image = np.full((200, 200), 255, np.uint8)
+cv2.circle(image, (100, 100), 60, 0, -1)
+cv2.imwrite(sys.argv[1], image)
+BezierTracing(sys.argv[1], tile_size=int(sys.argv[2]) or None).curves
+print(" ".join(sorted(name for name in sys.modules if name.startswith("PyQt6"))))
+"""
+
+
+def run(args: list, env: dict = None) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable] + args, cwd=SRC_DIR, env=env, capture_output=True, text=True, check=True)
+
+
+def timed_runs(args: list, repeat: int, env: dict = None) -> np.ndarray:
+    """Seconds until each run is done, as printed by the snippet, or else measured from outside."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = run(args, env).stdout.strip().splitlines()
+        elapsed = time.perf_counter() - start
+        try:
+            times.append(float(output[-1]))
+        except (IndexError, ValueError):
+            times.append(elapsed)
+    return np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-gui", action="store_true")
+    args = parser.parse_args()
+
+    results = {
+        "cli import": timed_runs(["-c", CLI_IMPORT], args.repeat),
+        # The whole process, interpreter start included
+        "cli --help": timed_runs(["batch.py", "--help"], args.repeat),
+    }
+    if not args.skip_gui:
+        env = dict(os.environ)
+        env.setdefault("QT_QPA_PLATFORM", "offscreen")
+        results["gui"] = timed_runs(["-c", GUI_LAUNCH], args.repeat, env)
+
+    print(f"{'':>11} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for name, times in results.items():
+        print(f"{name:>11} {np.median(times) * 1000:>10.1f} {times.min() * 1000:>8.1f} {times.max() * 1000:>8.1f}")
+
+    imported_qt = False
+    # The tiles of 64 pixels cut the circle at four seams, which are clipped and stitched
+    for name, tile_size in (("headless trace", 0), ("tiled headless trace", 64)):
+        with tempfile.TemporaryDirectory() as directory:
+            qt_modules = run(["-c", HEADLESS_TRACE, os.path.join(directory, "circle.png"), str(tile_size)]).stdout.strip()
+        print(f"Qt modules imported by a {name}: {qt_modules or 'none'}")
+        imported_qt |= bool(qt_modules)
+    sys.exit(1 if imported_qt else 0)
+
+
+if __name__ == "__main__":
+    main()
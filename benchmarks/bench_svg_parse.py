@@ -0,0 +1,101 @@
+"""Compare the in-memory SVG parser against the former tempfile + svgpathtools round trip.
+
+Usage: python benchmarks/bench_svg_parse.py [--size 2000] [--repeat 5]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from PyQt6.QtGui import QPainterPath  # noqa: E402
+
+from backends import run_potrace_output, svg2qt_path_list  # noqa: E402
+from main import BezierTracing  # noqa: E402
+
+
+def make_contour_heavy_image(size: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    image = np.full((size, size, 3), 255, np.uint8)
+    for _ in range(size // 2):
+        center = tuple(int(v) for v in rng.integers(0, size, 2))
+        radius = int(rng.integers(3, max(4, size // 40)))
+        cv2.circle(image, center, radius, (0, 0, 0), -1)
+        cv2.circle(image, center, radius // 2, (255, 255, 255), -1)
+    for row in range(20, size, 60):
+        cv2.putText(image, "Potrace 0123456789", (10, row), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+    return image
+
+
+def legacy_svg2qt_path_list(svg: str):
+    """The former implementation: write a temp file and parse it back with svgpathtools."""
+    from svgpathtools import svg2paths
+    from svgpathtools.path import CubicBezier, Line
+
+    svg_path = tempfile.NamedTemporaryFile().name
+    with open(svg_path, mode="w", encoding="utf-8") as f:
+        f.write(svg)
+    pathes, _, svg_attributes = svg2paths(svg_path, return_svg_attributes=True)
+    os.remove(svg_path)
+    height = float(svg_attributes["height"][:-2])
+    qt_path_list = []
+    end_point = None
+    for path in pathes:
+        qt_path = QPainterPath()
+        for segment in path:
+            qt_points = [(bpoint.real, bpoint.imag) for bpoint in segment.bpoints()]
+            if qt_points[0] != end_point:
+                if not qt_path.isEmpty():
+                    qt_path.closeSubpath()
+                    qt_path_list.append(qt_path)
+                    qt_path = QPainterPath()
+                qt_path.moveTo(qt_points[0][0] / 10, -qt_points[0][1] / 10 + height)
+            if isinstance(segment, Line):
+                qt_path.lineTo(qt_points[1][0] / 10, -qt_points[1][1] / 10 + height)
+            elif isinstance(segment, CubicBezier):
+                qt_path.cubicTo(*[v for x, y in qt_points[1:] for v in (x / 10, -y / 10 + height)])
+            end_point = qt_points[-1]
+        else:
+            qt_path.closeSubpath()
+            qt_path_list.append(qt_path)
+    return qt_path_list
+
+
+def best_of(repeat: int, function, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        image_path = os.path.join(directory, "contours.png")
+        cv2.imwrite(image_path, make_contour_heavy_image(args.size))
+        bezier_tracing = BezierTracing(image_path)
+        svg = run_potrace_output(bezier_tracing.opencv_image)
+
+    legacy_time, legacy_paths = best_of(args.repeat, legacy_svg2qt_path_list, svg.decode("utf-8"))
+    stream_time, stream_paths = best_of(args.repeat, svg2qt_path_list, svg)
+    assert len(legacy_paths) == len(stream_paths), (len(legacy_paths), len(stream_paths))
+
+    print(f"image {args.size}x{args.size}, {len(svg) / 1e6:.2f} MB SVG, {len(stream_paths)} contours")
+    print(f"tempfile + svgpathtools: {legacy_time * 1000:8.1f} ms")
+    print(f"in-memory stream parser: {stream_time * 1000:8.1f} ms ({legacy_time / stream_time:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Measure a select-all, move, delete, undo and redo over a dense trace, and the memory the edits hold.
+
+Times are in ms and "rss MB" is the growth of the process from before the shapes were loaded. The former
+scene kept one QUndoCommand per edit with the list of moved items and their old and new positions,
+and hid deleted items instead of removing them, so every edited shape kept an item of its own for good. The
+edit history stores index arrays and offset vectors on the shapes of the batched scene, merges consecutive
+moves of the same shapes, and frees the geometry of deletions that fall off the bottom of the stack.
+"legacy" is the former commands over one QGraphicsPathItem per shape.
+
+Usage: python benchmarks/bench_undo.py [--shapes 50000] [--depth 4] [--skip-legacy]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtCore import QPointF, Qt  # noqa: E402
+from PyQt6.QtGui import QBrush, QColor, QKeyEvent, QPen, QUndoCommand, QUndoStack  # noqa: E402
+from PyQt6.QtWidgets import QApplication, QGraphicsItem, QGraphicsPathItem, QGraphicsScene  # noqa: E402
+
+import profiling  # noqa: E402
+from bench_frame_time import make_curves  # noqa: E402
+from main_gui import CustomGraphicsScene  # noqa: E402
+from scene_items import BatchedCurvesItem, PathStyle  # noqa: E402
+from undo import EditHistory  # noqa: E402
+
+OFFSET = QPointF(5.0, 3.0)
+
+
+def key(scene: QGraphicsScene, key: Qt.Key, modifiers: Qt.KeyboardModifier = Qt.KeyboardModifier.NoModifier):
+    scene.keyPressEvent(QKeyEvent(QKeyEvent.Type.KeyPress, key, modifiers))
+
+
+def drag(items: list):
+    """Move the items the way a mouse drag of the selection does."""
+    for item in items:
+        item.setPos(item.pos() + OFFSET)
+
+
+def timed(steps: list) -> dict:
+    """Milliseconds of every step, including the event processing that follows it in the GUI."""
+    times = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        step()
+        QApplication.processEvents()
+        times[name] = (time.perf_counter() - start) * 1000
+    return times
+
+
+class LegacyMoveCommand(QUndoCommand):
+    def __init__(self, item_list, pos_list, new_pos_list):
+        super().__init__()
+        self.item_list, self.pos_list, self.new_pos_list = item_list, pos_list, new_pos_list
+
+    def undo(self):
+        for item, pos in zip(self.item_list, self.pos_list):
+            item.setPos(pos)
+
+    def redo(self):
+        for item, pos in zip(self.item_list, self.new_pos_list):
+            item.setPos(pos)
+
+
+class LegacyDeleteCommand(QUndoCommand):
+    def __init__(self, items):
+        super().__init__()
+        self.items = items
+
+    def undo(self):
+        for item in self.items:
+            item.setVisible(True)
+
+    def redo(self):
+        for item in self.items:
+            item.setVisible(False)
+
+
+def legacy_edits(curves, depth: int) -> dict:
+    scene = QGraphicsScene()
+    stack = QUndoStack()
+    stack.setUndoLimit(depth)
+    pen, brush = QPen(QColor(Qt.GlobalColor.black)), QBrush(QColor(Qt.GlobalColor.black))
+    items = []
+
+    def load():
+        for path in curves.to_qt_paths():
+            item = QGraphicsPathItem(path)
+            item.setFlags(QGraphicsItem.GraphicsItemFlag.ItemIsSelectable | QGraphicsItem.GraphicsItemFlag.ItemIsMovable)
+            item.setPen(pen)
+            item.setBrush(brush)
+            scene.addItem(item)
+            items.append(item)
+
+    def select_all():
+        for item in items:
+            item.setSelected(True)
+
+    def move():
+        old = [item.pos() for item in items]
+        drag(items)
+        stack.push(LegacyMoveCommand(items, old, [item.pos() for item in items]))
+
+    def delete():
+        scene.clearSelection()
+        stack.push(LegacyDeleteCommand(items))
+
+    rss = profiling.rss_bytes()
+    times = timed(
+        [("load", load), ("select all", select_all), ("move", move), ("move again", move), ("delete", delete), ("undo", stack.undo), ("redo", stack.redo)]
+    )
+    times["rss MB"] = (profiling.rss_bytes() - rss) / 2**20
+    return times
+
+
+def batched_edits(curves, depth: int) -> tuple:
+    scene = CustomGraphicsScene()
+    scene.undo_stack = EditHistory(depth, scene)
+    style = PathStyle(QPen(QColor(Qt.GlobalColor.black)), QBrush(QColor(Qt.GlobalColor.black)))
+    scene.batch = BatchedCurvesItem(style, 1.0)
+    scene.addItem(scene.batch)
+    everything = list(range(len(curves)))
+
+    def move():
+        drag(list(scene.batch.promoted_items))
+        scene._push_move()
+
+    def delete():
+        scene.promote_shapes(everything, select=True)
+        key(scene, Qt.Key.Key_Delete)
+
+    def expire():
+        # Edits of a few shapes push the deletion off the bottom of the stack
+        for i in range(depth):
+            scene.promote_shapes([i], select=True)
+            key(scene, Qt.Key.Key_Delete)
+
+    rss = profiling.rss_bytes()
+    times = timed(
+        [
+            ("load", lambda: scene.batch.add_curves(curves)),
+            ("select all", lambda: scene.promote_shapes(everything, select=True)),
+            ("move", move),
+            ("move again", move),
+            ("delete", delete),
+            ("undo", lambda: key(scene, Qt.Key.Key_Z, Qt.KeyboardModifier.ControlModifier)),
+            ("redo", lambda: key(scene, Qt.Key.Key_Z, Qt.KeyboardModifier.ControlModifier | Qt.KeyboardModifier.ShiftModifier)),
+        ]
+    )
+    times["rss MB"] = (profiling.rss_bytes() - rss) / 2**20
+    footprint = {"after edits": {**scene.undo_stack.footprint(), **scene.batch.footprint()}}
+    times["expire"] = timed([("expire", expire)])["expire"]
+    footprint["after expiry"] = {**scene.undo_stack.footprint(), **scene.batch.footprint()}
+    return times, footprint
+
+
+def run_scene(name: str, args) -> tuple:
+    """Times, footprint and Qt platform of one scene, measured in a fresh process so that its memory growth is its own."""
+    command = [sys.executable, os.path.abspath(__file__), "--scene", name, "--shapes", str(args.shapes), "--depth", str(args.depth)]
+    return tuple(json.loads(subprocess.run(command, capture_output=True, text=True, check=True).stdout))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shapes", type=int, default=50000)
+    parser.add_argument("--depth", type=int, default=4, help="undo depth of the edit history")
+    parser.add_argument("--skip-legacy", action="store_true")
+    parser.add_argument("--scene", choices=["batched", "legacy"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scene is not None:
+        app = QApplication(sys.argv)
+        curves = make_curves(args.shapes)
+        times, footprint = batched_edits(curves, args.depth) if args.scene == "batched" else (legacy_edits(curves, args.depth), {})
+        print(json.dumps([times, footprint, app.platformName()]))
+        return
+
+    batched, footprint, platform = run_scene("batched", args)
+    results = {"batched": batched}
+    if not args.skip_legacy:
+        results["legacy"] = run_scene("legacy", args)[0]
+
+    columns = list(batched)
+    print(f"{args.shapes} shapes, undo depth {args.depth}, {platform} platform")
+    print(f"{'scene':>8} " + " ".join(f"{name:>10}" for name in columns))
+    for name, times in results.items():
+        print(f"{name:>8} " + " ".join(f"{times[column]:>10.1f}" if column in times else f"{'':>10}" for column in columns))
+    for name, counts in footprint.items():
+        print(f"{name}: " + ", ".join(f"{key} {value}" for key, value in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
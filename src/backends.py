@@ -0,0 +1,271 @@
+import json
+import re
+import subprocess
+import threading
+import warnings
+from typing import List, Tuple
+
+import numpy as np
+
+import profiling
+from curves import CURVE_TO, CURVE_TO_DATA, LINE_TO, MOVE_TO, CurveStore
+from fitting import DEFAULT_CORNER_ANGLE, fit_bitmap
+
+SVG_TRANSFORM_RE = re.compile(rb"translate\(([-\d.eE]+)[ ,]+([-\d.eE]+)\)\s*scale\(([-\d.eE]+)[ ,]+([-\d.eE]+)\)")
+SVG_PATH_DATA_RE = re.compile(rb'<path\b[^>]*?\sd="([^"]*)"')
+SVG_PATH_TOKEN_RE = re.compile(rb"[A-Za-z]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+# Output formats of the potrace executable that can be parsed back
+POTRACE_OUTPUT_FORMATS = ("svg", "geojson")
+TURN_POLICIES = ("black", "white", "left", "right", "minority", "majority", "random")
+# Bitmap rows packed at once into the PBM input of potrace, which bounds the temporary arrays
+PBM_BLOCK_ROWS = 256
+# Potrace's own defaults
+DEFAULT_POTRACE_PARAMETERS = {"turdsize": 2, "turnpolicy": "minority", "alphamax": 1.0, "opticurve": True, "opttolerance": 0.2}
+
+
+class TraceCancelled(Exception):
+    pass
+
+
+def normalized_potrace_parameters(parameters: dict = None) -> dict:
+    """DEFAULT_POTRACE_PARAMETERS updated with parameters, checked and converted to their types.
+
+    Args:
+        parameters (dict, optional): any of turdsize (speckles of up to this many pixels are dropped), turnpolicy
+            (one of TURN_POLICIES, resolves ambiguous paths), alphamax (corner threshold, 0 gives a polygon and
+            values above 4 / 3 no corners), opticurve (join curve segments) and opttolerance (error allowed when
+            joining them). Defaults to None.
+    """
+    parameters = {**DEFAULT_POTRACE_PARAMETERS, **(parameters or {})}
+    unknown = set(parameters) - set(DEFAULT_POTRACE_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown potrace parameters: {', '.join(sorted(unknown))}")
+    if parameters["turnpolicy"] not in TURN_POLICIES:
+        raise ValueError(f"Unknown turn policy: {parameters['turnpolicy']}")
+    parameters["turdsize"] = int(parameters["turdsize"])
+    parameters["alphamax"] = float(parameters["alphamax"])
+    parameters["opticurve"] = bool(parameters["opticurve"])
+    parameters["opttolerance"] = float(parameters["opttolerance"])
+    if parameters["turdsize"] < 0 or parameters["alphamax"] < 0 or parameters["opttolerance"] < 0:
+        raise ValueError("turdsize, alphamax and opttolerance must not be negative")
+    return parameters
+
+
+def potrace_arguments(parameters: dict = None) -> List[str]:
+    """Command line options of the potrace executable for parameters."""
+    parameters = normalized_potrace_parameters(parameters)
+    arguments = ["-t", str(parameters["turdsize"]), "-z", parameters["turnpolicy"], "-a", repr(parameters["alphamax"])]
+    if parameters["opticurve"]:
+        arguments += ["-O", repr(parameters["opttolerance"])]
+    else:
+        arguments.append("-n")
+    return arguments
+
+
+def pbm_data(bitmap: np.ndarray) -> bytearray:
+    """The bitmap as a binary PBM file, its dark pixels set, packed into the file buffer PBM_BLOCK_ROWS at a time."""
+    height, width = bitmap.shape[:2]
+    header = f"P4\n{width} {height}\n".encode("ascii")
+    row_bytes = (width + 7) // 8
+    data = bytearray(len(header) + height * row_bytes)
+    data[: len(header)] = header
+    rows = np.frombuffer(data, np.uint8, offset=len(header)).reshape(height, row_bytes)
+    for start in range(0, height, PBM_BLOCK_ROWS):
+        # Potrace's own threshold for gray input
+        rows[start : start + PBM_BLOCK_ROWS] = np.packbits(bitmap[start : start + PBM_BLOCK_ROWS] < 128, axis=1)
+    return data
+
+
+def run_potrace_output(bitmap: np.ndarray, output_format: str = "svg", cancel_event: threading.Event = None, parameters: dict = None) -> bytes:
+    with profiling.stage("encode"):
+        binbmp = pbm_data(bitmap)
+    args = ["potrace", "-", "-o-", "-b", output_format] + potrace_arguments(parameters)
+    with profiling.stage("subprocess"):
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
+        if cancel_event is not None:
+            # communicate() cannot be resumed with pending input after a timeout, so a watcher kills potrace instead
+            def kill_on_cancel():
+                while p.poll() is None:
+                    if cancel_event.wait(0.1):
+                        p.kill()
+                        return
+
+            threading.Thread(target=kill_on_cancel, daemon=True).start()
+        stdout, stderr = p.communicate(input=binbmp)
+    if cancel_event is not None and cancel_event.is_set():
+        raise TraceCancelled()
+    if len(stderr) != 0:
+        raise RuntimeError("Potrace threw error:\n" + stderr.decode("utf-8"))
+    return stdout
+
+
+def parse_potrace_svg(svg: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Parse potrace's SVG output into flat curve arrays.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: element types (uint8), image space points (N x 2 float64)
+            and the start index of every contour.
+    """
+    if isinstance(svg, str):
+        svg = svg.encode("utf-8")
+    transform = SVG_TRANSFORM_RE.search(svg)
+    if transform is not None:
+        tx, ty, sx, sy = (float(value) for value in transform.groups())
+    else:
+        tx, ty, sx, sy = 0.0, 0.0, 1.0, 1.0
+    tokens = np.array(SVG_PATH_TOKEN_RE.findall(b" ".join(SVG_PATH_DATA_RE.findall(svg))))
+    if tokens.size == 0:
+        return np.empty(0, np.uint8), np.empty((0, 2)), np.empty(0, np.int64)
+
+    is_command = np.char.isalpha(tokens)
+    command_index = np.flatnonzero(is_command)
+    commands = tokens[command_index]
+    if not np.isin(commands, [b"M", b"m", b"l", b"c", b"z"]).all():
+        raise ValueError("Unsupported path command in potrace SVG output")
+    relative = tokens[~is_command].astype(np.float64).reshape(-1, 2)
+
+    # Expand the command of every coordinate pair. potrace only writes "M" at the start of a <path>
+    # element and relative "m", "l" and "c" afterwards, so every pair belongs to exactly one of them.
+    pair_counts = (np.diff(np.append(command_index, tokens.size)) - 1) // 2
+    pair_commands = np.repeat(commands, pair_counts)
+    chunk_starts = np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    position_in_chunk = np.arange(len(relative)) - chunk_starts
+    is_curve = pair_commands == b"c"
+    is_end = ~is_curve | (position_in_chunk % 3 == 2)
+    is_absolute = pair_commands == b"M"
+
+    # The current point after each segment is a running sum of the segment end offsets that restarts at
+    # every absolute moveto. Closed contours end on their start point, so "z" does not move it.
+    end_offsets = relative[is_end]
+    end_absolute = is_absolute[is_end]
+    running = np.cumsum(np.where(end_absolute[:, None], 0.0, end_offsets), axis=0)
+    group = np.cumsum(end_absolute) - 1
+    anchor = np.flatnonzero(end_absolute)
+    end_points = end_offsets[anchor][group] + running - running[anchor][group]
+
+    # Control points are relative to the start of their segment, i.e. the previous end point.
+    segment_index = np.cumsum(is_end) - is_end
+    start_points = np.vstack([np.zeros((1, 2)), end_points])[segment_index]
+    points = np.where(is_absolute[:, None], relative, start_points + relative)
+    points *= (sx, sy)
+    points += (tx, ty)
+
+    codes = np.full(len(points), LINE_TO, np.uint8)
+    codes[np.isin(pair_commands, [b"M", b"m"])] = MOVE_TO
+    codes[is_curve] = CURVE_TO_DATA
+    codes[is_curve & (position_in_chunk % 3 == 0)] = CURVE_TO
+    return codes, points, np.flatnonzero(codes == MOVE_TO)
+
+
+def parse_potrace_geojson(data: bytes, height: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Parse potrace's GeoJSON output into the same flat curve arrays as parse_potrace_svg.
+
+    GeoJSON has no curve primitive, so every contour arrives as a closed polygon ring.
+    """
+    rings = []
+    for feature in json.loads(data)["features"]:
+        geometry = feature["geometry"]
+        polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+        for polygon in polygons:
+            # The closing coordinate repeats the first one
+            rings.extend(ring[:-1] for ring in polygon if len(ring) > 1)
+    if not rings:
+        return np.empty(0, np.uint8), np.empty((0, 2)), np.empty(0, np.int64)
+    lengths = np.array([len(ring) for ring in rings])
+    points = np.array([point for ring in rings for point in ring], dtype=np.float64)
+    # GeoJSON coordinates have their origin at the bottom left
+    points[:, 1] = height - points[:, 1]
+    offsets = np.cumsum(lengths) - lengths
+    codes = np.full(len(points), LINE_TO, np.uint8)
+    codes[offsets] = MOVE_TO
+    return codes, points, offsets
+
+
+def svg2qt_path_list(svg: bytes) -> list:
+    """Build one closed QPainterPath per contour straight from potrace's SVG output."""
+    return CurveStore(*parse_potrace_svg(svg)).to_qt_paths()
+
+
+def trace_with_subprocess(bitmap: np.ndarray, cancel_event: threading.Event = None, parameters: dict = None) -> CurveStore:
+    """Trace with the potrace executable. Always available as long as potrace is on PATH."""
+    svg = run_potrace_output(bitmap, "svg", cancel_event, parameters)
+    with profiling.stage("parse"):
+        return CurveStore(*parse_potrace_svg(svg))
+
+
+def trace_with_subprocess_geojson(bitmap: np.ndarray, cancel_event: threading.Event = None, parameters: dict = None) -> CurveStore:
+    """Trace with the potrace executable's GeoJSON backend, which yields polygons instead of Bezier curves."""
+    data = run_potrace_output(bitmap, "geojson", cancel_event, parameters)
+    with profiling.stage("parse"):
+        return CurveStore(*parse_potrace_geojson(data, bitmap.shape[0]))
+
+
+def _point(point):
+    # pypotrace returns tuples, potracer returns objects with x and y
+    if hasattr(point, "x"):
+        return point.x, point.y
+    return point[0], point[1]
+
+
+def trace_with_bindings(bitmap: np.ndarray, cancel_event: threading.Event = None, parameters: dict = None) -> CurveStore:
+    """Trace in-process with the potrace Python bindings (pypotrace or potracer).
+
+    Falls back to the subprocess backend when no bindings are installed. The bindings cannot be
+    interrupted, so cancel_event is only honoured by the fallback.
+    """
+    try:
+        import potrace
+    except ImportError:
+        warnings.warn("potrace bindings are not installed, falling back to the potrace executable")
+        return trace_with_subprocess(bitmap, cancel_event, parameters)
+    parameters = normalized_potrace_parameters(parameters)
+    # pypotrace names the turn policies TURNPOLICY_*, potracer POTRACE_TURNPOLICY_*
+    policy = parameters["turnpolicy"].upper()
+    parameters["turnpolicy"] = getattr(potrace, f"TURNPOLICY_{policy}", None)
+    if parameters["turnpolicy"] is None:
+        parameters["turnpolicy"] = getattr(potrace, f"POTRACE_TURNPOLICY_{policy}")
+    if potrace.Bitmap.__module__ == "potrace.potrace":
+        # potracer follows the executable and traces the dark pixels of an 8-bit image
+        data = bitmap
+    else:
+        # pypotrace traces the non-zero entries
+        data = bitmap == 0
+    codes = []
+    points = []
+    offsets = []
+    for curve in potrace.Bitmap(data).trace(**parameters).curves:
+        offsets.append(len(codes))
+        codes.append(MOVE_TO)
+        points.append(_point(curve.start_point))
+        for segment in curve.segments:
+            if segment.is_corner:
+                codes.extend((LINE_TO, LINE_TO))
+                points.extend((_point(segment.c), _point(segment.end_point)))
+            else:
+                codes.extend((CURVE_TO, CURVE_TO_DATA, CURVE_TO_DATA))
+                points.extend((_point(segment.c1), _point(segment.c2), _point(segment.end_point)))
+    return CurveStore(np.array(codes, np.uint8), np.array(points, np.float64).reshape(-1, 2), np.array(offsets, np.int64))
+
+
+def trace_with_fitter(bitmap: np.ndarray, cancel_event: threading.Event = None, parameters: dict = None) -> CurveStore:
+    """Fit curves to the pixel boundaries with NumPy (see fitting.py), without potrace.
+
+    Needs no potrace executable and starts no process for small bitmaps. Of the potrace parameters, turdsize
+    drops speckles and alphamax scales the corner angle, 0 giving polygons as with potrace.
+    """
+    parameters = normalized_potrace_parameters(parameters)
+    curves = fit_bitmap(bitmap, corner_angle=DEFAULT_CORNER_ANGLE * parameters["alphamax"], turdsize=parameters["turdsize"], cancel_event=cancel_event)
+    if cancel_event is not None and cancel_event.is_set():
+        raise TraceCancelled()
+    return curves
+
+
+# Each backend takes the preprocessed bitmap (dark pixels are traced), an optional cancel event and optional
+# potrace parameters (see normalized_potrace_parameters()), and returns a CurveStore with one shape per contour.
+POTRACE_BACKENDS = {
+    "subprocess": trace_with_subprocess,
+    "geojson": trace_with_subprocess_geojson,
+    "native": trace_with_bindings,
+    "fitter": trace_with_fitter,
+}
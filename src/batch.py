@@ -0,0 +1,281 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List
+
+import profiling
+from backends import DEFAULT_POTRACE_PARAMETERS, POTRACE_BACKENDS, TURN_POLICIES
+from cache import DEFAULT_CACHE_MAX_BYTES, TraceCache
+from export import LAYER_WRITERS, WRITERS
+from main import BezierTracing
+from preprocess import POSTERIZE_METHODS, THRESHOLD_METHODS, Posterize, PreprocessPipeline
+from simplify import combined_stats
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".pgm", ".ppm"}
+
+
+def collect_image_paths(inputs: List[str]) -> List[str]:
+    """Expand directories and glob patterns into a sorted list of image files."""
+    image_paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            candidates = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            candidates = glob.glob(pattern, recursive=True)
+        for candidate in candidates:
+            if os.path.isfile(candidate) and os.path.splitext(candidate)[1].lower() in IMAGE_EXTENSIONS:
+                image_paths.add(candidate)
+    return sorted(image_paths)
+
+
+def get_output_path(image_path: str, output_dir: str, extension: str) -> str:
+    directory = output_dir if output_dir is not None else os.path.dirname(image_path)
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(directory, name + extension)
+
+
+def trace_file(
+    image_path: str,
+    output_path: str,
+    backend: str = "subprocess",
+    cache_dir: str = None,
+    cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    preprocess: PreprocessPipeline = None,
+    tile_size: int = None,
+    tile_workers: int = None,
+    export_options: dict = None,
+    profile_dir: str = None,
+    profile_level: int = 0,
+    potrace_parameters: dict = None,
+    posterize: dict = None,
+    simplify: float = None,
+):
+    """Trace one image and write it to output_path. Runs inside a worker process.
+
+    export_options are passed on to the writer of export.WRITERS, e.g. {"decimals": 1, "merge": True}.
+    With posterize, the arguments of a preprocess.Posterize stage, the image is traced in color layers with
+    BezierTracing.trace_layers() instead, without the cache.
+    With simplify, the trace is simplified with that tolerance in pixels, see simplify.simplify_curves().
+    With profile_dir, the stage times are written to <name>.profile.json in it, with the memory counters
+    from profile_level 1 on and the cProfile statistics to <name>.prof at profile_level 2.
+
+    Returns:
+        Tuple[str, bool, Optional[dict], Optional[dict]]: the written file, whether the trace came from the cache,
+        the profiling report and the simplification stats.
+    """
+    cache = TraceCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+    profiler = profiling.TraceProfiler(image_path, memory=profile_level >= 1, profile=profile_level >= 2) if profile_dir is not None else None
+    if profiler is not None:
+        profiler.start()
+    try:
+        bezier_tracing = BezierTracing(
+            image_path, backend, cache, preprocess, tile_size, tile_workers=tile_workers, potrace_parameters=potrace_parameters, simplify=simplify
+        )
+        extension = os.path.splitext(output_path)[1].lower()
+        if posterize is not None:
+            layers = bezier_tracing.trace_layers(Posterize(**posterize), tile_workers)
+            width, height = bezier_tracing.image_size
+            profiling.enter_stage("export")
+            LAYER_WRITERS[extension](layers, width, height, output_path, **(export_options or {}))
+        else:
+            curves = bezier_tracing.curves
+            width, height = bezier_tracing.image_size
+            profiling.enter_stage("export")
+            WRITERS[extension](curves, width, height, output_path, **(export_options or {}))
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    report = None
+    if profiler is not None:
+        report = profiler.report()
+        profiler.write_json(get_output_path(image_path, profile_dir, ".profile.json"))
+        profiler.write_cprofile(get_output_path(image_path, profile_dir, ".prof"))
+    return output_path, cache is not None and cache.hits > 0, report, bezier_tracing.simplify_stats
+
+
+def run_batch(
+    image_paths: List[str],
+    output_dir: str = None,
+    extension: str = ".svg",
+    jobs: int = None,
+    backend: str = "subprocess",
+    cache_dir: str = None,
+    cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    preprocess: PreprocessPipeline = None,
+    tile_size: int = None,
+    export_options: dict = None,
+    profile_dir: str = None,
+    profile_level: int = 0,
+    potrace_parameters: dict = None,
+    posterize: dict = None,
+    verbose: bool = False,
+    simplify: float = None,
+) -> int:
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+    failures = 0
+    reports = []
+    simplify_stats = []
+    cache_hits = 0
+    # Parallelism goes to the tiles of a single image, otherwise to the images
+    tile_workers = None if len(image_paths) == 1 else 1
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                trace_file,
+                image_path,
+                get_output_path(image_path, output_dir, extension),
+                backend,
+                cache_dir,
+                cache_max_bytes,
+                preprocess,
+                tile_size,
+                tile_workers,
+                export_options,
+                profile_dir,
+                profile_level,
+                potrace_parameters,
+                posterize,
+                simplify,
+            ): image_path
+            for image_path in image_paths
+        }
+        for future in as_completed(futures):
+            try:
+                output_path, cache_hit, report, stats = future.result()
+                cache_hits += cache_hit
+                if report is not None:
+                    reports.append(report)
+                if stats is not None:
+                    simplify_stats.append(stats)
+                if verbose:
+                    print(output_path)
+            except Exception as e:
+                failures += 1
+                print(f"Failed to trace {futures[future]}: {e}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    throughput = len(image_paths) / elapsed if elapsed > 0 else 0.0
+    print(f"Traced {len(image_paths) - failures}/{len(image_paths)} images in {elapsed:.2f} s ({throughput:.2f} images/s), {failures} failures")
+    if cache_dir is not None:
+        cache_stats = TraceCache(cache_dir, cache_max_bytes).stats()
+        print(
+            f"Cache: {cache_hits} hits, {len(image_paths) - failures - cache_hits} misses, {cache_stats['entries']} entries, {cache_stats['bytes'] / 1e6:.1f} MB"
+        )
+    if simplify_stats:
+        stats = combined_stats(simplify_stats)
+        print(
+            f"Simplified: {stats['nodes_before']} to {stats['nodes_after']} nodes ({stats['reduction']:.1%} fewer), "
+            f"max deviation {stats['max_deviation']:.3f} px, {stats['dropped_contours']} contours dropped"
+        )
+    if reports:
+        summary = profiling.aggregate(reports)
+        with open(os.path.join(profile_dir, "summary.json"), mode="w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"{'stage':>20} {'total s':>9} {'mean s':>9} {'p95 s':>9}")
+        for name, stage in sorted(summary["stages"].items(), key=lambda item: -item[1]["total_seconds"]):
+            print(f"{name:>20} {stage['total_seconds']:>9.3f} {stage['mean_seconds']:>9.3f} {stage['p95_seconds']:>9.3f}")
+    return failures
+
+
+def add_preprocess_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--threshold", default="120", help=f"gray level of the fixed threshold, or one of {', '.join(THRESHOLD_METHODS[1:])}")
+    parser.add_argument("--despeckle", type=int, default=1, help="median filter size applied before thresholding")
+    parser.add_argument("--scale", type=float, default=1.0, help="resize factor applied before tracing")
+
+
+def preprocess_from_arguments(args: argparse.Namespace) -> PreprocessPipeline:
+    preprocess = PreprocessPipeline.default()
+    if args.threshold in THRESHOLD_METHODS:
+        preprocess.update("threshold", method=args.threshold)
+    else:
+        preprocess.update("threshold", method="fixed", value=int(args.threshold))
+    preprocess.update("despeckle", ksize=args.despeckle)
+    preprocess.update("resize", scale=args.scale)
+    return preprocess
+
+
+def add_potrace_arguments(parser: argparse.ArgumentParser, nargs: str = None):
+    """Potrace parameter options, taking several values each with nargs="+"."""
+
+    def default(name):
+        return [DEFAULT_POTRACE_PARAMETERS[name]] if nargs else DEFAULT_POTRACE_PARAMETERS[name]
+
+    parser.add_argument("-t", "--turdsize", type=int, nargs=nargs, default=default("turdsize"), help="drop speckles of up to this many pixels")
+    parser.add_argument("-a", "--alphamax", type=float, nargs=nargs, default=default("alphamax"), help="corner threshold, 0 traces polygons")
+    parser.add_argument("-O", "--opttolerance", type=float, nargs=nargs, default=default("opttolerance"), help="curve optimization tolerance")
+    parser.add_argument("-z", "--turnpolicy", choices=TURN_POLICIES, nargs=nargs, default=default("turnpolicy"), help="how to resolve ambiguous paths")
+    parser.add_argument("-n", "--no-opticurve", action="store_true", help="turn off curve optimization")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace images to vector data with Potrace, without a display.")
+    parser.add_argument("inputs", nargs="+", help="image files, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir", default=None, help="directory for the traced files. Defaults to next to each input")
+    parser.add_argument("-f", "--format", choices=["svg", "pdf"], default="svg", help="output format")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes. Defaults to the CPU count")
+    parser.add_argument("-b", "--backend", choices=sorted(POTRACE_BACKENDS), default="subprocess", help="potrace backend")
+    add_preprocess_arguments(parser)
+    add_potrace_arguments(parser)
+    parser.add_argument("--layers", type=int, default=None, help="trace this many color layers, the background included, instead of a threshold")
+    parser.add_argument("--posterize", choices=POSTERIZE_METHODS[:2], default="kmeans", help="how the colors of --layers are picked")
+    parser.add_argument("--palette", nargs="+", default=None, metavar="RRGGBB", help="trace the layers of these colors, the background included")
+    parser.add_argument("--simplify", type=float, default=None, metavar="TOL", help="reduce the nodes of the trace, moving it by at most this many pixels")
+    parser.add_argument("--tile-size", type=int, default=None, help="trace very large images in tiles of this many pixels to bound memory")
+    parser.add_argument("--decimals", type=int, default=None, help="round coordinates to this many decimals to shrink the output")
+    parser.add_argument("--merge", action="store_true", help="write blocks of shapes as single paths")
+    parser.add_argument("--cache-dir", default=None, help="reuse traces stored in this directory. Disabled by default")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_MAX_BYTES // (1024 * 1024), help="cache size limit in MiB")
+    parser.add_argument("--profile", default=None, metavar="DIR", help="write per-stage timings of every image and their summary to this directory")
+    parser.add_argument("--profile-level", type=int, choices=[0, 1, 2], default=0, help="1 adds memory counters, 2 also writes cProfile statistics")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every written file")
+    args = parser.parse_args()
+
+    preprocess = preprocess_from_arguments(args)
+    potrace_parameters = {
+        "turdsize": args.turdsize,
+        "alphamax": args.alphamax,
+        "opttolerance": args.opttolerance,
+        "turnpolicy": args.turnpolicy,
+        "opticurve": not args.no_opticurve,
+    }
+    export_options = {"decimals": args.decimals, "merge": args.merge}
+    posterize = None
+    if args.palette is not None:
+        posterize = {"method": "palette", "palette": [tuple(int(color.lstrip("#")[i : i + 2], 16) for i in (0, 2, 4)) for color in args.palette]}
+    elif args.layers is not None:
+        posterize = {"method": args.posterize, "levels": args.layers}
+
+    image_paths = collect_image_paths(args.inputs)
+    if not image_paths:
+        print("No images found", file=sys.stderr)
+        sys.exit(2)
+    failures = run_batch(
+        image_paths,
+        args.output_dir,
+        "." + args.format,
+        args.jobs,
+        args.backend,
+        args.cache_dir,
+        args.cache_size * 1024 * 1024,
+        preprocess,
+        args.tile_size,
+        export_options,
+        args.profile,
+        args.profile_level,
+        potrace_parameters,
+        posterize,
+        args.verbose,
+        args.simplify,
+    )
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
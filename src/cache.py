@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from typing import Dict, Optional, Union
+
+import numpy as np
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "pyqt-potrace")
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Bump when the stored arrays change meaning, so stale entries are never read back.
+CACHE_FORMAT_VERSION = 3
+
+
+class TraceCache:
+    def __init__(self, directory: str = DEFAULT_CACHE_DIRECTORY, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        """Content addressed on-disk store for trace results with LRU eviction.
+
+        Entries are uncompressed .npz files. Reading an entry refreshes its modification time, which is what
+        eviction orders by, so several processes can share one directory.
+
+        Args:
+            directory (str, optional): cache directory. Defaults to DEFAULT_CACHE_DIRECTORY.
+            max_bytes (int, optional): total size the directory is trimmed to after each write. Defaults to 512 MiB.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(image: Union[str, bytes], parameters: dict) -> str:
+        """Hash of the image file, or of the encoded image in a buffer such as bytes or a memory map, and of the trace parameters."""
+        digest = hashlib.sha256()
+        if not isinstance(image, (str, os.PathLike)):
+            digest.update(image)
+        else:
+            with open(image, mode="rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+        digest.update(json.dumps({"version": CACHE_FORMAT_VERSION, "parameters": parameters}, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        entry_path = self._entry_path(key)
+        try:
+            with np.load(entry_path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(entry_path)
+        except OSError:
+            self.misses += 1
+            return None
+        except (ValueError, EOFError, zipfile.BadZipFile):
+            # A truncated or corrupt entry is a miss, and is removed so that it is written again
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key: str, arrays: Dict[str, np.ndarray]):
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, mode="wb") as f:
+                np.savez(f, **arrays)
+            os.replace(temp_path, self._entry_path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".npz"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, entry_path in self._entries():
+            os.remove(entry_path)
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
@@ -0,0 +1,278 @@
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+# Element types of the flat curve arrays, equal to the QPainterPath.ElementType values
+MOVE_TO = 0
+LINE_TO = 1
+CURVE_TO = 2
+CURVE_TO_DATA = 3
+
+# Points sampled on every cubic segment when a contour is flattened into a polygon
+FLATTEN_SAMPLES = 8
+
+
+class CurveStore:
+    def __init__(self, codes: np.ndarray, points: np.ndarray, contour_offsets: np.ndarray, shape_offsets: np.ndarray = None):
+        """Closed contours held in flat arrays, grouped into filled shapes (an outer contour and its holes).
+
+        Every contour starts with a MOVE_TO and is implicitly closed. A cubic segment is a CURVE_TO (first
+        control point) followed by two CURVE_TO_DATA (second control point, end point). The arrays are used
+        as given, so a store can be a view into another one's arrays.
+
+        Args:
+            codes (np.ndarray): element types (uint8).
+            points (np.ndarray): N x 2 element coordinates (float64).
+            contour_offsets (np.ndarray): index of the first element of every contour.
+            shape_offsets (np.ndarray, optional): index of the first contour of every shape. Defaults to one shape per contour.
+        """
+        self.codes = codes
+        self.points = points
+        self.contour_offsets = np.asarray(contour_offsets, dtype=np.int64)
+        if shape_offsets is None:
+            shape_offsets = np.arange(len(self.contour_offsets))
+        self.shape_offsets = np.asarray(shape_offsets, dtype=np.int64)
+
+    @classmethod
+    def empty(cls) -> "CurveStore":
+        return cls(np.empty(0, np.uint8), np.empty((0, 2)), np.empty(0, np.int64))
+
+    @classmethod
+    def concatenate(cls, stores: Sequence["CurveStore"]) -> "CurveStore":
+        stores = [store for store in stores if store.contour_count]
+        if not stores:
+            return cls.empty()
+        element_starts = np.cumsum([0] + [len(store.codes) for store in stores])
+        contour_starts = np.cumsum([0] + [store.contour_count for store in stores])
+        return cls(
+            np.concatenate([store.codes for store in stores]),
+            np.concatenate([store.points for store in stores]),
+            np.concatenate([store.contour_offsets + start for store, start in zip(stores, element_starts)]),
+            np.concatenate([store.shape_offsets + start for store, start in zip(stores, contour_starts)]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.shape_offsets)
+
+    @property
+    def contour_count(self) -> int:
+        return len(self.contour_offsets)
+
+    @property
+    def contour_ends(self) -> np.ndarray:
+        return np.append(self.contour_offsets[1:], len(self.codes))
+
+    @property
+    def shape_ends(self) -> np.ndarray:
+        return np.append(self.shape_offsets[1:], self.contour_count)
+
+    def _contour_end(self, i: int) -> int:
+        return int(self.contour_offsets[i + 1]) if i + 1 < len(self.contour_offsets) else len(self.codes)
+
+    def _shape_end(self, i: int) -> int:
+        return int(self.shape_offsets[i + 1]) if i + 1 < len(self.shape_offsets) else len(self.contour_offsets)
+
+    def contour(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Views of the codes and points of contour i."""
+        start, end = self.contour_offsets[i], self._contour_end(i)
+        return self.codes[start:end], self.points[start:end]
+
+    def slice(self, start: int, stop: int) -> "CurveStore":
+        """Shapes start to stop as a store viewing the same element arrays."""
+        stop = min(stop, len(self))
+        if start >= stop:
+            return CurveStore.empty()
+        first_contour, end_contour = self.shape_offsets[start], self._shape_end(stop - 1)
+        first_element = self.contour_offsets[first_contour]
+        end_element = self._contour_end(end_contour - 1)
+        return CurveStore(
+            self.codes[first_element:end_element],
+            self.points[first_element:end_element],
+            self.contour_offsets[first_contour:end_contour] - first_element,
+            self.shape_offsets[start:stop] - first_contour,
+        )
+
+    def shape(self, i: int) -> "CurveStore":
+        return self.slice(i, i + 1)
+
+    def shapes(self) -> Iterator["CurveStore"]:
+        for i in range(len(self)):
+            yield self.shape(i)
+
+    def contour_bounds(self) -> np.ndarray:
+        """C x 4 boxes (x0, y0, x1, y1) of the control points of every contour."""
+        if self.contour_count == 0:
+            return np.empty((0, 4))
+        lower = np.minimum.reduceat(self.points, self.contour_offsets)
+        upper = np.maximum.reduceat(self.points, self.contour_offsets)
+        return np.hstack([lower, upper])
+
+    def shape_bounds(self) -> np.ndarray:
+        """S x 4 boxes (x0, y0, x1, y1) of the control points of every shape."""
+        if len(self) == 0:
+            return np.empty((0, 4))
+        bounds = self.contour_bounds()
+        return np.hstack([np.minimum.reduceat(bounds[:, :2], self.shape_offsets), np.maximum.reduceat(bounds[:, 2:], self.shape_offsets)])
+
+    def transformed(self, scale: Tuple[float, float] = (1.0, 1.0), offset: Tuple[float, float] = (0.0, 0.0)) -> "CurveStore":
+        """Store with every point mapped to point * scale + offset, sharing the codes and offsets."""
+        return CurveStore(self.codes, self.points * scale + offset, self.contour_offsets, self.shape_offsets)
+
+    def regrouped(self, groups: List[Tuple[int, List[int]]]) -> "CurveStore":
+        """Store whose shapes are the given (outer, holes) contour groups, e.g. from nesting.nest_contours()."""
+        order = np.array([contour for outer, holes in groups for contour in [outer, *holes]], dtype=np.int64)
+        if len(order) == 0:
+            return CurveStore.empty()
+        starts, ends = self.contour_offsets[order], self.contour_ends[order]
+        lengths = ends - starts
+        # Element indices of the reordered contours, one arange per contour without a Python loop
+        contour_offsets = np.cumsum(lengths) - lengths
+        elements = np.repeat(starts - contour_offsets, lengths) + np.arange(lengths.sum())
+        group_sizes = np.array([1 + len(holes) for _, holes in groups], dtype=np.int64)
+        return CurveStore(self.codes[elements], self.points[elements], contour_offsets, np.cumsum(group_sizes) - group_sizes)
+
+    def take(self, indices: Sequence[int]) -> "CurveStore":
+        """Store with the given shapes, in that order."""
+        indices = np.asarray(indices, np.int64)
+        if len(indices) == 0:
+            return CurveStore.empty()
+        first_contours = self.shape_offsets[indices]
+        contour_counts = self.shape_ends[indices] - first_contours
+        shape_offsets = np.cumsum(contour_counts) - contour_counts
+        contours = np.repeat(first_contours - shape_offsets, contour_counts) + np.arange(contour_counts.sum())
+        starts, ends = self.contour_offsets[contours], self.contour_ends[contours]
+        lengths = ends - starts
+        contour_offsets = np.cumsum(lengths) - lengths
+        elements = np.repeat(starts - contour_offsets, lengths) + np.arange(lengths.sum())
+        return CurveStore(self.codes[elements], self.points[elements], contour_offsets, shape_offsets)
+
+    def emptied(self, indices: Sequence[int]) -> "CurveStore":
+        """Store in which the given shapes have no contours left, so that the other shapes keep their indices."""
+        keep_shape = np.ones(len(self), bool)
+        keep_shape[np.asarray(indices, np.int64)] = False
+        contour_counts = self.shape_ends - self.shape_offsets
+        keep_contour = np.repeat(keep_shape, contour_counts)
+        element_counts = self.contour_ends - self.contour_offsets
+        keep_element = np.repeat(keep_contour, element_counts)
+        kept_elements = element_counts[keep_contour]
+        kept_contours = contour_counts * keep_shape
+        return CurveStore(
+            self.codes[keep_element], self.points[keep_element], np.cumsum(kept_elements) - kept_elements, np.cumsum(kept_contours) - kept_contours
+        )
+
+    def shape_elements(self, indices: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Indices of the elements of the given shapes, which must have contours, in that order, and their count per shape."""
+        indices = np.asarray(indices, np.int64)
+        starts = self.contour_offsets[self.shape_offsets[indices]]
+        ends = self.contour_ends[self.shape_ends[indices] - 1]
+        lengths = ends - starts
+        return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum()), lengths
+
+    def edited(self, deleted: Iterable[int] = (), moved: Dict[int, Tuple[float, float]] = None) -> "CurveStore":
+        """Store without the deleted shapes and with the moved ones translated by their (dx, dy)."""
+        points = self.points
+        if moved:
+            points = points.copy()
+            for i, offset in moved.items():
+                start, end = self.contour_offsets[self.shape_offsets[i]], self._contour_end(self._shape_end(i) - 1)
+                points[start:end] += offset
+        store = CurveStore(self.codes, points, self.contour_offsets, self.shape_offsets)
+        deleted = np.fromiter(deleted, np.int64)
+        if len(deleted):
+            store = store.take(np.setdiff1d(np.arange(len(self)), deleted))
+        return store
+
+    def contour_polygon(self, i: int, samples: int = FLATTEN_SAMPLES) -> np.ndarray:
+        """Contour i with every cubic segment replaced by `samples` points on the curve."""
+        codes, points = self.contour(i)
+        curve_starts = np.flatnonzero(codes == CURVE_TO)
+        if len(curve_starts) == 0:
+            return points
+        t = np.linspace(0.0, 1.0, samples + 1)[1:, None, None]
+        p0, p1, p2, p3 = points[curve_starts - 1], points[curve_starts], points[curve_starts + 1], points[curve_starts + 2]
+        curve_points = (1 - t) ** 3 * p0 + 3 * (1 - t) ** 2 * t * p1 + 3 * (1 - t) * t**2 * p2 + t**3 * p3
+        # Replace the three elements of each cubic by its samples, keeping the order of the segments
+        keep = codes != CURVE_TO_DATA
+        keep[curve_starts] = False
+        keys = np.concatenate([np.flatnonzero(keep) * 1.0, (curve_starts[:, None] + np.arange(samples) / samples).ravel()])
+        polygon = np.concatenate([points[keep], curve_points.transpose(1, 0, 2).reshape(-1, 2)])
+        return polygon[np.argsort(keys, kind="stable")]
+
+    @staticmethod
+    def polygon_contains(polygon: np.ndarray, x: float, y: float) -> bool:
+        """Even-odd test of (x, y) against a closed polygon."""
+        closed = np.concatenate([polygon, polygon[:1]])
+        x0, y0 = closed[:-1, 0], closed[:-1, 1]
+        x1, y1 = closed[1:, 0], closed[1:, 1]
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing_x = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        return bool(np.count_nonzero(crosses & (crossing_x > x)) % 2)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """Arrays that from_arrays() rebuilds the store from, e.g. for np.savez."""
+        return {"codes": self.codes, "points": self.points, "contour_offsets": self.contour_offsets, "shape_offsets": self.shape_offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "CurveStore":
+        return cls(arrays["codes"], arrays["points"].astype(np.float64), arrays["contour_offsets"], arrays["shape_offsets"])
+
+    def to_qt_path(self, i: int):
+        """QPainterPath of shape i. Qt is only imported by the conversions."""
+        from PyQt6.QtGui import QPainterPath
+
+        qt_path = QPainterPath()
+        first_contour, end_contour = self.shape_offsets[i], self._shape_end(i)
+        first_element, end_element = self.contour_offsets[first_contour], self._contour_end(end_contour - 1)
+        codes = self.codes[first_element:end_element].tolist()
+        points = self.points[first_element:end_element].tolist()
+        j = 0
+        while j < len(codes):
+            if codes[j] == CURVE_TO:
+                qt_path.cubicTo(*points[j], *points[j + 1], *points[j + 2])
+                j += 3
+            elif codes[j] == MOVE_TO:
+                if j > 0:
+                    qt_path.closeSubpath()
+                qt_path.moveTo(*points[j])
+                j += 1
+            else:
+                qt_path.lineTo(*points[j])
+                j += 1
+        if codes:
+            qt_path.closeSubpath()
+        return qt_path
+
+    def to_qt_paths(self) -> list:
+        return [self.to_qt_path(i) for i in range(len(self))]
+
+    @classmethod
+    def from_qt_paths(cls, path_list: list) -> "CurveStore":
+        """One shape per non-empty QPainterPath and one contour per subpath. Implicit closing elements are dropped."""
+        from PyQt6.QtGui import QPainterPath
+
+        codes = []
+        points = []
+        contour_offsets = []
+        shape_offsets = []
+        for path in path_list:
+            count = path.elementCount()
+            if count == 0:
+                continue
+            shape_offsets.append(len(contour_offsets))
+            start = None
+            for i in range(count):
+                element = path.elementAt(i)
+                point = (element.x, element.y)
+                if element.type == QPainterPath.ElementType.MoveToElement:
+                    start = point
+                    contour_offsets.append(len(codes))
+                elif element.type == QPainterPath.ElementType.LineToElement and point == start:
+                    # A final line back to the start is implied by closeSubpath()
+                    if i + 1 == count or path.elementAt(i + 1).type == QPainterPath.ElementType.MoveToElement:
+                        continue
+                codes.append(element.type.value)
+                points.append(point)
+        return cls(
+            np.array(codes, np.uint8), np.array(points, np.float64).reshape(-1, 2), np.array(contour_offsets, np.int64), np.array(shape_offsets, np.int64)
+        )
@@ -0,0 +1,194 @@
+from contextlib import nullcontext
+from typing import IO, List, Optional, Tuple, Union
+
+import numpy as np
+
+from curves import CURVE_TO, LINE_TO, MOVE_TO, CurveStore
+
+SVG_PREFIXES = np.array(["M", "L", "C", " "], dtype="<U16")
+# Shapes formatted per block, which bounds the text held in memory while a file is written
+EXPORT_BLOCK_SHAPES = 1000
+DEFAULT_DECIMALS = 2
+BLACK = (0, 0, 0)
+
+
+def _open_output(file: Union[str, IO], mode: str):
+    """Open file_path for writing, or use an already open file, e.g. an io.BytesIO, and leave it open."""
+    if hasattr(file, "write"):
+        return nullcontext(file)
+    return open(file, mode=mode, encoding="utf-8" if "b" not in mode else None)
+
+
+def quantized(curves: CurveStore, decimals: int) -> CurveStore:
+    """Store with every point rounded to decimals and the line segments that became zero length dropped."""
+    points = np.round(curves.points, decimals)
+    keep = np.ones(len(curves.codes), bool)
+    # A line is never the first element of a contour, so its start is always the previous point
+    keep[1:] = ~((curves.codes[1:] == LINE_TO) & np.all(points[1:] == points[:-1], axis=1))
+    if keep.all():
+        return CurveStore(curves.codes, points, curves.contour_offsets, curves.shape_offsets)
+    kept_before = np.cumsum(keep) - keep
+    return CurveStore(curves.codes[keep], points[keep], kept_before[curves.contour_offsets], curves.shape_offsets)
+
+
+def _coordinates(points: np.ndarray, decimals: int, trim: bool) -> np.ndarray:
+    coords = np.char.mod(f"%.{decimals}f", points)
+    if trim and decimals > 0:
+        coords = np.char.rstrip(np.char.rstrip(coords, "0"), ".")
+    return coords
+
+
+def _shape_last_elements(curves: CurveStore) -> np.ndarray:
+    return np.append(curves.contour_offsets[curves.shape_offsets[1:]], len(curves.codes)) - 1
+
+
+def _svg_path_data(curves: CurveStore, decimals: int = DEFAULT_DECIMALS, trim: bool = False, merge: bool = False) -> str:
+    """Path data of the shapes, starting with "M" and without the final "Z".
+
+    Shapes are separated by the end and start of a path element, or are all part of one path with merge.
+    """
+    prefixes = SVG_PREFIXES[curves.codes]
+    prefixes[curves.contour_offsets[1:]] = "ZM"
+    if not merge:
+        prefixes[curves.contour_offsets[curves.shape_offsets[1:]]] = 'Z"/>\n<path d="M'
+    coords = _coordinates(curves.points, decimals, trim)
+    return "".join(np.char.add(np.char.add(np.char.add(prefixes, coords[:, 0]), " "), coords[:, 1]).tolist())
+
+
+def write_svg(
+    curves: CurveStore, width: int, height: int, file_path: str, decimals: Optional[int] = None, merge: bool = False, fill: bool = True, stroke_width: float = 0
+):
+    """Write the shapes as black filled paths, formatting and writing EXPORT_BLOCK_SHAPES shapes at a time.
+
+    Args:
+        curves (CurveStore): shapes in image coordinates.
+        width (int): image width.
+        height (int): image height.
+        file_path (str): output file, or a text file object, which is left open. write_pdf() takes a binary one.
+        decimals (int, optional): round coordinates to this many decimals, drop the segments that become empty
+            and trailing zeros. Defaults to None, which writes two decimals.
+        merge (bool, optional): write every block of shapes as one path element. Defaults to False.
+        fill (bool, optional): fill the shapes. Defaults to True.
+        stroke_width (float, optional): outline width, 0 for no outline. Defaults to 0.
+    """
+    write_svg_layers([(BLACK, curves)], width, height, file_path, decimals, merge, fill, stroke_width)
+
+
+def write_svg_layers(
+    layers: List[Tuple[Tuple[int, int, int], CurveStore]],
+    width: int,
+    height: int,
+    file_path: str,
+    decimals: Optional[int] = None,
+    merge: bool = False,
+    fill: bool = True,
+    stroke_width: float = 0,
+):
+    """Write every layer as a group of paths filled with its RGB color, the first layer at the bottom.
+
+    The other arguments are the ones of write_svg().
+    """
+    trim = decimals is not None
+    if not trim:
+        decimals = DEFAULT_DECIMALS
+    stroke = f'stroke="#000000" stroke-width="{stroke_width}" stroke-linejoin="round"' if stroke_width else 'stroke="none"'
+    with _open_output(file_path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n')
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">\n')
+        for color, curves in layers:
+            if trim:
+                curves = quantized(curves, decimals)
+            f.write(f'<g fill="{"#{:02x}{:02x}{:02x}".format(*color) if fill else "none"}" fill-rule="evenodd" {stroke}>\n')
+            # Merged paths stop at the block size too, as SVG readers limit the length of path data
+            for start in range(0, len(curves), EXPORT_BLOCK_SHAPES):
+                data = _svg_path_data(curves.slice(start, start + EXPORT_BLOCK_SHAPES), decimals, trim, merge)
+                f.write(f'<path d="{data}Z"/>\n')
+            f.write("</g>\n")
+        f.write("</svg>\n")
+
+
+def _pdf_path_data(curves: CurveStore, decimals: int = DEFAULT_DECIMALS, trim: bool = False, paint: str = "f*", merge: bool = False) -> str:
+    """Path operators of the shapes, each shape painted with the paint operator, or all of them at once with merge."""
+    # Every element ends with a separator, and the last point of a segment with its operator
+    suffixes = np.full(len(curves.codes), " ", dtype="<U16")
+    suffixes[curves.codes == MOVE_TO] = " m\n"
+    suffixes[curves.codes == LINE_TO] = " l\n"
+    suffixes[np.flatnonzero(curves.codes == CURVE_TO) + 2] = " c\n"
+    contour_last = curves.contour_ends - 1
+    suffixes[contour_last] = np.char.add(suffixes[contour_last], "h\n")
+    shape_last = len(curves.codes) - 1 if merge else _shape_last_elements(curves)
+    suffixes[shape_last] = np.char.add(np.char.rstrip(suffixes[shape_last], "\n"), f" {paint}\n")
+    coords = _coordinates(curves.points, decimals, trim)
+    return "".join(np.char.add(np.char.add(np.char.add(coords[:, 0], " "), coords[:, 1]), suffixes).tolist())
+
+
+def write_pdf(
+    curves: CurveStore, width: int, height: int, file_path: str, decimals: Optional[int] = None, merge: bool = False, fill: bool = True, stroke_width: float = 0
+):
+    """Write a single page PDF without going through QPrinter, so it works without a QApplication.
+
+    The content stream is written block by block and its length is stored in an object after it.
+    The arguments are the ones of write_svg().
+    """
+    write_pdf_layers([(BLACK, curves)], width, height, file_path, decimals, merge, fill, stroke_width)
+
+
+def _pdf_fill_color(color: Tuple[int, int, int]) -> str:
+    if color[0] == color[1] == color[2]:
+        return f"{color[0] / 255:.4g} g"
+    return " ".join(f"{value / 255:.4g}" for value in color) + " rg"
+
+
+def write_pdf_layers(
+    layers: List[Tuple[Tuple[int, int, int], CurveStore]],
+    width: int,
+    height: int,
+    file_path: str,
+    decimals: Optional[int] = None,
+    merge: bool = False,
+    fill: bool = True,
+    stroke_width: float = 0,
+):
+    """Write every layer filled with its RGB color, the first layer at the bottom, like write_pdf()."""
+    trim = decimals is not None
+    if not trim:
+        decimals = DEFAULT_DECIMALS
+    paint = ("B*" if fill else "S") if stroke_width else ("f*" if fill else "n")
+    # Flip the y axis once so the path coordinates can be written in image space.
+    prelude = [f"1 0 0 -1 0 {height} cm"]
+    if stroke_width:
+        prelude.append(f"0 G {stroke_width} w 1 j")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] /Contents 4 0 R >>".encode("ascii"),
+    ]
+    with _open_output(file_path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(f"{number} 0 obj\n".encode("ascii") + body + b"\nendobj\n")
+        offsets.append(f.tell())
+        f.write(b"4 0 obj\n<< /Length 5 0 R >>\nstream\n")
+        stream_start = f.tell()
+        f.write(("\n".join(prelude) + "\n").encode("ascii"))
+        for color, curves in layers:
+            if trim:
+                curves = quantized(curves, decimals)
+            f.write(f"{_pdf_fill_color(color)}\n".encode("ascii"))
+            for start in range(0, len(curves), EXPORT_BLOCK_SHAPES):
+                f.write(_pdf_path_data(curves.slice(start, start + EXPORT_BLOCK_SHAPES), decimals, trim, paint, merge).encode("ascii"))
+        stream_length = f.tell() - stream_start
+        f.write(b"\nendstream\nendobj\n")
+        offsets.append(f.tell())
+        f.write(f"5 0 obj\n{stream_length}\nendobj\n".encode("ascii"))
+        xref_offset = f.tell()
+        f.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode("ascii"))
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode("ascii"))
+        f.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+
+
+WRITERS = {".svg": write_svg, ".pdf": write_pdf}
+LAYER_WRITERS = {".svg": write_svg_layers, ".pdf": write_pdf_layers}
@@ -0,0 +1,290 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+import profiling
+from curves import CURVE_TO, CURVE_TO_DATA, LINE_TO, MOVE_TO, CurveStore
+
+# Largest distance in pixels of a contour point from its fitted segment
+DEFAULT_FIT_ERROR = 1.0
+# Turning angle in degrees above which a contour point is a corner, where segments meet without a common tangent
+DEFAULT_CORNER_ANGLE = 60.0
+# Contour points on either side of a point that its turning angle and tangent are measured over
+CORNER_WINDOW = 3
+# Newton steps moving the curve parameters of the points onto the fitted curve before a segment is split
+REPARAMETERIZE_STEPS = 2
+MAX_FIT_ROUNDS = 64
+# Moves the contours of bitmap_contours() from the centers of the boundary pixels onto their outer edges
+PIXEL_EDGE_OUTSET = 0.5
+# Contour points above which the contours are fitted in a process pool
+PARALLEL_FIT_POINTS = 200_000
+
+
+def bitmap_contours(bitmap: np.ndarray, turdsize: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Boundary contours of the dark pixels as one N x 2 point array and the index of the first point of every contour.
+
+    The points are the centers of the boundary pixels, fit_contours() moves them onto the pixel edges with
+    PIXEL_EDGE_OUTSET. Contours of fewer than three points are dropped, as are
+    the ones enclosing up to turdsize pixels, dark ones for outer contours and light ones for holes.
+    """
+    contours, _ = cv2.findContours((bitmap == 0).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    if not contours:
+        return np.empty((0, 2)), np.empty(0, np.int64)
+    lengths = np.array([len(contour) for contour in contours], np.int64)
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+    offsets = np.cumsum(lengths) - lengths
+    following = np.arange(1, len(points) + 1)
+    following[offsets + lengths - 1] = offsets
+    area = np.add.reduceat(points[:, 0] * points[following, 1] - points[following, 0] * points[:, 1], offsets) / 2
+    # Pick's theorem: a lattice polygon of area A with B boundary points has A + B/2 + 1 points on or inside it
+    # and A - B/2 + 1 strictly inside. Outer contours run one way round and holes the other.
+    pixels = np.where(area < 0, np.abs(area) + lengths / 2 + 1, np.abs(area) - lengths / 2 + 1)
+    keep = (lengths >= 3) & (pixels > turdsize)
+    return points[np.repeat(keep, lengths)] + 0.5, np.cumsum(lengths[keep]) - lengths[keep]
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    lengths = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, lengths, out=np.zeros_like(vectors), where=lengths > 0)
+
+
+def _bezier(u: np.ndarray, p0: np.ndarray, c1: np.ndarray, c2: np.ndarray, p3: np.ndarray) -> np.ndarray:
+    v = (1 - u)[:, None]
+    u = u[:, None]
+    return v**3 * p0 + 3 * u * v**2 * c1 + 3 * u**2 * v * c2 + u**3 * p3
+
+
+def _fit_cubics(u, samples, piece_of, firsts, p0, p3, t1, t2):
+    """Least squares cubic of every piece through its end points, along the given end tangents.
+
+    This is the linear system of Schneider's fitting algorithm (Graphics Gems, 1990), solved for all pieces at once
+    with sums over the segments of the flat sample array.
+
+    Returns:
+        The control points of every piece, and the squared distance of every sample from its curve point.
+    """
+    v = 1 - u
+    b0, b1, b2, b3 = v**3, 3 * u * v**2, 3 * u**2 * v, u**3
+    a1 = t1[piece_of] * b1[:, None]
+    a2 = t2[piece_of] * b2[:, None]
+    rest = samples - p0[piece_of] * (b0 + b1)[:, None] - p3[piece_of] * (b2 + b3)[:, None]
+    c00, c01, c11, x0, x1 = (np.add.reduceat(np.einsum("ij,ij->i", a, b), firsts) for a, b in ((a1, a1), (a1, a2), (a2, a2), (a1, rest), (a2, rest)))
+    det = c00 * c11 - c01 * c01
+    chord = np.linalg.norm(p3 - p0, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha1 = (x0 * c11 - x1 * c01) / det
+        alpha2 = (c00 * x1 - c01 * x0) / det
+    # Degenerate or backwards fits fall back to control points a third of the chord along the tangents
+    fallback = ~(np.abs(det) > 1e-12) | ~(alpha1 > 1e-6 * chord) | ~(alpha2 > 1e-6 * chord)
+    alpha1 = np.where(fallback, chord / 3, alpha1)
+    alpha2 = np.where(fallback, chord / 3, alpha2)
+    c1 = p0 + alpha1[:, None] * t1
+    c2 = p3 + alpha2[:, None] * t2
+    curve = _bezier(u, p0[piece_of], c1[piece_of], c2[piece_of], p3[piece_of])
+    return c1, c2, np.einsum("ij,ij->i", curve - samples, curve - samples)
+
+
+def _reparameterized(u, samples, piece_of, p0, c1, c2, p3):
+    """One Newton step towards the parameter of the curve point closest to every sample."""
+    p0, c1, c2, p3 = p0[piece_of], c1[piece_of], c2[piece_of], p3[piece_of]
+    v = (1 - u)[:, None]
+    w = u[:, None]
+    difference = _bezier(u, p0, c1, c2, p3) - samples
+    first = 3 * (v**2 * (c1 - p0) + 2 * w * v * (c2 - c1) + w**2 * (p3 - c2))
+    second = 6 * (v * (c2 - 2 * c1 + p0) + w * (p3 - 2 * c2 + c1))
+    numerator = np.einsum("ij,ij->i", difference, first)
+    denominator = np.einsum("ij,ij->i", first, first) + np.einsum("ij,ij->i", difference, second)
+    step = np.divide(numerator, denominator, out=np.zeros_like(u), where=np.abs(denominator) > 1e-12)
+    return np.clip(u - step, 0, 1)
+
+
+def _first_max(values: np.ndarray, piece_of: np.ndarray, maxima: np.ndarray) -> np.ndarray:
+    """Index of the first largest value of every piece."""
+    candidates = np.flatnonzero(values >= maxima[piece_of])
+    _, first = np.unique(piece_of[candidates], return_index=True)
+    return candidates[first]
+
+
+def fit_contours(
+    points: np.ndarray, offsets: np.ndarray, error: float = DEFAULT_FIT_ERROR, corner_angle: float = DEFAULT_CORNER_ANGLE, outset: float = 0.0
+) -> CurveStore:
+    """Fit cubic Bezier segments to closed polygonal contours, e.g. pixel boundaries from bitmap_contours().
+
+    Points turning by more than corner_angle are corners. Every contour is cut at its corners, or in two where it
+    has fewer than two, and every piece is fitted with one cubic tangent to the contour at its smooth ends. Pieces
+    whose points are further than error from their cubic are split at the worst point, until every point is
+    close enough. Pieces within error of their chord become lines. All pieces of all contours are fitted at once
+    in flat arrays, every round of splitting being a handful of NumPy operations.
+
+    Args:
+        points (np.ndarray): N x 2 points of all contours.
+        offsets (np.ndarray): index of the first point of every contour.
+        error (float, optional): largest distance of a point from its segment. Defaults to DEFAULT_FIT_ERROR.
+        corner_angle (float, optional): turning angle of corners in degrees, 0 or less fits polygons.
+            Defaults to DEFAULT_CORNER_ANGLE.
+        outset (float, optional): distance the points are moved along the normal (-dy, dx) of the direction
+            (dx, dy) the contour runs in, e.g. 0.5 from the centers of boundary pixels onto their edges, which is
+            away from the dark pixels. Defaults to 0.
+
+    Returns:
+        CurveStore: one shape per contour.
+    """
+    count = len(offsets)
+    if count == 0:
+        return CurveStore.empty()
+    polygon = corner_angle <= 0
+    lengths = np.diff(np.append(offsets, len(points)))
+    contour_of = np.repeat(np.arange(count), lengths)
+    local = np.arange(len(points)) - offsets[contour_of]
+
+    def shifted(shift):
+        return offsets[contour_of] + (local + shift) % lengths[contour_of]
+
+    window = np.maximum(1, np.minimum(CORNER_WINDOW, (lengths - 1) // 2))[contour_of]
+    ahead, behind = shifted(window), shifted(-window)
+    cosine = np.einsum("ij,ij->i", _normalized(points[behind] - points), _normalized(points[ahead] - points))
+    turning = 180 - np.degrees(np.arccos(np.clip(cosine, -1, 1)))
+    corner = turning > corner_angle
+    for shift in range(1, CORNER_WINDOW + 1):
+        # Only the sharpest point of a bend is a corner
+        corner &= (turning >= turning[shifted(-shift)]) & (turning > turning[shifted(shift)])
+    # Smooth the pixel steps away, keeping the corners sharp
+    smoothed = np.where(corner[:, None], points, (points[shifted(-1)] + points + points[shifted(1)]) / 3)
+    central = _normalized(smoothed[ahead] - smoothed[behind])
+    if outset:
+        # Further out at corners, where the pixel edges meet diagonally away from the pixel center
+        stretch = 1 / np.maximum(np.cos(np.radians(turning) / 2), 0.5)
+        smoothed = smoothed + outset * stretch[:, None] * np.stack([-central[:, 1], central[:, 0]], axis=1)
+    forward = _normalized(smoothed[ahead] - smoothed)
+    backward = _normalized(smoothed[behind] - smoothed)
+
+    # Every contour starts at its first corner and is closed by repeating its first point at the end
+    corners_per_contour = np.bincount(contour_of[corner], minlength=count)
+    corner_contours, first_corner = np.unique(contour_of[corner], return_index=True)
+    rotation = np.zeros(count, np.int64)
+    rotation[corner_contours] = local[np.flatnonzero(corner)[first_corner]]
+    closed_offsets = offsets + np.arange(count)
+    closed_contour_of = np.repeat(np.arange(count), lengths + 1)
+    position = np.arange(len(points) + count) - closed_offsets[closed_contour_of]
+    closed_lengths = lengths[closed_contour_of]
+    source = offsets[closed_contour_of] + (rotation[closed_contour_of] + position) % closed_lengths
+    closed = smoothed[source]
+    closed_corner = corner[source]
+    breaks = closed_corner | (position == 0) | (position == closed_lengths)
+    breaks |= (corners_per_contour[closed_contour_of] < 2) & (position == closed_lengths // 2)
+    break_positions = np.flatnonzero(breaks)
+    same_contour = closed_contour_of[break_positions[:-1]] == closed_contour_of[break_positions[1:]]
+    starts, ends = break_positions[:-1][same_contour], break_positions[1:][same_contour]
+    tangents1 = np.where(closed_corner[starts, None], forward[source[starts]], central[source[starts]])
+    tangents2 = np.where(closed_corner[ends, None], backward[source[ends]], -central[source[ends]])
+
+    fitted = []
+    for fit_round in range(MAX_FIT_ROUNDS + 1):
+        sizes = ends - starts + 1
+        firsts = np.cumsum(sizes) - sizes
+        piece_of = np.repeat(np.arange(len(starts)), sizes)
+        samples = closed[np.arange(len(piece_of)) - firsts[piece_of] + starts[piece_of]]
+        p0, p3 = closed[starts], closed[ends]
+        chord = p3 - p0
+        chord_lengths = np.linalg.norm(chord, axis=1)
+        offset = samples - p0[piece_of]
+        cross = np.abs(offset[:, 0] * chord[piece_of, 1] - offset[:, 1] * chord[piece_of, 0])
+        distance = np.where(chord_lengths[piece_of] > 0, cross / np.maximum(chord_lengths, 1e-12)[piece_of], np.linalg.norm(offset, axis=1))
+        line_error = np.maximum.reduceat(distance, firsts)
+        lines = (line_error <= error) | (sizes <= 2)
+        c1 = c2 = np.zeros_like(p0)
+        if polygon:
+            worst, done = distance, lines
+        else:
+            # Chord length parameters, then Newton steps keeping the best fit of every piece
+            steps = np.linalg.norm(np.diff(samples, axis=0, prepend=samples[:1]), axis=1)
+            steps[firsts] = 0
+            u = np.cumsum(steps)
+            u -= u[firsts][piece_of]
+            u = np.divide(u, u[firsts + sizes - 1][piece_of], out=np.zeros_like(u), where=u[firsts + sizes - 1][piece_of] > 0)
+            c1, c2, worst = _fit_cubics(u, samples, piece_of, firsts, p0, p3, tangents1, tangents2)
+            curve_error = np.maximum.reduceat(worst, firsts)
+            for _ in range(REPARAMETERIZE_STEPS):
+                u = _reparameterized(u, samples, piece_of, p0, c1, c2, p3)
+                u[firsts] = 0
+                u[firsts + sizes - 1] = 1
+                new_c1, new_c2, new_worst = _fit_cubics(u, samples, piece_of, firsts, p0, p3, tangents1, tangents2)
+                new_error = np.maximum.reduceat(new_worst, firsts)
+                better = new_error < curve_error
+                c1, c2, curve_error = np.where(better[:, None], new_c1, c1), np.where(better[:, None], new_c2, c2), np.minimum(new_error, curve_error)
+                worst = np.where(better[piece_of], new_worst, worst)
+            done = lines | (curve_error <= error * error)
+        if fit_round == MAX_FIT_ROUNDS:
+            done = np.ones(len(starts), bool)
+        fitted.append((starts[done], ends[done], lines[done], c1[done], c2[done]))
+        if done.all():
+            break
+        # Split the other pieces at their worst point, smooth there
+        split = _first_max(worst, piece_of, np.maximum.reduceat(worst, firsts))
+        split = np.clip(split - firsts + starts, starts + 1, ends - 1)[~done]
+        tangent = central[source[split]]
+        starts, ends = np.concatenate([starts[~done], split]), np.concatenate([split, ends[~done]])
+        tangents1 = np.concatenate([tangents1[~done], tangent])
+        tangents2 = np.concatenate([-tangent, tangents2[~done]])
+
+    starts, ends, lines, c1, c2 = (np.concatenate(arrays) for arrays in zip(*fitted))
+    # Every contour is a MOVE_TO followed by its segments in order, a line being one element and a cubic three
+    order = np.argsort(np.concatenate([closed_offsets * 2, starts * 2 + 1]), kind="stable")
+    is_move = np.concatenate([np.ones(count, bool), np.zeros(len(starts), bool)])[order]
+    is_line = np.concatenate([np.zeros(count, bool), lines])[order]
+    table_codes = np.empty((len(order), 3), np.uint8)
+    table_codes[:] = (CURVE_TO, CURVE_TO_DATA, CURVE_TO_DATA)
+    table_codes[is_line, 0] = LINE_TO
+    table_codes[is_move, 0] = MOVE_TO
+    table_points = np.empty((len(order), 3, 2))
+    end_points = np.concatenate([closed[closed_offsets], closed[ends]])[order]
+    table_points[:, 0] = np.where((is_move | is_line)[:, None], end_points, np.concatenate([np.zeros((count, 2)), c1])[order])
+    table_points[:, 1] = np.concatenate([np.zeros((count, 2)), c2])[order]
+    table_points[:, 2] = end_points
+    elements = np.where(is_move | is_line, 1, 3)
+    mask = np.arange(3) < elements[:, None]
+    contour_offsets = (np.cumsum(elements) - elements)[is_move]
+    return CurveStore(table_codes[mask], table_points[mask], contour_offsets)
+
+
+def fit_bitmap(
+    bitmap: np.ndarray,
+    error: float = DEFAULT_FIT_ERROR,
+    corner_angle: float = DEFAULT_CORNER_ANGLE,
+    turdsize: int = 2,
+    workers: int = None,
+    cancel_event: threading.Event = None,
+) -> CurveStore:
+    """Trace the dark pixels of bitmap by fitting curves to their boundary contours, without potrace.
+
+    Bitmaps with more than PARALLEL_FIT_POINTS contour points are fitted in a process pool, in chunks of whole
+    contours with about the same number of points. The other arguments are the ones of bitmap_contours() and
+    fit_contours().
+
+    Returns:
+        CurveStore: one shape per contour, empty when cancel_event was set.
+    """
+    with profiling.stage("contours"):
+        points, offsets = bitmap_contours(bitmap, turdsize)
+    workers = workers if workers is not None else os.cpu_count() or 1
+    with profiling.stage("fit"):
+        if len(points) < PARALLEL_FIT_POINTS or workers == 1 or len(offsets) < 2:
+            return fit_contours(points, offsets, error, corner_angle, PIXEL_EDGE_OUTSET)
+        cuts = np.unique(np.concatenate([[0], np.searchsorted(offsets, np.linspace(0, len(points), workers + 1)[1:-1]), [len(offsets)]]))
+        bounds = np.append(offsets, len(points))
+        with ProcessPoolExecutor(max_workers=len(cuts) - 1) as executor:
+            futures = [
+                executor.submit(fit_contours, points[bounds[start] : bounds[stop]], offsets[start:stop] - bounds[start], error, corner_angle, PIXEL_EDGE_OUTSET)
+                for start, stop in zip(cuts[:-1], cuts[1:])
+            ]
+            chunks = []
+            for future in futures:
+                if cancel_event is not None and cancel_event.is_set():
+                    executor.shutdown(cancel_futures=True)
+                    return CurveStore.empty()
+                chunks.append(future.result())
+        return CurveStore.concatenate(chunks)
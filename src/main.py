@@ -1,58 +1,176 @@
-import subprocess
-import tempfile
-from typing import List
+import copy
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Sequence, Tuple
 
 import cv2
-from PyQt6.QtGui import QPainterPath, QPixmap
-from svgpathtools import svg2paths
-from svgpathtools.path import CubicBezier, Line
+import numpy as np
 
-# from beziers.path import BezierPath
-# from beziers.point import Point
-# from beziers.segment import Segment
-# from beziers.utils.curvefitter import CurveFit
-# from beziers.path.representations.Segment import SegmentRepresentation
+from backends import POTRACE_BACKENDS, TraceCancelled, normalized_potrace_parameters
+from cache import TraceCache
+from curves import CurveStore
+import profiling
+from nesting import nest_curves
+from preprocess import Grayscale, Posterize, PreprocessPipeline, Threshold
+from regions import dirty_region, shapes_within
+from simplify import combined_stats, simplify_curves
+from tiling import DEFAULT_TILE_OVERLAP, decode_image, open_tile_source, trace_tiled
 
 
 class BezierTracing:
-    def __init__(self, image_path):
+    def __init__(
+        self,
+        image_path,
+        backend: str = "subprocess",
+        cache: TraceCache = None,
+        preprocess: PreprocessPipeline = None,
+        tile_size: int = None,
+        tile_overlap: int = DEFAULT_TILE_OVERLAP,
+        tile_workers: int = None,
+        potrace_parameters: dict = None,
+        image_data: bytes = None,
+        simplify: float = None,
+    ):
+        """Trace an image into QPainterPaths with potrace.
+
+        Args:
+            image_path (str): image file to trace, or only a name for messages when image_data is given.
+            backend (str, optional): potrace backend, one of POTRACE_BACKENDS. Defaults to "subprocess".
+            cache (TraceCache, optional): persistent store for the traced paths. Defaults to None.
+            preprocess (PreprocessPipeline, optional): turns the image into the traced bitmap. Defaults to PreprocessPipeline.default().
+            tile_size (int, optional): trace in tiles of this size to bound memory on very large images. Defaults to None, untiled.
+            tile_overlap (int, optional): margin traced around every tile. Defaults to DEFAULT_TILE_OVERLAP.
+            tile_workers (int, optional): tiles traced at once. Defaults to the CPU count.
+            potrace_parameters (dict, optional): turdsize, turnpolicy, alphamax, opticurve and opttolerance, see
+                backends.normalized_potrace_parameters(). Defaults to potrace's defaults.
+            image_data (bytes, optional): encoded image, e.g. a PNG received over the network, traced instead of
+                reading image_path. Defaults to None.
+            simplify (float, optional): reduce the nodes of the trace with simplify.simplify_curves(), moving it by
+                at most this many pixels. Defaults to None, the trace as it is.
+        """
+        if backend not in POTRACE_BACKENDS:
+            raise ValueError(f"Unknown potrace backend: {backend}")
         self.image_path = image_path
+        self.image_data = image_data
+        self.backend = backend
+        self.cache = cache
+        self.preprocess = preprocess if preprocess is not None else PreprocessPipeline.default()
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_workers = tile_workers
+        self.potrace_parameters = normalized_potrace_parameters(potrace_parameters)
+        self.simplify = simplify
+        # Stats of simplify_curves() for the last trace, when it was simplified
+        self.simplify_stats: dict = None
+        # Called with the name of every pipeline stage as it starts, e.g. to report progress
+        self.stage_callback: Callable[[str], None] = None
+        self.cancel_event = threading.Event()
+        self._image_size = None
+        self._image_buffer = None
         self._opencv_original_image = None
         self._opencv_image = None
         self._opencv_contours = None
+        self._curves = None
         self._potrace_path = None
-        self._simoncozens_beziers = None
-        self._simoncozens_path = None
+        self._qt_image = None
         self._qt_pixmap = None
 
+    @property
+    def image_buffer(self):
+        """The encoded image: image_data, or else the image file memory mapped.
+
+        The cache key and the decoder read the file through the map instead of copying it into Python first. It
+        is released after each of them.
+        """
+        if self.image_data is not None:
+            return self.image_data
+        if self._image_buffer is None:
+            with open(self.image_path, mode="rb") as f:
+                try:
+                    self._image_buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    raise ValueError(f"Failed to read image: {self.image_path} is empty")
+        return self._image_buffer
+
     @property
     def opencv_original_image(self):
+        """The image decoded once, to 8-bit gray or BGR, and shared by the preprocessing, the layers and Qt."""
         if self._opencv_original_image is None:
-            self._opencv_original_image = cv2.imread(self.image_path)
+            self._enter_stage("imread")
+            self._opencv_original_image = decode_image(self.image_buffer)
+            # A PGM image is a view of the map, which then stays open as long as the image is alive
+            self._image_buffer = None
+            if self._opencv_original_image is None:
+                raise ValueError(f"Failed to read image: {self.image_path}")
         return self._opencv_original_image
 
     @property
     def opencv_image(self):
         if self._opencv_image is None:
-            self._opencv_image = self._preprocess_opencv_image()
+            image = self.opencv_original_image
+            self._enter_stage("preprocess")
+            self._opencv_image = self._preprocess_opencv_image(image)
         return self._opencv_image
 
-    def _preprocess_opencv_image(self):
-        gray_img = cv2.cvtColor(self.opencv_original_image, cv2.COLOR_BGR2GRAY)
-        _, threshold_img = cv2.threshold(gray_img, 120, 255, cv2.THRESH_BINARY_INV)
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (1, 1))
-        dilated_img = cv2.dilate(threshold_img, kernel)
-        final_img = cv2.bitwise_not(dilated_img)
-        return final_img
+    def _preprocess_opencv_image(self, image):
+        return self.preprocess.run(image)
+
+    def invalidate_preprocess(self):
+        """Drop every result derived from the bitmap after self.preprocess was changed.
+
+        The decoded image and the pipeline stages before the changed one are kept.
+        """
+        self._opencv_image = None
+        self._opencv_contours = None
+        self._curves = None
+        self._potrace_path = None
+
+    def update_potrace(self, **parameters):
+        """Change potrace parameters. The traced result is dropped if they differ, the bitmap is kept."""
+        parameters = normalized_potrace_parameters({**self.potrace_parameters, **parameters})
+        if parameters != self.potrace_parameters:
+            self.potrace_parameters = parameters
+            self._curves = None
+            self._potrace_path = None
+
+    @property
+    def image_size(self):
+        """(width, height) of the image. Known without decoding the image after a cache hit."""
+        if self._image_size is None:
+            height, width = self.opencv_original_image.shape[:2]
+            self._image_size = (width, height)
+        return self._image_size
+
+    @property
+    def trace_parameters(self) -> dict:
+        """Everything besides the image content that changes the trace result."""
+        parameters = {"backend": self.backend, "preprocess": self.preprocess.parameters(), "potrace": self.potrace_parameters}
+        if self.tile_size is not None:
+            parameters["tiling"] = {"tile_size": self.tile_size, "overlap": self.tile_overlap}
+        if self.simplify is not None:
+            parameters["simplify"] = self.simplify
+        return parameters
+
+    @property
+    def qt_image(self):
+        """QImage of self.opencv_original_image sharing its pixels, valid for as long as this object is alive."""
+        if self._qt_image is None:
+            # Qt is only imported by the GUI, headless traces never load it
+            from PyQt6.QtGui import QImage
+
+            image = self.opencv_original_image
+            height, width = image.shape[:2]
+            image_format = QImage.Format.Format_Grayscale8 if image.ndim == 2 else QImage.Format.Format_BGR888
+            self._qt_image = QImage(image.data, width, height, image.strides[0], image_format)
+        return self._qt_image
 
     @property
     def qt_pixmap(self):
         if self._qt_pixmap is None:
-            # cv_rgb = cv2.cvtColor(self.opencv_original_image, cv2.COLOR_BGR2RGB)
-            # h, w = cv_rgb.shape[:2]
-            # qt_img = QImage(cv_rgb.flatten(), w, h, QImage.Format.Format_RGB888)
-            # self._qt_pixmap = QPixmap.fromImage(qt_img)
-            self._qt_pixmap = QPixmap(self.image_path)
+            from PyQt6.QtGui import QPixmap
+
+            self._qt_pixmap = QPixmap.fromImage(self.qt_image)
         return self._qt_pixmap
 
     @property
@@ -61,112 +179,203 @@ class BezierTracing:
             self._opencv_contours, _ = cv2.findContours(self.opencv_image, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
         return self._opencv_contours
 
+    @property
+    def curves(self) -> CurveStore:
+        """The traced filled shapes, one outer contour and its holes each."""
+        if self._curves is None:
+            if self.cache is None:
+                self._curves = self.run_potrace()
+            else:
+                self._curves = self._run_potrace_cached()
+        return self._curves
+
     @property
     def potrace_path(self):
+        """self.curves as one QPainterPath per filled shape, converted on first use."""
         if self._potrace_path is None:
-            self._potrace_path = self.run_potrace()
+            self._potrace_path = self.curves.to_qt_paths()
         return self._potrace_path
 
-    def run_potrace(self):
-        retval, buf = cv2.imencode(".bmp", self.opencv_image)
-        if retval == False:
-            raise ValueError("Failed to convert into BMP binary data")
-        binbmp = buf.tobytes()
-        args = ["potrace", "-", "-o-", "-b", "svg"]
-        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-        stdout, stderr = p.communicate(input=binbmp)
-        if len(stderr) != 0:
-            raise RuntimeError("Potrace threw error:\n" + stderr.decode("utf-8"))
-        svg = stdout.decode("utf-8")
-        qt_path_list = self.svg2qt_path_list(svg)
-        qt_path_list = self._get_filled_path_list(qt_path_list)
-        return qt_path_list
-
-    def svg2qt_path_list(self, svg: str) -> List[QPainterPath]:
-        svg_path = tempfile.NamedTemporaryFile().name
-        with open(svg_path, mode="w", encoding="utf-8") as f:
-            f.write(svg)
-        pathes, _, svg_attributes = svg2paths(svg_path, return_svg_attributes=True)
-        height = float(svg_attributes["height"][:-2])
-        qt_path_list = []
-        end_point = None
-        for path in pathes:
-            qt_path = QPainterPath()
-            for segment in path:
-                qt_points = [(bpoint.real, bpoint.imag) for bpoint in segment.bpoints()]
-                start_point = qt_points[0]
-                if start_point != end_point:
-                    if not qt_path.isEmpty():
-                        qt_path.closeSubpath()
-                        qt_path_list.append(qt_path)
-                        qt_path = QPainterPath()
-                    qt_path.moveTo(qt_points[0][0] / 10, -qt_points[0][1] / 10 + height)
-                # else:
-                if isinstance(segment, Line):
-                    qt_path.lineTo(qt_points[1][0] / 10, -qt_points[1][1] / 10 + height)
-                elif isinstance(segment, CubicBezier):
-                    qt_path.cubicTo(
-                        qt_points[1][0] / 10,
-                        -qt_points[1][1] / 10 + height,
-                        qt_points[2][0] / 10,
-                        -qt_points[2][1] / 10 + height,
-                        qt_points[3][0] / 10,
-                        -qt_points[3][1] / 10 + height,
-                    )
-                else:
-                    exit()
-                end_point = qt_points[-1]
-            else:
-                qt_path.closeSubpath()
-                qt_path_list.append(qt_path)
-        return qt_path_list
-
-    def _get_filled_path_list(self, path_list: List[QPainterPath]):
-        filled_path_list = []
-        sorted_path_list = sorted(path_list, key=lambda x: x.boundingRect().x())
-        while sorted_path_list:
-            outer_path = sorted_path_list.pop(0)
-            hole_path_list = []
-            inner_path_list = [path for path in sorted_path_list if outer_path.contains(path)]
-            while inner_path_list:
-                hole_path = inner_path_list.pop(0)
-                for inner_path in inner_path_list[:]:
-                    if hole_path.contains(inner_path):
-                        inner_path_list.remove(inner_path)
-                hole_path_list.append(hole_path)
-                sorted_path_list.remove(hole_path)
-            filled_path = QPainterPath(outer_path)
-            for hole_path in hole_path_list:
-                filled_path.addPath(hole_path)
-            filled_path_list.append(filled_path)
-        return filled_path_list
-
-    # @property
-    # def simoncozens_path(self):
-    #     if self._simoncozens_path is None:
-    #         self._simoncozens_path = self.run_simoncozens_bezier()
-    #     return self._simoncozens_path
-
-    # def simoncozens_beziers2qt_path(self,simoncozens_beziers:List[BezierPath]):
-    #     svgs = []
-    #     for bezier in simoncozens_beziers:
-    #         try:
-    #             svg = bezier.asSVGPath()
-    #             svgs.append(svg)
-    #         except:
-    #             pass
-    #     path_svg = " ".join([f'<path  d="{svg}"/>' for svg in svgs])
-    #     svg = f"<svg >{path_svg}</svg>"
-    #     qt_path = self.svg2qt_path_list(svg)
-    #     return qt_path
-
-    # def run_simoncozens_bezier(self):
-    #     self._simoncozens_beziers = []
-    #     for contour in self.opencv_contours:
-    #         points = [Point(val[0][0], val[0][1]) for val in contour.tolist()]
-    #         segs = CurveFit.fitCurve(points, error=1, cornerTolerance=20, maxSegments=1000)
-    #         bezier = BezierPath()
-    #         bezier.closed = True
-    #         bezier.activeRepresentation = SegmentRepresentation(bezier, segs)
-    #         self._simoncozens_beziers.append(bezier)
-    #     return self.simoncozens_beziers2qt_path(self._simoncozens_beziers)
+    def _run_potrace_cached(self):
+        profiling.enter_stage("cache")
+        key = self.cache.key(self.image_buffer, self.trace_parameters)
+        # Mapping the file again for the decoder is cheap, holding it open while the image may change is not
+        self._image_buffer = None
+        arrays = self.cache.get(key)
+        if arrays is not None:
+            self._image_size = tuple(arrays["image_size"].tolist())
+            if self.simplify is not None:
+                self.simplify_stats = {key[len("simplify_") :]: value.item() for key, value in arrays.items() if key.startswith("simplify_")}
+            return CurveStore.from_arrays(arrays)
+        curves = self.run_potrace()
+        arrays = curves.to_arrays()
+        arrays["image_size"] = np.array(self.image_size)
+        if self.simplify_stats is not None:
+            arrays.update({f"simplify_{key}": np.array(value) for key, value in self.simplify_stats.items()})
+        profiling.enter_stage("cache")
+        self.cache.put(key, arrays)
+        return curves
+
+    def run_potrace(self) -> CurveStore:
+        if self.tile_size is not None:
+            return self._run_potrace_tiled()
+        bitmap = self.opencv_image
+        self._enter_stage("potrace")
+        curves = self.trace_bitmap(bitmap, self.cancel_event)
+        if self.preprocess.scale != 1.0:
+            # Map curves traced on a resized bitmap back onto the image
+            height, width = self.opencv_original_image.shape[:2]
+            curves = curves.transformed((width / bitmap.shape[1], height / bitmap.shape[0]))
+        curves = self._simplified(curves)
+        self._enter_stage("nesting")
+        curves = nest_curves(curves)
+        self.check_cancelled()
+        return curves
+
+    def _run_potrace_tiled(self):
+        # The whole image is never decoded in color, nor preprocessed or traced in one piece
+        self._enter_stage("imread")
+        source = open_tile_source(self.image_data if self.image_data is not None else self.image_path)
+        height, width = source.shape[:2]
+        self._image_size = (width, height)
+        self._enter_stage("potrace")
+        curves = trace_tiled(
+            source,
+            self.trace_bitmap,
+            self.preprocess,
+            nest_curves,
+            self.tile_size,
+            self.tile_overlap,
+            self.tile_workers,
+            self.cancel_event,
+        )
+        self.check_cancelled()
+        # After the seams are joined, which match pieces of the shapes as traced
+        return self._simplified(curves)
+
+    def _simplified(self, curves: CurveStore) -> CurveStore:
+        if self.simplify is None:
+            return curves
+        self._enter_stage("simplify")
+        curves, self.simplify_stats = simplify_curves(curves, self.simplify)
+        return curves
+
+    def retrace_region(self, rect: Tuple[int, int, int, int]) -> Tuple[np.ndarray, CurveStore]:
+        """Trace again the shapes around a changed area of the bitmap and splice them into self.curves.
+
+        The bitmap is brought up to date with self.preprocess, but only the region covering rect and the shapes
+        touching it is traced. Shapes cut by the region border are kept as they were. The result is not written
+        to the cache, as it may mix traces of different parameters.
+
+        Args:
+            rect (Tuple[int, int, int, int]): (x, y, width, height) of the dirty area in image pixels.
+
+        Returns:
+            Tuple[np.ndarray, CurveStore]: indices in the former self.curves of the shapes that were removed, and the
+                new shapes, which self.curves now ends with.
+        """
+        curves = self.curves
+        width, height = self.image_size
+        x, y, w, h = rect
+        x0, y0, x1, y1 = dirty_region(curves, (x, y, x + w, y + h), width, height)
+        self._enter_stage("preprocess")
+        if self.tile_size is not None:
+            # Preprocess the region with the context a tile would have, like the rest of the trace
+            source = open_tile_source(self.image_data if self.image_data is not None else self.image_path)
+            px0, py0 = max(0, x0 - self.tile_overlap), max(0, y0 - self.tile_overlap)
+            px1, py1 = min(width, x1 + self.tile_overlap), min(height, y1 + self.tile_overlap)
+            bitmap = self.preprocess.copy().run(np.ascontiguousarray(source[py0:py1, px0:px1]))
+        else:
+            # Only the stages changed since the last run are computed again
+            self._opencv_image = self.preprocess.run(self.opencv_original_image)
+            px0, py0, px1, py1 = 0, 0, width, height
+            bitmap = self._opencv_image
+        scale_x, scale_y = bitmap.shape[1] / (px1 - px0), bitmap.shape[0] / (py1 - py0)
+        bx0, by0 = int((x0 - px0) * scale_x), int((y0 - py0) * scale_y)
+        bx1, by1 = int(np.ceil((x1 - px0) * scale_x)), int(np.ceil((y1 - py0) * scale_y))
+        self._enter_stage("potrace")
+        traced = self.trace_bitmap(np.ascontiguousarray(bitmap[by0:by1, bx0:bx1]), self.cancel_event)
+        traced = traced.transformed((1 / scale_x, 1 / scale_y), (px0 + bx0 / scale_x, py0 + by0 / scale_y))
+        traced = self._simplified(traced)
+        self._enter_stage("nesting")
+        traced = nest_curves(traced)
+        self.check_cancelled()
+
+        # Shapes touching a border inside the image were cut by the region and are left alone
+        inner = (x0 + 1 if x0 > 0 else -np.inf, y0 + 1 if y0 > 0 else -np.inf, x1 - 1 if x1 < width else np.inf, y1 - 1 if y1 < height else np.inf)
+        removed = shapes_within(curves, inner)
+        added = traced.take(shapes_within(traced, inner))
+        kept = np.setdiff1d(np.arange(len(curves)), removed)
+        self._curves = CurveStore.concatenate([curves.take(kept), added])
+        self._potrace_path = None
+        return removed, added
+
+    def remove_shapes(self, indices: Sequence[int]):
+        """Drop shapes from self.curves for good, e.g. deletions that can no longer be undone."""
+        if len(indices):
+            self._curves = self.curves.take(np.setdiff1d(np.arange(len(self.curves)), indices))
+            self._potrace_path = None
+
+    def trace_layers(self, posterize: Posterize, workers: int = None) -> List[Tuple[Tuple[int, int, int], CurveStore]]:
+        """Trace the image posterized into layers of one color each, all layers at once.
+
+        The image is decoded once and the stages of self.preprocess other than the grayscale conversion and the
+        threshold are shared by every layer. Layer k covers every pixel whose color ranks k or darker, so drawing
+        the layers from the first to the last leaves no gaps between the colors. The lightest color is the
+        background and is not traced. Layered traces are neither cached nor tiled.
+
+        Args:
+            posterize (Posterize): stage that picks the colors.
+            workers (int, optional): layers traced at once. Defaults to the CPU count.
+
+        Returns:
+            List[Tuple[Tuple[int, int, int], CurveStore]]: RGB color and filled shapes of every layer, bottom to top.
+        """
+        if self.tile_size is not None:
+            raise ValueError("Layered traces cannot be tiled")
+        image = self.opencv_original_image
+        height, width = image.shape[:2]
+        self._enter_stage("preprocess")
+        stages = [copy.copy(stage) for stage in self.preprocess.stages if not isinstance(stage, (Grayscale, Threshold))]
+        labels = PreprocessPipeline(stages + [posterize]).run(image)
+        self._enter_stage("potrace")
+
+        def trace_layer(level: int) -> Tuple[CurveStore, dict]:
+            bitmap = np.where(labels >= level, np.uint8(0), np.uint8(255))
+            curves = self.trace_bitmap(bitmap, self.cancel_event)
+            if bitmap.shape != (height, width):
+                curves = curves.transformed((width / bitmap.shape[1], height / bitmap.shape[0]))
+            stats = None
+            if self.simplify is not None:
+                with profiling.stage("simplify"):
+                    curves, stats = simplify_curves(curves, self.simplify)
+            with profiling.stage("nesting"):
+                return nest_curves(curves), stats
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            layers = list(executor.map(trace_layer, range(1, len(posterize.colors))))
+        self.check_cancelled()
+        if self.simplify is not None:
+            self.simplify_stats = combined_stats(stats for _, stats in layers)
+        return [(tuple(color), curves) for color, (curves, _) in zip(posterize.colors[1:].tolist(), layers)]
+
+    def trace_bitmap(self, bitmap: np.ndarray, cancel_event: threading.Event = None, parameters: dict = None) -> CurveStore:
+        """Trace a preprocessed bitmap with the backend of this object, one shape per contour.
+
+        parameters replace self.potrace_parameters, e.g. to try other settings on the same bitmap.
+        """
+        return POTRACE_BACKENDS[self.backend](bitmap, cancel_event, parameters if parameters is not None else self.potrace_parameters)
+
+    def cancel(self):
+        """Ask a trace running in another thread to stop. It raises TraceCancelled at the next stage."""
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise TraceCancelled()
+
+    def _enter_stage(self, stage: str):
+        self.check_cancelled()
+        profiling.enter_stage(stage)
+        if self.stage_callback is not None:
+            self.stage_callback(stage)
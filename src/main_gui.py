@@ -1,29 +1,41 @@
 import os
 import sys
-from typing import List, Set
+import threading
+from contextlib import nullcontext
+from typing import Callable, List, Optional, Set, Tuple
 
-from PyQt6.QtCore import QPointF, QStandardPaths, Qt, pyqtSignal
-from PyQt6.QtGui import QBrush, QColor, QFileSystemModel, QImage, QPainter, QPainterPath, QPen, QUndoCommand, QUndoStack
-from PyQt6.QtPrintSupport import QPrinter
-from PyQt6.QtSvg import QSvgGenerator
+import numpy as np
+from PyQt6.QtCore import QObject, QRectF, QRunnable, QStandardPaths, Qt, QThreadPool, QTimer, pyqtSignal
+from PyQt6.QtGui import QBrush, QColor, QFileSystemModel, QImage, QPainter, QPen, QPixmap
 from PyQt6.QtWidgets import (
     QApplication,
+    QComboBox,
     QCompleter,
+    QDoubleSpinBox,
     QFileDialog,
     QGraphicsItem,
-    QGraphicsPathItem,
     QGraphicsPixmapItem,
     QGraphicsScene,
     QGraphicsView,
     QHBoxLayout,
     QLineEdit,
+    QProgressBar,
     QPushButton,
     QSlider,
+    QSpinBox,
     QVBoxLayout,
     QWidget,
 )
 
+import profiling
+from backends import DEFAULT_POTRACE_PARAMETERS, POTRACE_BACKENDS, TURN_POLICIES, TraceCancelled, normalized_potrace_parameters
+from cache import TraceCache
+from curves import CurveStore
+from export import LAYER_WRITERS, WRITERS
 from main import BezierTracing
+from preprocess import THRESHOLD_METHODS, Despeckle, Posterize, Resize, Threshold
+from scene_items import BatchedCurvesItem, PathStyle, PromotedShapesItem
+from undo import EditHistory, ShapesDeleteCommand, ShapesMoveCommand
 
 
 class DragDropLineEdit(QLineEdit):
@@ -38,14 +50,24 @@ class DragDropLineEdit(QLineEdit):
         self.filters = filter
         self.setDragEnabled(True)
         self.setPlaceholderText("Enter a file path OR Drag & Drop a file")
-        completer = QCompleter()
-        self.fs_model = QFileSystemModel(completer)
-        self.fs_model.setRootPath("")
-        if self.filters is not None:
-            self.fs_model.setNameFilters({f"*{filter}" for filter in self.filters})
-            self.fs_model.setNameFilterDisables(False)
-        completer.setModel(self.fs_model)
-        self.setCompleter(completer)
+        # The model starts watching the file system, so it is only created once a path is typed or set
+        self.fs_model = None
+        self.setCompleter(QCompleter(self))
+
+    def file_system_model(self) -> QFileSystemModel:
+        if self.fs_model is None:
+            self.fs_model = QFileSystemModel(self.completer())
+            if self.filters is not None:
+                self.fs_model.setNameFilters({f"*{filter}" for filter in self.filters})
+                self.fs_model.setNameFilterDisables(False)
+            self.completer().setModel(self.fs_model)
+        return self.fs_model
+
+    def keyPressEvent(self, event):
+        if self.fs_model is None:
+            # Rooted at the typed directory rather than at "", which would list every drive
+            self.set_completer(self.text() or os.path.join(os.path.expanduser("~"), ""))
+        super().keyPressEvent(event)
 
     def dragEnterEvent(self, event):
         data = event.mimeData()
@@ -76,7 +98,7 @@ class DragDropLineEdit(QLineEdit):
             self.set_completer(file_path)
 
     def set_completer(self, file_path):
-        self.fs_model.setRootPath(os.path.dirname(file_path))
+        self.file_system_model().setRootPath(os.path.dirname(file_path))
 
 
 class DragDropFileButton(QPushButton):
@@ -188,64 +210,51 @@ class CustomGraphicsView(QGraphicsView):
         super().keyReleaseEvent(e)
 
 
-class ItemsMoveCommand(QUndoCommand):
-    def __init__(self, item_list: List[QGraphicsItem], pos_list: List[QPointF], new_pos_list: List[QPointF]):
-        super().__init__()
-        self.item_list = item_list
-        self.pos_list = pos_list
-        self.new_pos_list = new_pos_list
-
-    def undo(self):
-        for item, pos in zip(self.item_list, self.pos_list):
-            item.setPos(pos)
-
-    def redo(self):
-        for item, pos in zip(self.item_list, self.new_pos_list):
-            item.setPos(pos)
-
-
-class ItemsDeleteCommand(QUndoCommand):
-    def __init__(self, items: List[QGraphicsItem]):
-        super().__init__()
-        self.items = items
-
-    def undo(self):
-        for item in self.items:
-            item.setVisible(True)
-
-    def redo(self):
-        for item in self.items:
-            item.setVisible(False)
-
-
 class CustomGraphicsScene(QGraphicsScene):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.selectionChanged.connect(self.selection_changed)
-        self.undo_stack = QUndoStack()
+        self.undo_stack = EditHistory(parent=self)
         self.origin_item_dict = {}
-        self.selected_items = {}
-
-    def _set_item_move_command(self):
-        item_list = []
-        pos_list = []
-        new_pos_list = []
-        for item, pos in self.selected_items.items():
-            if pos != item.pos():
-                item_list.append(item)
-                pos_list.append(pos)
-                new_pos_list.append(item.pos())
-        if item_list:
-            command = ItemsMoveCommand(item_list, pos_list, new_pos_list)
-            self.undo_stack.push(command)
-        new_items = self.selectedItems()
-        if new_items:
-            self.selected_items.clear()
-            for item in new_items:
-                self.selected_items[item] = item.pos()
+        # Traced shapes, whose selected ones are promoted to movable items
+        self.batch = None
+        # Items of the color layers of a layered trace, bottom to top, which are not editable
+        self.layers = []
+
+    def _push_move(self):
+        """Record the drag of the selected shapes as one command, with one offset if they moved together."""
+        indices, offsets = self.batch.dragged(item for item in self.selectedItems() if isinstance(item, PromotedShapesItem))
+        if len(indices):
+            self.undo_stack.push(ShapesMoveCommand(self.batch, indices, offsets[0] if (offsets == offsets[0]).all() else offsets))
 
     def selection_changed(self):
-        self._set_item_move_command()
+        if self.batch is not None:
+            # Shapes that are no longer selected go back to being drawn by their tile
+            self.batch.demote([path_item for path_item in self.batch.promoted_items if not path_item.isSelected()])
+
+    def promote_shapes(self, indices: List[int], select: bool = False):
+        path_items = self.batch.promote(indices)
+        if select and path_items:
+            # One selection update for all of them instead of one per item
+            self.blockSignals(True)
+            for path_item in path_items:
+                path_item.setSelected(True)
+            self.blockSignals(False)
+            self.selection_changed()
+
+    def mousePressEvent(self, e):
+        if self.batch is not None and e.button() == Qt.MouseButton.LeftButton:
+            item = self.itemAt(e.scenePos(), self.views()[0].transform())
+            if item is None or not item.flags() & QGraphicsItem.GraphicsItemFlag.ItemIsSelectable:
+                i = self.batch.shape_at(self.batch.mapFromScene(e.scenePos()))
+                if i is not None:
+                    self.promote_shapes([i])
+        super().mousePressEvent(e)
+
+    def mouseReleaseEvent(self, e):
+        super().mouseReleaseEvent(e)
+        if self.batch is not None and e.button() == Qt.MouseButton.LeftButton:
+            self._push_move()
 
     def keyPressEvent(self, e):
         if (Qt.KeyboardModifier.ControlModifier | Qt.KeyboardModifier.ShiftModifier) == e.modifiers() and e.key() == Qt.Key.Key_Z:
@@ -255,36 +264,245 @@ class CustomGraphicsScene(QGraphicsScene):
             self.clearSelection()
             self.undo_stack.undo()
         elif e.key() in {Qt.Key.Key_Backspace, Qt.Key.Key_Delete}:
-            items = self.selectedItems()
+            path_items = [item for item in self.selectedItems() if isinstance(item, PromotedShapesItem)]
+            indices = np.concatenate([path_item.shape_indices for path_item in path_items]) if path_items else []
             self.clearSelection()
-            if items:
-                command = ItemsDeleteCommand(items)
-                self.undo_stack.push(command)
+            if len(indices):
+                self.undo_stack.push(ShapesDeleteCommand(self.batch, indices))
         super().keyPressEvent(e)
 
 
+class TraceSignals(QObject):
+    progress = pyqtSignal(int, int, str)
+    image_loaded = pyqtSignal(int, QImage)
+    # CurveStore with a chunk of shapes
+    paths_ready = pyqtSignal(int, object)
+    # Indices of the shapes replaced by a region re-trace, and the CurveStore replacing them
+    region_ready = pyqtSignal(int, object, object)
+    # (RGB color, CurveStore) of every color layer
+    layers_ready = pyqtSignal(int, object)
+    finished = pyqtSignal(int)
+    failed = pyqtSignal(int, str)
+
+
+class TraceJob(QRunnable):
+    # Progress reported when each BezierTracing stage starts
+    STAGE_PROGRESS = {"imread": 5, "preprocess": 15, "potrace": 25, "nesting": 70}
+
+    def __init__(
+        self,
+        job_id: int,
+        bezier_tracing: BezierTracing,
+        preprocess_settings: dict = None,
+        potrace_parameters: dict = None,
+        load_image: bool = True,
+        chunk_size: int = 500,
+        profiler: Optional[profiling.TraceProfiler] = None,
+    ):
+        """Trace an image on a pool thread and hand the paths to the GUI thread in chunks.
+
+        Every signal carries job_id so that results of a job that was replaced can be ignored.
+        Jobs sharing a BezierTracing must run one at a time, as they reuse its cached stages.
+
+        Args:
+            job_id (int): id sent with every signal.
+            bezier_tracing (BezierTracing): object to trace.
+            preprocess_settings (dict, optional): {stage name: parameters} applied to its pipeline before tracing. Defaults to None.
+            potrace_parameters (dict, optional): applied with BezierTracing.update_potrace() before tracing. Defaults to None.
+            load_image (bool, optional): emit image_loaded with the image. Defaults to True.
+            chunk_size (int, optional): number of paths per paths_ready signal. Defaults to 500.
+            profiler (TraceProfiler, optional): run while the job traces, stopped before finished is emitted. Defaults to None.
+        """
+        super().__init__()
+        self.job_id = job_id
+        self.bezier_tracing = bezier_tracing
+        self.preprocess_settings = preprocess_settings or {}
+        self.potrace_parameters = potrace_parameters or {}
+        self.load_image = load_image
+        self.chunk_size = chunk_size
+        self.profiler = profiler
+        self.cancel_event = threading.Event()
+        self.signals = TraceSignals()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        if self.cancel_event.is_set():
+            return
+        self.bezier_tracing.cancel_event = self.cancel_event
+        self.bezier_tracing.stage_callback = lambda stage: self.signals.progress.emit(self.job_id, self.STAGE_PROGRESS.get(stage, 0), stage)
+        if self.profiler is not None:
+            self.profiler.start()
+        try:
+            # Unchanged settings keep the bitmap and the traced curves
+            changed = [self.bezier_tracing.preprocess.update(name, **parameters) for name, parameters in self.preprocess_settings.items()]
+            if any(changed):
+                self.bezier_tracing.invalidate_preprocess()
+            self.bezier_tracing.update_potrace(**self.potrace_parameters)
+            if self.load_image:
+                # QImage, unlike QPixmap, may be created outside the GUI thread. It shares the decoded pixels
+                self.signals.image_loaded.emit(self.job_id, self.bezier_tracing.qt_image)
+            curves = self.bezier_tracing.curves
+            for start in range(0, len(curves), self.chunk_size):
+                self.bezier_tracing.check_cancelled()
+                self.signals.progress.emit(self.job_id, 80 + 20 * start // len(curves), "scene")
+                chunk = curves.slice(start, start + self.chunk_size)
+                self.signals.paths_ready.emit(self.job_id, chunk)
+        except TraceCancelled:
+            return
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, f"Failed to trace {self.bezier_tracing.image_path}: {e}")
+            return
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+        self.signals.finished.emit(self.job_id)
+
+
+class ExportSignals(QObject):
+    finished = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+
+class ExportJob(QRunnable):
+    def __init__(self, writer: Callable, curves: CurveStore, width: int, height: int, file_path: str, **options):
+        """Write curves with a writer of export.WRITERS on a pool thread.
+
+        Args:
+            writer (Callable): export function.
+            curves (CurveStore): shapes to write, with the user's edits applied, or the (color, shapes) layers of a
+                export.LAYER_WRITERS writer.
+            width (int): image width.
+            height (int): image height.
+            file_path (str): output file.
+            options: keyword arguments of the writer.
+        """
+        super().__init__()
+        self.writer = writer
+        self.curves = curves
+        self.width = width
+        self.height = height
+        self.file_path = file_path
+        self.options = options
+        self.signals = ExportSignals()
+
+    def run(self):
+        try:
+            self.writer(self.curves, self.width, self.height, self.file_path, **self.options)
+            self.signals.finished.emit(self.file_path)
+        except Exception as e:
+            self.signals.failed.emit(f"Failed to write {self.file_path}: {e}")
+
+
+class RegionTraceJob(TraceJob):
+    def __init__(
+        self,
+        job_id: int,
+        bezier_tracing: BezierTracing,
+        rect: Tuple[int, int, int, int],
+        preprocess_settings: dict = None,
+        potrace_parameters: dict = None,
+        profiler: Optional[profiling.TraceProfiler] = None,
+    ):
+        """Re-trace the area around rect with BezierTracing.retrace_region() and emit region_ready."""
+        super().__init__(job_id, bezier_tracing, preprocess_settings, potrace_parameters, load_image=False, profiler=profiler)
+        self.rect = rect
+
+    def run(self):
+        if self.cancel_event.is_set():
+            return
+        self.bezier_tracing.cancel_event = self.cancel_event
+        self.bezier_tracing.stage_callback = lambda stage: self.signals.progress.emit(self.job_id, self.STAGE_PROGRESS.get(stage, 0), stage)
+        if self.profiler is not None:
+            self.profiler.start()
+        try:
+            # The pipeline recomputes the changed stages, the traced shapes outside the region are kept.
+            # update_potrace() would drop them too, so the parameters are set directly.
+            for name, parameters in self.preprocess_settings.items():
+                self.bezier_tracing.preprocess.update(name, **parameters)
+            self.bezier_tracing.potrace_parameters = normalized_potrace_parameters({**self.bezier_tracing.potrace_parameters, **self.potrace_parameters})
+            removed, added = self.bezier_tracing.retrace_region(self.rect)
+            self.signals.region_ready.emit(self.job_id, removed, added)
+        except TraceCancelled:
+            return
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, f"Failed to trace a region of {self.bezier_tracing.image_path}: {e}")
+            return
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+        self.signals.finished.emit(self.job_id)
+
+
+class LayerTraceJob(TraceJob):
+    def __init__(
+        self,
+        job_id: int,
+        bezier_tracing: BezierTracing,
+        levels: int,
+        preprocess_settings: dict = None,
+        potrace_parameters: dict = None,
+        load_image: bool = True,
+        profiler: Optional[profiling.TraceProfiler] = None,
+    ):
+        """Trace levels color layers with BezierTracing.trace_layers() and emit layers_ready."""
+        super().__init__(job_id, bezier_tracing, preprocess_settings, potrace_parameters, load_image, profiler=profiler)
+        self.levels = levels
+
+    def run(self):
+        if self.cancel_event.is_set():
+            return
+        self.bezier_tracing.cancel_event = self.cancel_event
+        self.bezier_tracing.stage_callback = lambda stage: self.signals.progress.emit(self.job_id, self.STAGE_PROGRESS.get(stage, 0), stage)
+        if self.profiler is not None:
+            self.profiler.start()
+        try:
+            for name, parameters in self.preprocess_settings.items():
+                self.bezier_tracing.preprocess.update(name, **parameters)
+            self.bezier_tracing.update_potrace(**self.potrace_parameters)
+            if self.load_image:
+                self.signals.image_loaded.emit(self.job_id, self.bezier_tracing.qt_image)
+            layers = self.bezier_tracing.trace_layers(Posterize(self.levels))
+            self.signals.layers_ready.emit(self.job_id, layers)
+        except TraceCancelled:
+            return
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, f"Failed to trace the layers of {self.bezier_tracing.image_path}: {e}")
+            return
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+        self.signals.finished.emit(self.job_id)
+
+
 class MainWindow(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
 
-        self.items = []
-
         self.pen = QPen()
         self.pen.setColor(QColor(Qt.GlobalColor.black))
         self.pen.setJoinStyle(Qt.PenJoinStyle.RoundJoin)
         self.brush = QBrush()
+        self.style = PathStyle(self.pen, self.brush, self)
+        self.style.changed.connect(self.style_changed)
 
         filter = {".png", ".jpg"}
         self.file_select_widget = FileSelectWidget(filter)
         self.view = CustomGraphicsView()
         self.view.setDragMode(QGraphicsView.DragMode.RubberBandDrag)
         self.view.setScene(QGraphicsScene())
+        self.view.rubberBandChanged.connect(self.rubber_band_changed)
+        self.rubber_band_rect = QRectF()
         h_box = QHBoxLayout()
         self.slider = QSlider(Qt.Orientation.Horizontal)
         self.slider.setMinimum(1)
         self.slider.setMaximum(100)
         self.slider.setValue(1)
         self.slider.valueChanged.connect(self.slider_changed)
+        # Antialiased strokes take several times longer to draw, so they are only drawn once the slider is let go
+        self.slider.sliderPressed.connect(lambda: self.view.setRenderHint(QPainter.RenderHint.Antialiasing, False))
+        self.slider.sliderReleased.connect(self.slider_released)
 
         self.image_button = QPushButton("Image")
         self.image_button.setCheckable(True)
@@ -302,6 +520,84 @@ class MainWindow(QWidget):
         self.path_structure_button.setCheckable(True)
         self.path_structure_button.clicked.connect(self.trace_image)
 
+        self.threshold_method_combo = QComboBox()
+        self.threshold_method_combo.addItems(THRESHOLD_METHODS)
+        self.threshold_method_combo.currentTextChanged.connect(self.preprocess_changed)
+
+        self.threshold_slider = QSlider(Qt.Orientation.Horizontal)
+        self.threshold_slider.setRange(0, 255)
+        self.threshold_slider.setValue(Threshold().value)
+        self.threshold_slider.valueChanged.connect(self.preprocess_changed)
+
+        # Median filter aperture applied before the threshold, 1 turns it off
+        self.despeckle_spin_box = QSpinBox()
+        self.despeckle_spin_box.setRange(1, 15)
+        self.despeckle_spin_box.setSingleStep(2)
+        self.despeckle_spin_box.setValue(Despeckle().ksize)
+        self.despeckle_spin_box.setToolTip("despeckle")
+        self.despeckle_spin_box.valueChanged.connect(self.preprocess_changed)
+
+        # Bitmap size relative to the image, the traced curves are scaled back to the image
+        self.resize_spin_box = QDoubleSpinBox()
+        self.resize_spin_box.setRange(0.25, 4.0)
+        self.resize_spin_box.setSingleStep(0.25)
+        self.resize_spin_box.setValue(Resize().scale)
+        self.resize_spin_box.setToolTip("resize")
+        self.resize_spin_box.valueChanged.connect(self.preprocess_changed)
+
+        # Speckles of up to this many pixels are dropped
+        self.turdsize_spin_box = QSpinBox()
+        self.turdsize_spin_box.setRange(0, 1000)
+        self.turdsize_spin_box.setValue(DEFAULT_POTRACE_PARAMETERS["turdsize"])
+        self.turdsize_spin_box.setToolTip("turdsize")
+        self.turdsize_spin_box.valueChanged.connect(self.potrace_changed)
+
+        # Corner threshold, 0 traces polygons and values above 4 / 3 no corners
+        self.alphamax_spin_box = QDoubleSpinBox()
+        self.alphamax_spin_box.setRange(0.0, 1.34)
+        self.alphamax_spin_box.setSingleStep(0.1)
+        self.alphamax_spin_box.setValue(DEFAULT_POTRACE_PARAMETERS["alphamax"])
+        self.alphamax_spin_box.setToolTip("alphamax")
+        self.alphamax_spin_box.valueChanged.connect(self.potrace_changed)
+
+        # Error allowed when joining curve segments, 0 turns the optimization off
+        self.opttolerance_spin_box = QDoubleSpinBox()
+        self.opttolerance_spin_box.setRange(0.0, 5.0)
+        self.opttolerance_spin_box.setSingleStep(0.1)
+        self.opttolerance_spin_box.setValue(DEFAULT_POTRACE_PARAMETERS["opttolerance"])
+        self.opttolerance_spin_box.setToolTip("opttolerance")
+        self.opttolerance_spin_box.valueChanged.connect(self.potrace_changed)
+
+        self.turnpolicy_combo = QComboBox()
+        self.turnpolicy_combo.addItems(TURN_POLICIES)
+        self.turnpolicy_combo.setCurrentText(DEFAULT_POTRACE_PARAMETERS["turnpolicy"])
+        self.turnpolicy_combo.setToolTip("turnpolicy")
+        self.turnpolicy_combo.currentTextChanged.connect(self.potrace_changed)
+
+        # Potrace, or the NumPy curve fitter which needs no potrace executable
+        self.backend_combo = QComboBox()
+        self.backend_combo.addItems(sorted(POTRACE_BACKENDS))
+        self.backend_combo.setCurrentText("subprocess")
+        self.backend_combo.setToolTip("backend")
+        self.backend_combo.currentTextChanged.connect(self.backend_changed)
+
+        # Number of colors, the background included, traced as stacked layers instead of a threshold from 3 on
+        self.layers_spin_box = QSpinBox()
+        self.layers_spin_box.setRange(2, 16)
+        self.layers_spin_box.setValue(2)
+        self.layers_spin_box.setToolTip("colors")
+        self.layers_spin_box.valueChanged.connect(self.potrace_changed)
+
+        # Retrace once the threshold controls settle instead of on every slider tick
+        self.retrace_timer = QTimer(self)
+        self.retrace_timer.setSingleShot(True)
+        self.retrace_timer.setInterval(200)
+        self.retrace_timer.timeout.connect(self.retrace)
+
+        # While checked, dragging a rectangle re-traces that area with the current threshold instead of selecting
+        self.region_button = QPushButton("Region")
+        self.region_button.setCheckable(True)
+
         self.save_button = QPushButton("Save")
         self.save_button.clicked.connect(self.save)
         h_box.addStretch()
@@ -310,20 +606,43 @@ class MainWindow(QWidget):
         h_box.addWidget(self.fill_button)
         h_box.addWidget(self.path_structure_button)
         h_box.addWidget(self.slider)
+        h_box.addWidget(self.threshold_method_combo)
+        h_box.addWidget(self.threshold_slider)
+        h_box.addWidget(self.despeckle_spin_box)
+        h_box.addWidget(self.resize_spin_box)
+        h_box.addWidget(self.turdsize_spin_box)
+        h_box.addWidget(self.alphamax_spin_box)
+        h_box.addWidget(self.opttolerance_spin_box)
+        h_box.addWidget(self.turnpolicy_combo)
+        h_box.addWidget(self.backend_combo)
+        h_box.addWidget(self.layers_spin_box)
+        h_box.addWidget(self.region_button)
         h_box.addWidget(self.save_button)
         h_box.setContentsMargins(5, 0, 5, 0)
 
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setVisible(False)
+
         v_box = QVBoxLayout()
         v_box.addWidget(self.file_select_widget)
         v_box.addLayout(h_box)
+        v_box.addWidget(self.progress_bar)
         v_box.addWidget(self.view)
         v_box.setContentsMargins(5, 5, 5, 5)
         self.setLayout(v_box)
         self.resize(700, 500)
 
         self.image_path = None
+        self.trace_cache = TraceCache()
+        # Jobs on the same BezierTracing reuse its cached stages, so they must not overlap
+        self.trace_pool = QThreadPool(self)
+        self.trace_pool.setMaxThreadCount(1)
+        self.trace_job_id = 0
+        self.trace_cancel_event = None
+        self.trace_profiler = None
+        self.point_radius = 1.0
         self.bezier_tracing_obj = None
-        self.path = None
 
     def trace_image(self):
         file = self.file_select_widget.get_path()
@@ -331,55 +650,245 @@ class MainWindow(QWidget):
             if self.bezier_tracing_obj and self.bezier_tracing_obj.image_path == file:
                 pass
             else:
-                self.bezier_tracing_obj = BezierTracing(file)
-                scene = CustomGraphicsScene()
-                self.view.setScene(scene)
-                # Image
-                self.image_item = QGraphicsPixmapItem(self.bezier_tracing_obj.qt_pixmap)
-                scene.addItem(self.image_item)
-
-                # Trace Path
-                self.path = self.bezier_tracing_obj.potrace_path
-                self.items = []
-                if self.path is not None:
-                    for segment in self.path:
-                        path_item = QGraphicsPathItem()
-                        path_item.setPath(segment)
-                        path_item.setFlags(QGraphicsItem.GraphicsItemFlag.ItemIsSelectable | QGraphicsItem.GraphicsItemFlag.ItemIsMovable)
-                        path_item.setPen(self.pen)
-                        self.items.append(path_item)
-                        scene.addItem(path_item)
-
-                    self.slider.setMaximum(int(self.view.scene().sceneRect().width() / 10))
-
-                    self.view.fitInView(self.view.scene().sceneRect(), Qt.AspectRatioMode.KeepAspectRatio)
-
-                    for item in self.items:
-                        decorate_path_item(item, min(self.view.scene().sceneRect().width(), self.view.scene().sceneRect().height()) / 300)
-
-            self.image_item.setVisible(self.image_button.isChecked())
-            for item in self.items:
-                item.setVisible(self.trace_path_button.isChecked())
-
-            for item in self.items:
-                for child_item in item.childItems():
-                    child_item.setVisible(self.path_structure_button.isChecked())
-
-            if self.fill_button.isChecked():
-                self.brush = QBrush(QColor(Qt.GlobalColor.black))
-            else:
-                self.brush = QBrush()
-            for item in self.items:
-                item.setBrush(self.brush)
+                self.start_trace(file)
+            self.update_items()
         else:
+            self.cancel_trace()
             self.bezier_tracing_obj = None
             scene = CustomGraphicsScene()
             self.view.setScene(scene)
 
+    def start_trace(self, file):
+        self.cancel_trace()
+        self.bezier_tracing_obj = BezierTracing(file, self.backend_combo.currentText(), cache=self.trace_cache)
+        scene = CustomGraphicsScene()
+        scene.undo_stack.expired.connect(self.drop_expired_shapes)
+        self.view.setScene(scene)
+        self.image_item = QGraphicsPixmapItem()
+        scene.addItem(self.image_item)
+        self.run_trace_job(load_image=True)
+
+    def retrace(self):
+        if self.bezier_tracing_obj is None:
+            return
+        self.cancel_trace()
+        scene = self.view.scene()
+        scene.clearSelection()
+        scene.undo_stack.clear()
+        if scene.batch is not None:
+            scene.removeItem(scene.batch)
+            scene.batch = None
+        for layer in scene.layers:
+            scene.removeItem(layer)
+        scene.layers = []
+        self.run_trace_job(load_image=False)
+
+    def preprocess_changed(self):
+        self.threshold_slider.setEnabled(self.threshold_method_combo.currentText() == "fixed")
+        if self.bezier_tracing_obj is not None and not self.region_button.isChecked():
+            self.retrace_timer.start()
+
+    def preprocess_settings(self) -> dict:
+        return {
+            "resize": {"scale": self.resize_spin_box.value()},
+            "despeckle": {"ksize": self.despeckle_spin_box.value()},
+            "threshold": {"method": self.threshold_method_combo.currentText(), "value": self.threshold_slider.value()},
+        }
+
+    def potrace_changed(self):
+        if self.bezier_tracing_obj is not None and not self.region_button.isChecked():
+            self.retrace_timer.start()
+
+    def backend_changed(self):
+        # Start over on a new BezierTracing, as a job that is being cancelled may still use the current one
+        if self.bezier_tracing_obj is not None:
+            self.start_trace(self.bezier_tracing_obj.image_path)
+
+    def potrace_parameters(self) -> dict:
+        opttolerance = self.opttolerance_spin_box.value()
+        return {
+            "turdsize": self.turdsize_spin_box.value(),
+            "alphamax": self.alphamax_spin_box.value(),
+            "opticurve": opttolerance > 0,
+            "opttolerance": opttolerance,
+            "turnpolicy": self.turnpolicy_combo.currentText(),
+        }
+
+    def run_trace_job(self, load_image: bool):
+        self.trace_job_id += 1
+        self.trace_profiler = self.create_trace_profiler()
+        levels = self.layers_spin_box.value()
+        if levels > 2:
+            job = LayerTraceJob(
+                self.trace_job_id, self.bezier_tracing_obj, levels, self.preprocess_settings(), self.potrace_parameters(), load_image, self.trace_profiler
+            )
+        else:
+            job = TraceJob(
+                self.trace_job_id, self.bezier_tracing_obj, self.preprocess_settings(), self.potrace_parameters(), load_image, profiler=self.trace_profiler
+            )
+        job.signals.progress.connect(self.trace_progress)
+        job.signals.image_loaded.connect(self.trace_image_loaded)
+        job.signals.paths_ready.connect(self.trace_paths_ready)
+        job.signals.layers_ready.connect(self.trace_layers_ready)
+        job.signals.finished.connect(self.trace_finished)
+        job.signals.failed.connect(self.trace_failed)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.trace_cancel_event = job.cancel_event
+        self.trace_pool.start(job)
+
+    def create_trace_profiler(self) -> Optional[profiling.TraceProfiler]:
+        """Profiler of the next trace job when the profiling environment variable names a directory."""
+        if not os.environ.get(profiling.PROFILE_DIR_ENV):
+            return None
+        level = int(os.environ.get(profiling.PROFILE_LEVEL_ENV, "0"))
+        return profiling.TraceProfiler(f"{self.bezier_tracing_obj.image_path} #{self.trace_job_id}", memory=level >= 1, profile=level >= 2)
+
+    def cancel_trace(self):
+        if self.trace_cancel_event is not None:
+            self.trace_cancel_event.set()
+        # Signals of the stale job that are already queued are dropped by their job id
+        self.trace_job_id += 1
+        self.progress_bar.setVisible(False)
+
+    def trace_progress(self, job_id, value, stage):
+        if job_id == self.trace_job_id:
+            self.progress_bar.setValue(value)
+            self.progress_bar.setFormat(f"{stage} %p%")
+
+    def trace_image_loaded(self, job_id, image):
+        if job_id != self.trace_job_id:
+            return
+        self.image_item.setPixmap(QPixmap.fromImage(image))
+        scene_rect = self.view.scene().itemsBoundingRect()
+        self.slider.setMaximum(max(1, int(scene_rect.width() / 10)))
+        self.view.fitInView(scene_rect, Qt.AspectRatioMode.KeepAspectRatio)
+        self.point_radius = min(scene_rect.width(), scene_rect.height()) / 300
+
+    def trace_paths_ready(self, job_id, curves):
+        if job_id != self.trace_job_id:
+            return
+        scene = self.view.scene()
+        if scene.batch is None:
+            scene.batch = BatchedCurvesItem(self.style, self.point_radius)
+            scene.batch.setVisible(self.trace_path_button.isChecked())
+            scene.batch.set_points_visible(self.path_structure_button.isChecked())
+            scene.addItem(scene.batch)
+        with self.trace_profiler.substage("scene") if self.trace_profiler is not None else nullcontext():
+            scene.batch.add_curves(curves)
+
+    def trace_layers_ready(self, job_id, layers):
+        if job_id != self.trace_job_id:
+            return
+        scene = self.view.scene()
+        with self.trace_profiler.substage("scene") if self.trace_profiler is not None else nullcontext():
+            for z, (color, curves) in enumerate(layers):
+                layer = BatchedCurvesItem(self.style, self.point_radius, color=QColor(*color))
+                layer.setZValue(z)
+                layer.setVisible(self.trace_path_button.isChecked())
+                layer.set_points_visible(self.path_structure_button.isChecked())
+                layer.add_curves(curves)
+                scene.addItem(layer)
+                scene.layers.append(layer)
+
+    def trace_finished(self, job_id):
+        if job_id == self.trace_job_id:
+            self.progress_bar.setVisible(False)
+            if self.trace_profiler is not None:
+                self.write_trace_profile()
+            self.drop_expired_shapes()
+
+    def write_trace_profile(self):
+        directory = os.environ[profiling.PROFILE_DIR_ENV]
+        os.makedirs(directory, exist_ok=True)
+        name = f"{os.path.splitext(os.path.basename(self.bezier_tracing_obj.image_path))[0]}-{self.trace_job_id}"
+        self.trace_profiler.write_json(os.path.join(directory, name + ".profile.json"))
+        self.trace_profiler.write_cprofile(os.path.join(directory, name + ".prof"))
+        self.trace_profiler = None
+
+    def trace_failed(self, job_id, message):
+        if job_id == self.trace_job_id:
+            self.progress_bar.setVisible(False)
+            print(message, file=sys.stderr)
+            self.drop_expired_shapes()
+
+    def drop_expired_shapes(self):
+        """Drop the deletions that fell off the edit history from the trace too, once no job is using it."""
+        scene = self.view.scene()
+        if self.progress_bar.isVisible() or self.bezier_tracing_obj is None or getattr(scene, "batch", None) is None:
+            return
+        self.bezier_tracing_obj.remove_shapes(scene.batch.take_expired())
+
+    def update_items(self):
+        self.image_item.setVisible(self.image_button.isChecked())
+        scene = self.view.scene()
+        for batch in [getattr(scene, "batch", None)] + getattr(scene, "layers", []):
+            if batch is not None:
+                batch.setVisible(self.trace_path_button.isChecked())
+                batch.set_points_visible(self.path_structure_button.isChecked())
+
+        if self.fill_button.isChecked():
+            self.brush = QBrush(QColor(Qt.GlobalColor.black))
+        else:
+            self.brush = QBrush()
+        self.style.set_brush(self.brush)
+
     def slider_changed(self, value):
-        self.pen.setWidth(value)
-        for item in self.items:
-            item.setPen(self.pen)
+        self.style.set_pen_width(value)
+
+    def slider_released(self):
+        self.view.setRenderHint(QPainter.RenderHint.Antialiasing, True)
+        # Cached tiles were drawn without antialiasing
+        self.style_changed()
+
+    def style_changed(self):
+        scene = self.view.scene()
+        for batch in [getattr(scene, "batch", None)] + getattr(scene, "layers", []):
+            if batch is not None:
+                batch.style_changed()
+
+    def rubber_band_changed(self, rect, from_scene, to_scene):
+        scene = self.view.scene()
+        if not rect.isNull():
+            self.rubber_band_rect = QRectF(from_scene, to_scene).normalized()
+        elif not self.rubber_band_rect.isNull() and getattr(scene, "batch", None) is not None:
+            # The drag ended: re-trace or select the shapes inside the final rubber band
+            if self.region_button.isChecked():
+                self.retrace_region(scene.batch.mapRectFromScene(self.rubber_band_rect))
+            else:
+                scene.promote_shapes(scene.batch.shapes_in(scene.batch.mapRectFromScene(self.rubber_band_rect)), select=True)
+            self.rubber_band_rect = QRectF()
+
+    def retrace_region(self, rect: QRectF):
+        # A region is spliced into a finished trace only, whose shape order it relies on
+        if self.bezier_tracing_obj is None or self.progress_bar.isVisible():
+            return
+        self.trace_job_id += 1
+        rect = rect.toAlignedRect()
+        self.trace_profiler = self.create_trace_profiler()
+        job = RegionTraceJob(
+            self.trace_job_id,
+            self.bezier_tracing_obj,
+            (rect.x(), rect.y(), rect.width(), rect.height()),
+            self.preprocess_settings(),
+            self.potrace_parameters(),
+            self.trace_profiler,
+        )
+        job.signals.progress.connect(self.trace_progress)
+        job.signals.region_ready.connect(self.trace_region_ready)
+        job.signals.finished.connect(self.trace_finished)
+        job.signals.failed.connect(self.trace_failed)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.trace_cancel_event = job.cancel_event
+        self.trace_pool.start(job)
+
+    def trace_region_ready(self, job_id, removed, added):
+        if job_id != self.trace_job_id:
+            return
+        scene = self.view.scene()
+        with self.trace_profiler.substage("scene") if self.trace_profiler is not None else nullcontext():
+            scene.batch.replace_shapes(removed, added)
 
     def resizeEvent(self, evt):
         if self.view.scene():
@@ -394,81 +903,38 @@ class MainWindow(QWidget):
         print(filename)
         extenstion = os.path.splitext(filename)[1].lower()
         scene = self.view.scene()
-        if extenstion == ".pdf":
-            printer = QPrinter()
-            printer.setOutputFileName(filename)
-            paint = QPainter()
-            if paint.begin(printer):
-                scene.render(paint)
-                paint.end()
+        self.style.flush()
+        if extenstion in WRITERS:
+            batch = scene.batch
+            if scene.layers:
+                writer = LAYER_WRITERS[extenstion]
+                curves = [(layer.color.getRgb()[:3], layer.curves()) for layer in scene.layers]
+            else:
+                writer = WRITERS[extenstion]
+                curves = batch.curves().edited(*batch.edits()) if batch is not None else CurveStore.empty()
+            rect = self.image_item.boundingRect()
+            job = ExportJob(
+                writer,
+                curves,
+                int(rect.width()),
+                int(rect.height()),
+                filename,
+                fill=self.style.brush.style() != Qt.BrushStyle.NoBrush,
+                stroke_width=self.style.pen.widthF(),
+            )
+            job.signals.failed.connect(lambda message: print(message, file=sys.stderr))
+            QThreadPool.globalInstance().start(job)
         elif extenstion in {".png", ".jpg"}:
             image = QImage(scene.sceneRect().size().toSize(), QImage.Format.Format_ARGB32)
             paint = QPainter(image)
             paint.fillRect(scene.sceneRect(), QBrush(Qt.GlobalColor.white, Qt.BrushStyle.SolidPattern))
+            # Tiles still waiting for the style change of the last frames are drawn with it now
+            for batch in [getattr(scene, "batch", None)] + getattr(scene, "layers", []):
+                if batch is not None:
+                    batch.refresh_stale_tiles(None)
             scene.render(paint)
             image.save(filename)
 
-        elif extenstion == ".svg":
-            printer = QSvgGenerator()
-            printer.setViewBox(self.view.sceneRect())
-            printer.setFileName(filename)
-            printer.setTitle(None)
-            printer.setDescription(None)
-            painter = QPainter()
-            painter.begin(printer)
-            painter.setPen(self.pen)
-            painter.setBrush(self.brush)
-            for item in self.items:
-                painter.drawPath(item.path())
-            painter.end()
-
-
-def decorate_path_item(path_item: QGraphicsPathItem, r: float):
-    item = get_points_item(path_item, r)
-    item.setParentItem(path_item)
-
-
-def get_points_item(path_item: QGraphicsPathItem, r: float) -> list:
-    path = path_item.path()
-    points = []
-    is_target = False
-    for i in range(path.elementCount()):
-        element = path.elementAt(i)
-        if element.type == QPainterPath.ElementType.CurveToDataElement:
-            if is_target:
-                is_target = False
-                points.append(((element.x, element.y), True))
-            else:
-                is_target = True
-                points.append(((element.x, element.y), False))
-        elif element.type == QPainterPath.ElementType.CurveToElement:
-            points.append(((element.x, element.y), False))
-        else:
-            points.append(((element.x, element.y), True))
-    is_first_offpoint = True
-    path = QPainterPath()
-    for i in range(len(points)):
-        pt, on_line = points[i]
-        path.addEllipse(pt[0] - r, pt[1] - r, 2 * r, 2 * r)
-        if not on_line:
-            if is_first_offpoint:
-                pre_pt, _ = points[i - 1]
-                path.moveTo(pre_pt[0], pre_pt[1])
-                path.lineTo(pt[0], pt[1])
-                is_first_offpoint = False
-            else:
-                next_pt, _ = points[i + 1]
-                path.moveTo(next_pt[0], next_pt[1])
-                path.lineTo(pt[0], pt[1])
-                is_first_offpoint = True
-    item = QGraphicsPathItem()
-    item.setPath(path)
-    pen = QPen()
-    pen.setColor(QColor(Qt.GlobalColor.green))
-    pen.setWidth(int(r))
-    item.setPen(pen)
-    return item
-
 
 def main():
     app = QApplication(sys.argv)
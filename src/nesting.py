@@ -0,0 +1,123 @@
+from collections import defaultdict
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from curves import CurveStore
+
+# Up to this many contours, every box is tested against every anchor point at once
+DENSE_CONTOURS = 256
+# Candidate (container, contour) pairs generated at a time, which bounds the memory of larger inputs
+PAIR_BLOCK = 1 << 20
+
+
+def _candidate_pairs(bounds: np.ndarray, anchors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(container, contour) index pairs of every box covering the anchor point of another contour."""
+    count = len(bounds)
+    if count <= DENSE_CONTOURS:
+        x, y = anchors[:, 0], anchors[:, 1]
+        covers = (bounds[:, 0, None] <= x) & (bounds[:, 2, None] >= x) & (bounds[:, 1, None] <= y) & (bounds[:, 3, None] >= y)
+        np.fill_diagonal(covers, False)
+        return np.nonzero(covers)
+    # Only the anchors are indexed, sorted by x: every box covers one run of them, which the y test narrows down
+    order = np.argsort(anchors[:, 0], kind="stable")
+    starts = np.searchsorted(anchors[order, 0], bounds[:, 0], "left")
+    lengths = np.searchsorted(anchors[order, 0], bounds[:, 2], "right") - starts
+    ends = np.cumsum(lengths)
+    containers, contours = [], []
+    first = 0
+    while first < count:
+        last = max(first + 1, int(np.searchsorted(ends, ends[first] - lengths[first] + PAIR_BLOCK, "right")))
+        block_lengths = lengths[first:last]
+        container = np.repeat(np.arange(first, last), block_lengths)
+        run_starts = np.repeat(starts[first:last] - (np.cumsum(block_lengths) - block_lengths), block_lengths)
+        contour = order[run_starts + np.arange(len(container))]
+        y = anchors[contour, 1]
+        keep = (bounds[container, 1] <= y) & (bounds[container, 3] >= y) & (container != contour)
+        containers.append(container[keep])
+        contours.append(contour[keep])
+        first = last
+    return np.concatenate(containers), np.concatenate(contours)
+
+
+def nest_contours(bounds: np.ndarray, anchors: np.ndarray, contains: Callable[[int, int], bool]) -> List[Tuple[int, List[int]]]:
+    """Group non-intersecting closed contours into filled shapes (an outer contour and its holes).
+
+    Only the contours whose box covers a contour's anchor point are tested exactly, instead of every pair.
+    They are found by a sweep over the anchor points sorted by x, or all at once for few contours.
+
+    Args:
+        bounds (np.ndarray): N x 4 boxes (x0, y0, x1, y1) enclosing each contour.
+        anchors (np.ndarray): N x 2 points lying on each contour.
+        contains (Callable[[int, int], bool]): contains(outer, inner) is True if contour outer encloses contour inner.
+
+    Returns:
+        List[Tuple[int, List[int]]]: (outer, holes) index groups, ordered by the left edge of the outer contour.
+            Contours nested inside a hole start a new group, as they are filled again.
+    """
+    count = len(bounds)
+    if count == 0:
+        return []
+    bounds = np.asarray(bounds, dtype=np.float64)
+    anchors = np.asarray(anchors, dtype=np.float64)
+    areas = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+
+    def encloses(outer: int, inner: int) -> bool:
+        # Of two identical contours, the one with the lower index is the container
+        return contains(outer, inner) and not (areas[outer] == areas[inner] and outer > inner and contains(inner, outer))
+
+    containers, contours = _candidate_pairs(bounds, anchors)
+    # Candidates of every contour from the smallest box up, so the first real container is the innermost one
+    order = np.lexsort((containers, areas[containers], contours))
+    containers, contours = containers[order].tolist(), contours[order]
+    group_starts = np.flatnonzero(np.diff(contours, prepend=-1)).tolist()
+    parents = np.full(count, -1)
+    for start, end in zip(group_starts, group_starts[1:] + [len(containers)]):
+        i = int(contours[start])
+        candidates = containers[start:end]
+        for k, j in enumerate(candidates):
+            if encloses(j, i):
+                # Boxes of equal area are ordered by index alone, so the container inside the others is looked for
+                for other in candidates[k + 1 :]:
+                    if areas[other] != areas[j]:
+                        break
+                    if encloses(j, other) and encloses(other, i):
+                        j = other
+                parents[i] = j
+                break
+
+    # Depths follow the parent chains, which needs no order of the contours
+    depths = np.full(count, -1)
+    for i in range(count):
+        chain = []
+        while i >= 0 and depths[i] < 0:
+            chain.append(i)
+            i = parents[i]
+        depth = depths[i] if i >= 0 else -1
+        for j in reversed(chain):
+            depth += 1
+            depths[j] = depth
+
+    holes = defaultdict(list)
+    for i in np.flatnonzero(depths % 2 == 1).tolist():
+        holes[parents[i]].append(i)
+    outers = np.flatnonzero(depths % 2 == 0)
+    outers = outers[np.argsort(bounds[outers, 0], kind="stable")]
+    return [(outer, holes[outer]) for outer in outers.tolist()]
+
+
+def nest_curves(curves: CurveStore) -> CurveStore:
+    """Group the contours of curves into filled shapes without going through Qt.
+
+    Containment is decided on the contours flattened into polygons, each flattened once.
+    """
+    anchors = curves.points[curves.contour_offsets]
+    polygons = {}
+
+    def contains(outer: int, inner: int) -> bool:
+        if outer not in polygons:
+            polygons[outer] = curves.contour_polygon(outer)
+        # potrace contours never cross, so one point of the inner contour decides containment
+        return curves.polygon_contains(polygons[outer], *anchors[inner])
+
+    return curves.regrouped(nest_contours(curves.contour_bounds(), anchors, contains))
@@ -0,0 +1,263 @@
+import copy
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+THRESHOLD_METHODS = ("fixed", "otsu", "adaptive")
+POSTERIZE_METHODS = ("kmeans", "gray", "palette")
+# Pixels compared against the cluster centers at a time, which bounds the memory of the distance matrix
+LABEL_BLOCK_PIXELS = 1 << 16
+
+
+class PreprocessStage:
+    name = ""
+
+    def parameters(self) -> dict:
+        return {}
+
+    def is_noop(self, shape: Tuple[int, ...]) -> bool:
+        return False
+
+    def output_shape(self, shape: Tuple[int, ...]) -> Tuple[int, ...]:
+        return shape
+
+    def apply(self, src: np.ndarray, dst: np.ndarray):
+        """Write the stage output for src into the preallocated dst."""
+        raise NotImplementedError
+
+
+class Grayscale(PreprocessStage):
+    name = "grayscale"
+
+    def is_noop(self, shape):
+        return len(shape) == 2
+
+    def output_shape(self, shape):
+        return shape[:2]
+
+    def apply(self, src, dst):
+        cv2.cvtColor(src, cv2.COLOR_BGRA2GRAY if src.shape[2] == 4 else cv2.COLOR_BGR2GRAY, dst=dst)
+
+
+class Resize(PreprocessStage):
+    name = "resize"
+
+    def __init__(self, scale: float = 1.0):
+        self.scale = scale
+
+    def parameters(self):
+        return {"scale": self.scale}
+
+    def is_noop(self, shape):
+        return self.scale == 1.0
+
+    def output_shape(self, shape):
+        return (max(1, round(shape[0] * self.scale)), max(1, round(shape[1] * self.scale))) + shape[2:]
+
+    def apply(self, src, dst):
+        interpolation = cv2.INTER_AREA if self.scale < 1.0 else cv2.INTER_CUBIC
+        cv2.resize(src, (dst.shape[1], dst.shape[0]), dst=dst, interpolation=interpolation)
+
+
+class Despeckle(PreprocessStage):
+    name = "despeckle"
+
+    def __init__(self, ksize: int = 1):
+        self.ksize = ksize
+
+    def parameters(self):
+        return {"ksize": self.ksize}
+
+    def is_noop(self, shape):
+        return self.ksize <= 1
+
+    def apply(self, src, dst):
+        # medianBlur only accepts odd apertures
+        cv2.medianBlur(src, self.ksize | 1, dst=dst)
+
+
+class Threshold(PreprocessStage):
+    name = "threshold"
+
+    def __init__(self, method: str = "fixed", value: int = 120, block_size: int = 31, c: int = 10):
+        """Binarize so that traced pixels are 0 and background pixels are 255.
+
+        Args:
+            method (str, optional): one of THRESHOLD_METHODS. Defaults to "fixed".
+            value (int, optional): gray level of the fixed threshold. Defaults to 120.
+            block_size (int, optional): neighbourhood of the adaptive threshold, odd. Defaults to 31.
+            c (int, optional): offset subtracted from the adaptive threshold. Defaults to 10.
+        """
+        self.method = method
+        self.value = value
+        self.block_size = block_size
+        self.c = c
+
+    def parameters(self):
+        if self.method == "adaptive":
+            return {"method": self.method, "block_size": self.block_size, "c": self.c}
+        elif self.method == "otsu":
+            return {"method": self.method}
+        return {"method": self.method, "value": self.value}
+
+    def apply(self, src, dst):
+        if self.method == "fixed":
+            cv2.threshold(src, self.value, 255, cv2.THRESH_BINARY, dst=dst)
+        elif self.method == "otsu":
+            cv2.threshold(src, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU, dst=dst)
+        elif self.method == "adaptive":
+            cv2.adaptiveThreshold(src, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, self.block_size | 1, self.c, dst=dst)
+        else:
+            raise ValueError(f"Unknown threshold method: {self.method}")
+
+
+def _nearest_center(pixels: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """Index of the closest of centers (K x C) for every row of pixels (N x C)."""
+    labels = np.empty(len(pixels), np.int64)
+    for start in range(0, len(pixels), LABEL_BLOCK_PIXELS):
+        block = pixels[start : start + LABEL_BLOCK_PIXELS].astype(np.float32)
+        labels[start : start + LABEL_BLOCK_PIXELS] = ((block[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+    return labels
+
+
+class Posterize(PreprocessStage):
+    name = "posterize"
+
+    def __init__(self, levels: int = 4, method: str = "kmeans", palette: List[Tuple[int, int, int]] = None, sample_size: int = 200_000):
+        """Label every pixel with the rank of its color among a few colors, 0 being the lightest.
+
+        After apply(), colors holds the RGB color of every rank.
+
+        Args:
+            levels (int, optional): number of colors, the background included. Defaults to 4.
+            method (str, optional): one of POSTERIZE_METHODS. "kmeans" clusters the colors of a sample of the pixels,
+                "gray" splits the gray levels into equal ranges and "palette" picks the closest color of palette.
+                Defaults to "kmeans".
+            palette (List[Tuple[int, int, int]], optional): RGB colors of the "palette" method, which replace levels.
+                Defaults to None.
+            sample_size (int, optional): pixels k-means is run on. Defaults to 200000.
+        """
+        self.levels = levels
+        self.method = method
+        self.palette = palette
+        self.sample_size = sample_size
+        self.colors = None
+
+    def parameters(self):
+        if self.method == "palette":
+            return {"method": self.method, "palette": [list(color) for color in self.palette]}
+        return {"method": self.method, "levels": self.levels}
+
+    def output_shape(self, shape):
+        return shape[:2]
+
+    def apply(self, src, dst):
+        if self.method == "gray":
+            gray = src if src.ndim == 2 else cv2.cvtColor(src, cv2.COLOR_BGRA2GRAY if src.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+            # Equal ranges of gray levels, the darkest one ranked last
+            bins = (gray.astype(np.uint16) * self.levels) >> 8
+            np.subtract(self.levels - 1, bins, out=dst, casting="unsafe")
+            values = np.round((np.arange(self.levels)[::-1] + 0.5) * 256 / self.levels - 0.5).astype(np.uint8)
+            self.colors = np.repeat(values[:, None], 3, axis=1)
+            return
+        pixels = src.reshape(-1, 1) if src.ndim == 2 else src.reshape(-1, src.shape[2])[:, :3]
+        if self.method == "kmeans":
+            rng = np.random.default_rng(0)
+            sample = pixels if len(pixels) <= self.sample_size else pixels[rng.choice(len(pixels), self.sample_size, replace=False)]
+            # Seeded, so that the same image gives the same layers
+            cv2.setRNGSeed(0)
+            criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_MAX_ITER, 20, 0.5)
+            _, _, centers = cv2.kmeans(sample.astype(np.float32), self.levels, None, criteria, 3, cv2.KMEANS_PP_CENTERS)
+            bgr = centers if centers.shape[1] == 3 else np.repeat(centers, 3, axis=1)
+        elif self.method == "palette":
+            bgr = np.array(self.palette, np.float32)[:, ::-1]
+            # Gray pixels are matched against the gray of every color, the layers keep the colors themselves
+            centers = bgr if src.ndim == 3 else bgr @ np.array([[0.114], [0.587], [0.299]], np.float32)
+        else:
+            raise ValueError(f"Unknown posterize method: {self.method}")
+        labels = _nearest_center(pixels, centers)
+        order = np.argsort(-(bgr @ np.array([0.114, 0.587, 0.299], np.float32)), kind="stable")
+        rank = np.empty(len(order), np.uint8)
+        rank[order] = np.arange(len(order))
+        dst[...] = rank[labels].reshape(dst.shape)
+        self.colors = np.clip(np.round(bgr[order][:, ::-1]), 0, 255).astype(np.uint8)
+
+
+class PreprocessPipeline:
+    def __init__(self, stages: List[PreprocessStage]):
+        """Chain of preprocessing stages that keeps every stage output in a reusable buffer.
+
+        After a stage is changed through update(), run() only recomputes that stage and the ones after it.
+        Stages that would not change their input are skipped without a copy.
+        The returned bitmap is owned by the pipeline and overwritten by the next run().
+        """
+        self.stages = list(stages)
+        self._buffers = [None] * len(self.stages)
+        self._outputs = [None] * len(self.stages)
+        self._valid_stages = 0
+        self._source = None
+
+    @classmethod
+    def default(cls) -> "PreprocessPipeline":
+        return cls([Grayscale(), Resize(), Despeckle(), Threshold()])
+
+    def copy(self) -> "PreprocessPipeline":
+        """Pipeline with the same stage parameters and its own buffers, e.g. for another thread."""
+        return PreprocessPipeline([copy.copy(stage) for stage in self.stages])
+
+    def stage(self, name: str) -> PreprocessStage:
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def update(self, name: str, **parameters) -> bool:
+        """Change parameters of the stage called name and invalidate it and everything after it.
+
+        Parameters equal to the current ones keep the stage outputs.
+
+        Returns:
+            bool: whether a parameter changed.
+        """
+        stage = self.stage(name)
+        for key in parameters:
+            if not hasattr(stage, key):
+                raise AttributeError(f"{name} has no parameter {key}")
+        changed = {key: value for key, value in parameters.items() if getattr(stage, key) != value}
+        for key, value in changed.items():
+            setattr(stage, key, value)
+        if changed:
+            self._valid_stages = min(self._valid_stages, self.stages.index(stage))
+        return bool(changed)
+
+    def parameters(self) -> list:
+        return [dict(stage=stage.name, **stage.parameters()) for stage in self.stages]
+
+    @property
+    def scale(self) -> float:
+        """Size of the output bitmap relative to the input image."""
+        scale = 1.0
+        for stage in self.stages:
+            if isinstance(stage, Resize):
+                scale *= stage.scale
+        return scale
+
+    def run(self, image: np.ndarray) -> np.ndarray:
+        if image is not self._source:
+            self._source = image
+            self._valid_stages = 0
+        src = image
+        for i, stage in enumerate(self.stages):
+            if i >= self._valid_stages:
+                if stage.is_noop(src.shape):
+                    self._outputs[i] = src
+                else:
+                    shape = stage.output_shape(src.shape)
+                    if self._buffers[i] is None or self._buffers[i].shape != shape:
+                        self._buffers[i] = np.empty(shape, np.uint8)
+                    stage.apply(src, self._buffers[i])
+                    self._outputs[i] = self._buffers[i]
+            src = self._outputs[i]
+        self._valid_stages = len(self.stages)
+        return src
@@ -0,0 +1,221 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Set to a directory to write a report of every trace the GUI runs
+PROFILE_DIR_ENV = "PYQT_POTRACE_PROFILE"
+# Set to 1 to add memory counters to the GUI reports, and to 2 to also write cProfile statistics
+PROFILE_LEVEL_ENV = "PYQT_POTRACE_PROFILE_LEVEL"
+
+_lock = threading.Lock()
+_active: Optional["TraceProfiler"] = None
+
+
+def rss_bytes() -> Optional[int]:
+    """Resident set size of this process, or its peak where the current size is not available."""
+    try:
+        with open("/proc/self/statm", mode="rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+class TraceProfiler:
+    def __init__(self, name: str = "", memory: bool = False, profile: bool = False):
+        """Per-stage wall times, and optionally memory counters and cProfile statistics, of one trace.
+
+        While the profiler is running, BezierTracing's stages and the stage() blocks in the backends, in
+        nesting and in the callers are recorded. Sub-stages are named "<stage>.<sub-stage>" and add up over
+        repeated calls, e.g. over the tiles of a tiled trace. One profiler runs at a time per process.
+        tracemalloc has a single peak per process, so memory counters are only recorded for the stages run
+        by the thread that started the profiler. Stages run by other threads, e.g. the tiles or the layers of
+        a trace, record their times only.
+
+        Args:
+            name (str, optional): name of the report, e.g. the image path. Defaults to "".
+            memory (bool, optional): record the RSS after each stage and the Python allocation peak during it
+                with tracemalloc. Slows down allocation heavy stages. Defaults to False.
+            profile (bool, optional): run cProfile while the profiler is running. Defaults to False.
+        """
+        self.name = name
+        self.memory = memory
+        self.profile = profile
+        self.stages: Dict[str, dict] = {}
+        self.started = None
+        self.seconds = 0.0
+        self._stage = None
+        self._stage_start = None
+        self._cprofile = cProfile.Profile() if profile else None
+        self._started_tracemalloc = False
+        self._peak_rss = 0
+        self._thread = None
+        # [traced bytes at the start, peak so far] of the stages open on the owning thread, innermost last
+        self._memory_stack: List[list] = []
+
+    def start(self):
+        global _active
+        with _lock:
+            if _active is not None:
+                raise RuntimeError("Another TraceProfiler is already running")
+            _active = self
+        self._thread = threading.get_ident()
+        self.started = time.perf_counter()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if self._cprofile is not None:
+            self._cprofile.enable()
+        return self
+
+    def stop(self):
+        global _active
+        self.enter_stage(None)
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        self.seconds = time.perf_counter() - self.started
+        with _lock:
+            if _active is self:
+                _active = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _measures_memory(self) -> bool:
+        return self.memory and tracemalloc.is_tracing() and threading.get_ident() == self._thread
+
+    def _update_peaks(self):
+        # The stages still open keep the peak reached so far before a nested stage resets it
+        peak = tracemalloc.get_traced_memory()[1]
+        for measure in self._memory_stack:
+            measure[1] = max(measure[1], peak)
+
+    def _begin(self) -> tuple:
+        measure = None
+        if self._measures_memory():
+            self._update_peaks()
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            measure = [current, current]
+            self._memory_stack.append(measure)
+        return time.perf_counter(), measure
+
+    def _record(self, stage: str, began: tuple):
+        seconds = time.perf_counter() - began[0]
+        measure = began[1]
+        if measure is not None:
+            self._update_peaks()
+            self._memory_stack = [other for other in self._memory_stack if other is not measure]
+        with _lock:
+            record = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+            record["calls"] += 1
+            record["seconds"] += seconds
+            if self.memory:
+                if measure is not None:
+                    # Peak of the Python allocations made during the stage on top of what was allocated before it
+                    record["python_peak_bytes"] = max(record.get("python_peak_bytes", 0), measure[1] - measure[0])
+                rss = rss_bytes()
+                if rss is not None:
+                    record["rss_bytes"] = rss
+                    self._peak_rss = max(self._peak_rss, rss)
+
+    def enter_stage(self, stage: Optional[str]):
+        """End the current top-level stage and start the next one, or none."""
+        if self._stage is not None:
+            self._record(self._stage, self._stage_start)
+        self._stage = stage
+        self._stage_start = self._begin() if stage is not None else None
+
+    @contextmanager
+    def substage(self, name: str):
+        """Time a block as a part of the current stage, or as a stage of its own outside of one."""
+        stage = f"{self._stage}.{name}" if self._stage is not None else name
+        began = self._begin()
+        try:
+            yield
+        finally:
+            self._record(stage, began)
+
+    def report(self) -> dict:
+        report = {"name": self.name, "seconds": self.seconds, "stages": [dict(stage=stage, **record) for stage, record in self.stages.items()]}
+        if self.memory and self._peak_rss:
+            report["peak_rss_bytes"] = self._peak_rss
+        return report
+
+    def write_json(self, file_path: str):
+        with open(file_path, mode="w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_cprofile(self, file_path: str):
+        """Write the cProfile statistics for pstats or snakeviz."""
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(file_path)
+
+
+def active() -> Optional[TraceProfiler]:
+    return _active
+
+
+def enter_stage(stage: str):
+    profiler = _active
+    if profiler is not None:
+        profiler.enter_stage(stage)
+
+
+@contextmanager
+def stage(name: str):
+    """Record the block in the running profiler. Costs one global lookup when none is running."""
+    profiler = _active
+    if profiler is None:
+        yield
+    else:
+        with profiler.substage(name):
+            yield
+
+
+def aggregate(reports: List[dict]) -> dict:
+    """Totals and distributions of the stage times of several reports, e.g. of a batch run."""
+    per_stage = {}
+    for report in reports:
+        for record in report["stages"]:
+            per_stage.setdefault(record["stage"], []).append(record)
+    stages = {}
+    for name, records in per_stage.items():
+        seconds = np.array([record["seconds"] for record in records])
+        stages[name] = {
+            "images": len(records),
+            "calls": sum(record["calls"] for record in records),
+            "total_seconds": float(seconds.sum()),
+            "mean_seconds": float(seconds.mean()),
+            "p50_seconds": float(np.percentile(seconds, 50)),
+            "p95_seconds": float(np.percentile(seconds, 95)),
+            "max_seconds": float(seconds.max()),
+        }
+        peaks = [record["python_peak_bytes"] for record in records if "python_peak_bytes" in record]
+        if peaks:
+            stages[name]["max_python_peak_bytes"] = max(peaks)
+    summary = {"images": len(reports), "seconds": float(sum(report["seconds"] for report in reports)), "stages": stages}
+    peak_rss = [report["peak_rss_bytes"] for report in reports if "peak_rss_bytes" in report]
+    if peak_rss:
+        summary["max_peak_rss_bytes"] = max(peak_rss)
+    return summary
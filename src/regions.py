@@ -0,0 +1,73 @@
+from typing import Tuple
+
+import numpy as np
+
+from curves import CurveStore
+
+# Distance in pixels within which a shape counts as touching a dirty rectangle, as the curves may run up
+# to about a pixel from the traced pixel edges
+TOUCH_MARGIN = 2.0
+# Background kept around the re-traced region, so that the shapes inside it are traced whole
+REGION_PADDING = 4
+
+
+def _segments_meet_box(polygon: np.ndarray, box: Tuple[float, float, float, float]) -> bool:
+    """True if an edge of the closed polygon crosses or lies inside box (x0, y0, x1, y1)."""
+    x0, y0, x1, y1 = box
+    p = polygon
+    q = np.concatenate([polygon[1:], polygon[:1]])
+    overlap = (
+        (np.minimum(p[:, 0], q[:, 0]) <= x1)
+        & (np.maximum(p[:, 0], q[:, 0]) >= x0)
+        & (np.minimum(p[:, 1], q[:, 1]) <= y1)
+        & (np.maximum(p[:, 1], q[:, 1]) >= y0)
+    )
+    if not overlap.any():
+        return False
+    p, d = p[overlap], (q - p)[overlap]
+    corners = np.array([(x0, y0), (x1, y0), (x1, y1), (x0, y1)])
+    # The box meets the edge's line if its corners are not all on the same side of it
+    side = d[:, None, 0] * (corners[None, :, 1] - p[:, None, 1]) - d[:, None, 1] * (corners[None, :, 0] - p[:, None, 0])
+    return bool(np.any((side.min(axis=1) <= 0) & (side.max(axis=1) >= 0)))
+
+
+def shapes_touching(curves: CurveStore, box: Tuple[float, float, float, float], margin: float = TOUCH_MARGIN) -> np.ndarray:
+    """Indices of the shapes whose filled area comes within margin of box (x0, y0, x1, y1).
+
+    A shape whose hole contains the whole box is not touched by it, even though its bounds are.
+    """
+    x0, y0, x1, y1 = box[0] - margin, box[1] - margin, box[2] + margin, box[3] + margin
+    bounds = curves.shape_bounds()
+    candidates = np.flatnonzero((bounds[:, 0] <= x1) & (bounds[:, 2] >= x0) & (bounds[:, 1] <= y1) & (bounds[:, 3] >= y0))
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    touching = []
+    for i in candidates.tolist():
+        contours = range(curves.shape_offsets[i], curves._shape_end(i))
+        polygons = [curves.contour_polygon(j) for j in contours]
+        # Either an outline runs through the box, or the box lies inside the filled area (even-odd)
+        if (
+            any(_segments_meet_box(polygon, (x0, y0, x1, y1)) for polygon in polygons)
+            or sum(CurveStore.polygon_contains(polygon, cx, cy) for polygon in polygons) % 2
+        ):
+            touching.append(i)
+    return np.array(touching, np.int64)
+
+
+def shapes_within(curves: CurveStore, box: Tuple[float, float, float, float]) -> np.ndarray:
+    """Indices of the shapes whose bounds lie inside box (x0, y0, x1, y1)."""
+    bounds = curves.shape_bounds()
+    return np.flatnonzero((bounds[:, 0] >= box[0]) & (bounds[:, 1] >= box[1]) & (bounds[:, 2] <= box[2]) & (bounds[:, 3] <= box[3]))
+
+
+def dirty_region(
+    curves: CurveStore, box: Tuple[float, float, float, float], width: int, height: int, padding: int = REGION_PADDING
+) -> Tuple[int, int, int, int]:
+    """Pixel rectangle (x0, y0, x1, y1) to re-trace after the pixels in box changed.
+
+    It covers box and every shape touching it, plus padding, clipped to the image.
+    """
+    touching = shapes_touching(curves, box)
+    bounds = np.vstack([np.array(box, np.float64)[None, :], curves.shape_bounds()[touching]])
+    x0, y0 = np.floor(bounds[:, :2].min(axis=0)).astype(int) - padding
+    x1, y1 = np.ceil(bounds[:, 2:].max(axis=0)).astype(int) + padding
+    return max(0, x0), max(0, y0), min(width, x1), min(height, y1)
@@ -0,0 +1,649 @@
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PyQt6.QtCore import QLineF, QObject, QPointF, QRectF, Qt, QTimer, pyqtSignal
+from PyQt6.QtGui import QBrush, QColor, QPainter, QPainterPath, QPainterPathStroker, QPen, QPolygonF
+from PyQt6.QtWidgets import QGraphicsItem
+
+from curves import CURVE_TO, CurveStore
+
+
+class PathStyle(QObject):
+    # Changes made within one frame at 60 Hz are applied together
+    FRAME_INTERVAL = 16
+
+    changed = pyqtSignal()
+
+    def __init__(self, pen: QPen, brush: QBrush, parent: QObject = None):
+        """Pen and brush that batched path items read whenever they paint.
+
+        set_pen_width() and set_brush() only record the change. The pending changes are applied and
+        `changed` is emitted once per frame, so dragging a slider repaints the shapes once per frame instead of
+        once per slider value.
+        """
+        super().__init__(parent)
+        self.pen = pen
+        self.brush = brush
+        self._pending = {}
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(self.FRAME_INTERVAL)
+        self._timer.timeout.connect(self.flush)
+
+    def set_pen_width(self, width: int):
+        if width != self._pending.get("pen_width", self.pen.width()):
+            self._schedule("pen_width", width)
+
+    def set_brush(self, brush: QBrush):
+        if brush != self._pending.get("brush", self.brush):
+            self._schedule("brush", brush)
+
+    def _schedule(self, name: str, value):
+        self._pending[name] = value
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        """Apply the pending changes now, e.g. before the style is read outside of painting."""
+        self._timer.stop()
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        if "pen_width" in pending:
+            self.pen.setWidth(pending["pen_width"])
+        if "brush" in pending:
+            self.brush = pending["brush"]
+        self.changed.emit()
+
+
+def fill_brush(style: PathStyle, color: Optional[QColor]) -> QBrush:
+    """Brush of style, in color instead if one is given and the style fills at all."""
+    if color is None or style.brush.style() == Qt.BrushStyle.NoBrush:
+        return style.brush
+    return QBrush(color)
+
+
+def points_rect(curves: CurveStore, margin: float) -> QRectF:
+    """Rectangle around every point of curves, grown by margin on each side."""
+    if len(curves.points) == 0:
+        return QRectF()
+    x0, y0 = curves.points.min(axis=0).tolist()
+    x1, y1 = curves.points.max(axis=0).tolist()
+    return QRectF(x0, y0, x1 - x0, y1 - y0).adjusted(-margin, -margin, margin, margin)
+
+
+class PointsItem(QGraphicsItem):
+    # On-screen point radius in pixels from which points are drawn as circles, and below which only
+    # every n-th anchor point is drawn
+    CIRCLE_MIN_RADIUS = 2.0
+    DOT_MIN_RADIUS = 0.25
+    DOT_SIZE = 3
+
+    def __init__(self, curves: CurveStore, r: float, parent: QGraphicsItem = None):
+        """Overlay showing the points and control handles of curves.
+
+        Nothing is built until the item is painted, i.e. until it is shown and inside the view. What is drawn
+        depends on the zoom: circles and handles close up, dots further out, and a thinned out set of anchor
+        points when zoomed far out. Each representation is built once per zoom band and kept.
+
+        Args:
+            curves (CurveStore): curves of the parent item.
+            r (float): circle radius in scene units.
+            parent (QGraphicsItem, optional): item the overlay belongs to. Defaults to None.
+        """
+        super().__init__(parent)
+        self.curves = curves
+        self.r = r
+        self.pen = QPen(QColor(Qt.GlobalColor.green))
+        self.pen.setWidth(int(r))
+        self.dot_pen = QPen(QColor(Qt.GlobalColor.green), self.DOT_SIZE)
+        self.dot_pen.setCosmetic(True)
+        self._bounding_rect = points_rect(curves, r + self.pen.widthF())
+        self._representations = {}
+
+    def set_curves(self, curves: CurveStore):
+        """Show other curves, dropping every cached representation."""
+        self.prepareGeometryChange()
+        self.curves = curves
+        self._bounding_rect = points_rect(curves, self.r + self.pen.widthF())
+        self._representations.clear()
+        self.update()
+
+    def boundingRect(self) -> QRectF:
+        return self._bounding_rect
+
+    def zoom_band(self, level_of_detail: float) -> int:
+        """Power of two of the on-screen circle radius, clamped to the bands that look different."""
+        screen_radius = max(self.r * level_of_detail, 1e-9)
+        return int(np.clip(np.floor(np.log2(screen_radius)), np.log2(self.DOT_MIN_RADIUS) - 8, np.log2(self.CIRCLE_MIN_RADIUS)))
+
+    def _handles(self) -> np.ndarray:
+        codes, points = self.curves.codes, self.curves.points
+        curve_starts = np.flatnonzero(codes == CURVE_TO)
+        # The first control point hangs off the segment start, the second one off the segment end
+        return np.concatenate(
+            [np.stack([points[curve_starts - 1], points[curve_starts]], axis=1), np.stack([points[curve_starts + 2], points[curve_starts + 1]], axis=1)]
+        )
+
+    def _representation(self, band: int):
+        if band not in self._representations:
+            points = self.curves.points
+            if 2.0**band >= self.CIRCLE_MIN_RADIUS:
+                r = self.r
+                path = QPainterPath()
+                for x, y in points.tolist():
+                    path.addEllipse(x - r, y - r, 2 * r, 2 * r)
+                for (x0, y0), (x1, y1) in self._handles().tolist():
+                    path.moveTo(x0, y0)
+                    path.lineTo(x1, y1)
+                self._representations[band] = path
+            elif 2.0**band >= self.DOT_MIN_RADIUS:
+                dots = QPolygonF([QPointF(x, y) for x, y in points.tolist()])
+                handles = [QLineF(x0, y0, x1, y1) for (x0, y0), (x1, y1) in self._handles().tolist()]
+                self._representations[band] = (dots, handles)
+            else:
+                # Anchors only, fewer the further out
+                codes = self.curves.codes
+                on_curve = codes < CURVE_TO
+                on_curve[np.flatnonzero(codes == CURVE_TO) + 2] = True
+                anchors = points[on_curve]
+                step = int(self.DOT_MIN_RADIUS / 2.0**band)
+                self._representations[band] = (QPolygonF([QPointF(x, y) for x, y in anchors[::step].tolist()]), [])
+        return self._representations[band]
+
+    def paint(self, painter: QPainter, option, widget=None):
+        band = self.zoom_band(option.levelOfDetailFromTransform(painter.worldTransform()))
+        representation = self._representation(band)
+        if isinstance(representation, QPainterPath):
+            painter.setPen(self.pen)
+            painter.drawPath(representation)
+        else:
+            dots, handles = representation
+            painter.setPen(self.dot_pen)
+            painter.drawPoints(dots)
+            if handles:
+                painter.setPen(QPen(self.pen.color(), 0))
+                painter.drawLines(handles)
+
+
+class GroupItem(QGraphicsItem):
+    """Item without contents that shows, hides and stacks its children together."""
+
+    def __init__(self, parent: QGraphicsItem = None):
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemHasNoContents)
+
+    def boundingRect(self) -> QRectF:
+        return QRectF()
+
+    def paint(self, painter: QPainter, option, widget=None):
+        pass
+
+
+class CurveTileItem(QGraphicsItem):
+    def __init__(self, curves: CurveStore, style: PathStyle, parent: QGraphicsItem = None, color: QColor = None):
+        """Nearby shapes drawn as a single path, except for the ones that are hidden.
+
+        Traced shapes never overlap, so the even-odd fill of their union is the same as filling each of them.
+        Moved shapes may overlap the others and are drawn as paths of their own instead, which keeps overlaps
+        filled rather than cut out.
+        The rendered tile is cached as a pixmap in device coordinates, so panning does not draw the path again.
+        The shapes are filled with color instead of the brush color of style if one is given. The tile paints
+        with the pen and brush of style as of the last style_changed(), and paint_seconds is the time the last
+        rendering took, or None if the tile was not rendered since.
+        """
+        super().__init__(parent)
+        self.curves = curves
+        self.style = style
+        self.color = color
+        self.pen = QPen(style.pen)
+        self.brush = fill_brush(style, color)
+        self.paint_seconds = None
+        self.hidden = np.zeros(len(curves), bool)
+        self.moved = np.zeros(len(curves), bool)
+        self._path = None
+        self._moved_paths = None
+        self._rect = points_rect(curves, 0.0)
+        self.setCacheMode(QGraphicsItem.CacheMode.DeviceCoordinateCache)
+
+    def visible_curves(self) -> CurveStore:
+        return self.curves.take(np.flatnonzero(~self.hidden))
+
+    def set_hidden(self, i, hidden: bool):
+        """Hide or show shape i, or every shape of an index array."""
+        self.hidden[i] = hidden
+        self._path = None
+        self._moved_paths = None
+        self.update()
+
+    def translate_shapes(self, indices: np.ndarray, offset: np.ndarray):
+        """Move the given shapes by one (dx, dy) or by one row per shape."""
+        elements, lengths = self.curves.shape_elements(indices)
+        self.curves.points[elements] += np.repeat(np.broadcast_to(offset, (len(indices), 2)), lengths, axis=0)
+        self.moved[indices] = True
+        self.prepareGeometryChange()
+        self._rect = points_rect(self.curves, 0.0)
+        self._path = None
+        self._moved_paths = None
+        self.update()
+
+    def free_shapes(self, indices: np.ndarray):
+        """Drop the geometry of shapes that stay hidden for good, keeping the indices of the others."""
+        self.hidden[indices] = True
+        self.curves = self.curves.emptied(indices)
+        self.prepareGeometryChange()
+        self._rect = points_rect(self.curves, 0.0)
+        self._path = None
+        self._moved_paths = None
+        self.update()
+
+    def style_changed(self):
+        # The pen width changes the bounding rect and every cached pixmap is stale
+        self.prepareGeometryChange()
+        self.pen = QPen(self.style.pen)
+        self.brush = fill_brush(self.style, self.color)
+        self.paint_seconds = None
+        self.update()
+
+    def boundingRect(self) -> QRectF:
+        margin = self.pen.widthF() / 2 + 1
+        return self._rect.adjusted(-margin, -margin, margin, margin)
+
+    def path(self) -> QPainterPath:
+        """The visible shapes that were never moved, all contours in one even-odd path."""
+        if self._path is None:
+            batched = self.curves.take(np.flatnonzero(~self.hidden & ~self.moved))
+            if batched.contour_count:
+                self._path = CurveStore(batched.codes, batched.points, batched.contour_offsets, [0]).to_qt_path(0)
+            else:
+                self._path = QPainterPath()
+        return self._path
+
+    def moved_paths(self) -> List[QPainterPath]:
+        """One path per visible moved shape."""
+        if self._moved_paths is None:
+            self._moved_paths = self.curves.take(np.flatnonzero(~self.hidden & self.moved)).to_qt_paths()
+        return self._moved_paths
+
+    def paint(self, painter: QPainter, option, widget=None):
+        started = time.perf_counter()
+        painter.setPen(self.pen)
+        painter.setBrush(self.brush)
+        painter.drawPath(self.path())
+        for path in self.moved_paths():
+            painter.drawPath(path)
+        self.paint_seconds = time.perf_counter() - started
+
+
+class BatchedCurvesItem(GroupItem):
+    # Z values of the children: promoted shapes are drawn over the tiles, control points over both
+    PROMOTED_Z = 1
+    POINTS_Z = 2
+    # Seconds per frame spent rendering tiles again after a style change. The other tiles keep their former
+    # look until a later frame, so a change repaints the shapes over several frames instead of stalling one.
+    REFRESH_BUDGET = 0.008
+
+    def __init__(self, style: PathStyle, point_radius: float, tile_shapes: int = 256, parent: QGraphicsItem = None, color: QColor = None):
+        """All traced shapes, drawn by a few tile items instead of one item per shape.
+
+        Shapes are looked up by their index in the order they were added. promote() turns shapes into one
+        selectable and movable item and hides them from their tiles; demote() puts them back. Edits are kept
+        as the (dx, dy) offset and the deleted flag of every shape, which the tiles follow, so that an edited
+        shape needs no item of its own.
+        Hiding this item hides every shape, and hiding points_root hides the control points of all tiles.
+
+        Args:
+            style (PathStyle): pen and brush of the shapes.
+            point_radius (float): radius of the control point circles.
+            tile_shapes (int, optional): shapes per tile. Defaults to 256.
+            parent (QGraphicsItem, optional): parent item. Defaults to None.
+            color (QColor, optional): fill color replacing the brush color of style, e.g. of a color layer. Defaults to None.
+        """
+        super().__init__(parent)
+        self.style = style
+        self.color = color
+        self.point_radius = point_radius
+        self.tile_shapes = tile_shapes
+        self.points_root = GroupItem(self)
+        self.points_root.setZValue(self.POINTS_Z)
+        self.tiles: List[CurveTileItem] = []
+        # Item of every promoted shape, and every item once
+        self.promoted: Dict[int, PromotedShapesItem] = {}
+        self.promoted_items = set()
+        self.offsets = np.zeros((0, 2))
+        self.deleted = np.zeros(0, bool)
+        # Shapes replaced by a re-trace or deleted beyond undo, which are no longer shown nor exported
+        self.removed = set()
+        # The ones the owner of the trace (BezierTracing.curves) no longer holds either
+        self.dropped = set()
+        # Shapes deleted beyond undo that the owner still holds, until take_expired() hands them over
+        self.expired = set()
+        self._chunks: List[CurveStore] = []
+        self._chunk_starts = [0]
+        self._chunk_bounds: List[np.ndarray] = []
+        self._chunk_tiles: List[np.ndarray] = []
+        self._bounds = None
+        self._tile_of = None
+        # Tiles still painted with a former style, and the ones refreshed by the last refresh_stale_tiles()
+        self._stale_tiles: List[CurveTileItem] = []
+        self._refreshed_tiles: List[CurveTileItem] = []
+        self._seconds_per_shape = None
+        self._refresh_timer = QTimer(style)
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.timeout.connect(self.refresh_stale_tiles)
+
+    def __len__(self) -> int:
+        return self._chunk_starts[-1]
+
+    def add_curves(self, curves: CurveStore):
+        """Append shapes, grouped into tiles of shapes that lie next to each other."""
+        if len(curves) == 0:
+            return
+        bounds = curves.shape_bounds()
+        order = np.argsort(bounds[:, 1] + bounds[:, 3], kind="stable")
+        tile_of = np.empty((len(curves), 2), np.int64)
+        for group in np.array_split(order, -(-len(curves) // self.tile_shapes)):
+            tile = CurveTileItem(curves.take(group), self.style, self, self.color)
+            tile.points_item = PointsItem(tile.curves, self.point_radius, self.points_root)
+            tile_of[group, 0] = len(self.tiles)
+            tile_of[group, 1] = np.arange(len(group))
+            self.tiles.append(tile)
+        self._chunks.append(curves)
+        self._chunk_starts.append(len(self) + len(curves))
+        self._chunk_bounds.append(bounds)
+        self._chunk_tiles.append(tile_of)
+        self.offsets = np.concatenate([self.offsets, np.zeros((len(curves), 2))])
+        self.deleted = np.concatenate([self.deleted, np.zeros(len(curves), bool)])
+        self._bounds = self._tile_of = None
+
+    def _index(self):
+        if self._bounds is None:
+            self._bounds = np.concatenate(self._chunk_bounds) if self._chunk_bounds else np.empty((0, 4))
+            self._tile_of = np.concatenate(self._chunk_tiles) if self._chunk_tiles else np.empty((0, 2), np.int64)
+        return self._bounds, self._tile_of
+
+    def curves(self) -> CurveStore:
+        """Every shape as traced, in the order of their indices."""
+        return CurveStore.concatenate(self._chunks)
+
+    def edits(self) -> Tuple[List[int], Dict[int, Tuple[float, float]]]:
+        """Shapes deleted and moved by the user, as the arguments of CurveStore.edited()."""
+        deleted = np.union1d(np.flatnonzero(self.deleted), self._removed_indices())
+        moved = np.setdiff1d(np.flatnonzero(self.offsets.any(axis=1)), deleted)
+        return deleted.tolist(), dict(zip(moved.tolist(), map(tuple, self.offsets[moved].tolist())))
+
+    def shape_curves(self, i: int) -> CurveStore:
+        chunk = int(np.searchsorted(self._chunk_starts, i, side="right")) - 1
+        return self._chunks[chunk].shape(i - self._chunk_starts[chunk])
+
+    def shape_path(self, i: int) -> QPainterPath:
+        """Path of shape i as traced, without its offset."""
+        return self.shape_curves(i).to_qt_path(0)
+
+    def _by_tile(self, indices: np.ndarray) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """(tile index, positions in indices, indices in the tile) of the given shapes, one tile at a time."""
+        if len(indices) == 0:
+            return
+        _, tile_of = self._index()
+        tiles = tile_of[indices, 0]
+        order = np.argsort(tiles, kind="stable")
+        for group in np.split(order, np.flatnonzero(np.diff(tiles[order])) + 1):
+            yield int(tiles[group[0]]), group, tile_of[indices[group], 1]
+
+    def _set_tiles_hidden(self, indices: np.ndarray, hidden: bool):
+        for tile_index, _, local in self._by_tile(indices):
+            tile = self.tiles[tile_index]
+            tile.set_hidden(local, hidden)
+            tile.points_item.set_curves(tile.visible_curves())
+
+    def _candidates(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        """Indices of the tiled shapes whose bounds, grown by the pen, meet the rectangle, topmost first."""
+        bounds, _ = self._index()
+        bounds = bounds + np.tile(self.offsets, 2)
+        margin = self.style.pen.widthF() / 2 + 1
+        hits = (bounds[:, 0] - margin <= x1) & (bounds[:, 2] + margin >= x0) & (bounds[:, 1] - margin <= y1) & (bounds[:, 3] + margin >= y0)
+        hits &= ~self.deleted
+        return np.array([i for i in np.flatnonzero(hits)[::-1].tolist() if i not in self.promoted and i not in self.removed], np.int64)
+
+    def shape_at(self, pos: QPointF) -> Optional[int]:
+        """Index of the topmost tiled shape under pos in item coordinates, or None."""
+        if not self.isVisible():
+            return None
+        stroker = QPainterPathStroker()
+        stroker.setWidth(max(self.style.pen.widthF(), 1.0))
+        for i in self._candidates(pos.x(), pos.y(), pos.x(), pos.y()).tolist():
+            path = self.shape_path(i)
+            local_pos = pos - QPointF(*self.offsets[i].tolist())
+            if path.contains(local_pos) or stroker.createStroke(path).contains(local_pos):
+                return i
+        return None
+
+    def shapes_in(self, rect: QRectF) -> List[int]:
+        """Indices of the tiled shapes intersecting rect in item coordinates."""
+        if not self.isVisible():
+            return []
+        candidates = self._candidates(rect.left(), rect.top(), rect.right(), rect.bottom())
+        return [i for i in candidates.tolist() if self.shape_path(i).intersects(rect.translated(*(-self.offsets[i]).tolist()))]
+
+    def shapes_curves(self, indices: np.ndarray) -> CurveStore:
+        """Shapes at their current offsets, in the order of the given sorted indices."""
+        chunks = np.searchsorted(self._chunk_starts, indices, side="right") - 1
+        stores = []
+        for chunk in np.unique(chunks).tolist():
+            stores.append(self._chunks[chunk].take(indices[chunks == chunk] - self._chunk_starts[chunk]))
+        curves = CurveStore.concatenate(stores)
+        elements, lengths = curves.shape_elements(np.arange(len(curves)))
+        curves.points[elements] += np.repeat(self.offsets[indices], lengths, axis=0)
+        return curves
+
+    def promote(self, indices: Sequence[int]) -> List["PromotedShapesItem"]:
+        """One selectable and movable item for the given shapes, which are hidden from their tiles.
+
+        Returns:
+            List[PromotedShapesItem]: the new item, and the items of the shapes that were promoted before.
+        """
+        indices = np.unique(np.asarray(indices, np.int64))
+        promoted = np.array([i in self.promoted for i in indices.tolist()], bool)
+        path_items = list({id(self.promoted[i]): self.promoted[i] for i in indices[promoted].tolist()}.values())
+        indices = indices[~promoted]
+        if len(indices):
+            path_item = PromotedShapesItem(self.shapes_curves(indices), indices, self.offsets[indices[0]], self.style, self, self.color)
+            # Shapes moved before may overlap the others of the item
+            path_item.moved[:] = self.offsets[indices].any(axis=1)
+            path_item.setZValue(self.PROMOTED_Z)
+            path_item.points_item = PointsItem(path_item.curves, self.point_radius, path_item)
+            path_item.points_item.setVisible(self.points_root.isVisible())
+            self.promoted.update(dict.fromkeys(indices.tolist(), path_item))
+            self.promoted_items.add(path_item)
+            self._set_tiles_hidden(indices, True)
+            path_items.append(path_item)
+        return path_items
+
+    def demote(self, path_items: Iterable["PromotedShapesItem"]):
+        """Draw promoted shapes by their tiles again and remove their items."""
+        path_items = [path_item for path_item in path_items if path_item in self.promoted_items]
+        if not path_items:
+            return
+        for path_item in path_items:
+            for i in path_item.shape_indices.tolist():
+                del self.promoted[i]
+            self.promoted_items.discard(path_item)
+            if path_item.scene() is not None:
+                path_item.scene().removeItem(path_item)
+        indices = np.concatenate([path_item.shape_indices for path_item in path_items])
+        self._set_tiles_hidden(indices[~np.isin(indices, self._removed_indices())], False)
+
+    def dragged(self, path_items: Iterable["PromotedShapesItem"]) -> Tuple[np.ndarray, np.ndarray]:
+        """Indices of the shapes of promoted items that were dragged since their last move, and one (dx, dy) row per shape."""
+        indices, offsets = [np.empty(0, np.int64)], [np.empty((0, 2))]
+        for path_item in path_items:
+            offset = np.array([path_item.x(), path_item.y()]) - (self.offsets[path_item.shape_indices[0]] - path_item.promoted_offset)
+            if offset.any():
+                indices.append(path_item.shape_indices)
+                offsets.append(np.broadcast_to(offset, (len(path_item.shape_indices), 2)))
+        indices, offsets = np.concatenate(indices), np.concatenate(offsets)
+        order = np.argsort(indices)
+        return indices[order], offsets[order]
+
+    def _removed_indices(self) -> np.ndarray:
+        return np.fromiter(self.removed, np.int64, len(self.removed))
+
+    def move_shapes(self, indices: np.ndarray, offset: np.ndarray):
+        """Move shapes by one (dx, dy) for all of them or by one row per shape."""
+        offset = np.broadcast_to(offset, (len(indices), 2))
+        self.offsets[indices] += offset
+        # Removed shapes have no geometry left in their tiles
+        alive = ~np.isin(indices, self._removed_indices())
+        alive_offset = offset[alive]
+        for tile_index, positions, local in self._by_tile(indices[alive]):
+            tile = self.tiles[tile_index]
+            tile.translate_shapes(local, alive_offset[positions])
+            tile.points_item.set_curves(tile.visible_curves())
+        # The shapes of a promoted item only ever move together
+        for path_item in {id(self.promoted[i]): self.promoted[i] for i in indices.tolist() if i in self.promoted}.values():
+            path_item.setPos(*(self.offsets[path_item.shape_indices[0]] - path_item.promoted_offset).tolist())
+
+    def set_deleted(self, indices: np.ndarray, deleted: bool):
+        """Delete shapes, which demotes the items they were promoted to, or bring them back."""
+        self.deleted[indices] = deleted
+        self.demote({id(self.promoted[i]): self.promoted[i] for i in indices.tolist() if i in self.promoted}.values())
+        self._set_tiles_hidden(indices[~np.isin(indices, self._removed_indices())], deleted)
+
+    def remove_shapes(self, indices: Sequence[int], replaced: bool = False):
+        """Stop showing shapes for good and free their geometry in the tiles and in the traced chunks.
+
+        Args:
+            indices (Sequence[int]): shapes to remove, e.g. deletions that can no longer be undone.
+            replaced (bool, optional): the shapes were traced again and dropped from BezierTracing.curves. Otherwise
+                BezierTracing.curves still holds them until take_expired(). Defaults to False.
+        """
+        indices = np.asarray(indices, np.int64)
+        if replaced:
+            self.dropped.update(indices.tolist())
+            self.expired.difference_update(indices.tolist())
+        else:
+            self.expired.update(indices[~np.isin(indices, list(self.dropped))].tolist())
+        indices = np.setdiff1d(indices, self._removed_indices())
+        self.demote({id(self.promoted[i]): self.promoted[i] for i in indices.tolist() if i in self.promoted}.values())
+        for tile_index, _, local in self._by_tile(indices):
+            tile = self.tiles[tile_index]
+            tile.free_shapes(local)
+            tile.points_item.set_curves(tile.visible_curves())
+        # The shapes keep their indices, with no contours left
+        chunks = np.searchsorted(self._chunk_starts, indices, side="right") - 1
+        for chunk in np.unique(chunks).tolist():
+            self._chunks[chunk] = self._chunks[chunk].emptied(indices[chunks == chunk] - self._chunk_starts[chunk])
+        self.removed.update(indices.tolist())
+
+    def take_expired(self) -> np.ndarray:
+        """Hand the shapes deleted beyond undo over to the owner of the trace, which drops them too.
+
+        Returns:
+            np.ndarray: their indices in BezierTracing.curves, for BezierTracing.remove_shapes(). From now on they no
+                longer count in live_indices().
+        """
+        expired = np.array(sorted(self.expired), np.int64)
+        positions = np.searchsorted(self.live_indices(), expired)
+        self.dropped.update(self.expired)
+        self.expired.clear()
+        return positions
+
+    def live_indices(self) -> np.ndarray:
+        """Indices of the shapes that BezierTracing.curves holds, in order: its shape i is shape live_indices()[i].
+
+        Deletions removed beyond undo count until take_expired() hands them over.
+        """
+        alive = np.ones(len(self), bool)
+        alive[list(self.dropped)] = False
+        return np.flatnonzero(alive)
+
+    def replace_shapes(self, removed: np.ndarray, added: CurveStore):
+        """Apply the result of BezierTracing.retrace_region(): remove the shapes it dropped and append the new ones.
+
+        Args:
+            removed (np.ndarray): indices in BezierTracing.curves of the shapes that were traced again.
+            added (CurveStore): their new shapes.
+        """
+        self.remove_shapes(self.live_indices()[removed], replaced=True)
+        self.add_curves(added)
+
+    def footprint(self) -> Dict[str, int]:
+        """Promoted items, and the bytes of the tile geometry, of the traced chunks and of the edit state of every shape."""
+
+        def store_bytes(curves: CurveStore) -> int:
+            return curves.points.nbytes + curves.codes.nbytes + curves.contour_offsets.nbytes + curves.shape_offsets.nbytes
+
+        return {
+            "promoted_items": len(self.promoted_items),
+            "tile_bytes": sum(store_bytes(tile.curves) for tile in self.tiles),
+            "chunk_bytes": sum(store_bytes(chunk) for chunk in self._chunks),
+            "edit_bytes": self.offsets.nbytes + self.deleted.nbytes,
+        }
+
+    def set_points_visible(self, visible: bool):
+        self.points_root.setVisible(visible)
+        for path_item in self.promoted_items:
+            path_item.points_item.setVisible(visible)
+
+    def style_changed(self):
+        """Repaint with the current pen and brush of the style, the tiles a few per frame from the next event on."""
+        for path_item in self.promoted_items:
+            path_item.style_changed()
+        self._stale_tiles = list(self.tiles)
+        self._refresh_timer.start(0)
+
+    def refresh_stale_tiles(self, budget: Optional[float] = REFRESH_BUDGET):
+        """Give the current style to as many stale tiles as rendering them takes budget seconds, or to all of them if budget is None.
+
+        The rendering time per shape is learnt from the tiles refreshed before that have been painted since.
+        Until it is known, one tile is refreshed. Call with None before the scene is rendered outside of the view.
+        """
+        self._refresh_timer.stop()
+        painted = [tile for tile in self._refreshed_tiles if tile.paint_seconds is not None]
+        if painted:
+            self._seconds_per_shape = sum(tile.paint_seconds for tile in painted) / max(1, sum(len(tile.curves) for tile in painted))
+        if budget is None:
+            count = len(self._stale_tiles)
+        elif self._seconds_per_shape is None:
+            count = 1
+        else:
+            shapes = np.cumsum([len(tile.curves) for tile in self._stale_tiles])
+            count = max(1, int(np.searchsorted(shapes, budget / max(self._seconds_per_shape, 1e-9), "right")))
+        self._refreshed_tiles, self._stale_tiles = self._stale_tiles[:count], self._stale_tiles[count:]
+        for tile in self._refreshed_tiles:
+            tile.style_changed()
+        if self._stale_tiles:
+            self._refresh_timer.start(PathStyle.FRAME_INTERVAL)
+
+
+class PromotedShapesItem(CurveTileItem):
+    def __init__(self, curves: CurveStore, indices: np.ndarray, offset: np.ndarray, style: PathStyle, parent: QGraphicsItem = None, color: QColor = None):
+        """Shapes taken out of their tiles to be selected and moved as one item.
+
+        Args:
+            curves (CurveStore): the shapes at their offsets when they were promoted.
+            indices (np.ndarray): indices of the shapes in their BatchedCurvesItem.
+            offset (np.ndarray): offset of the first shape when they were promoted, from which the item position counts.
+            style (PathStyle): pen and brush of the shapes.
+            parent (QGraphicsItem, optional): parent item. Defaults to None.
+            color (QColor, optional): fill color replacing the brush color of style. Defaults to None.
+        """
+        super().__init__(curves, style, parent, color)
+        self.shape_indices = indices
+        self.promoted_offset = offset.copy()
+        self.points_item = None
+        self.setFlags(QGraphicsItem.GraphicsItemFlag.ItemIsSelectable | QGraphicsItem.GraphicsItemFlag.ItemIsMovable)
+
+    def shape(self) -> QPainterPath:
+        shape = QPainterPath(self.path())
+        for path in self.moved_paths():
+            shape = shape.united(path)
+        return shape
+
+    def paint(self, painter: QPainter, option, widget=None):
+        super().paint(painter, option, widget)
+        if self.isSelected():
+            painter.setPen(QPen(QColor(Qt.GlobalColor.black), 0, Qt.PenStyle.DashLine))
+            painter.setBrush(Qt.BrushStyle.NoBrush)
+            painter.drawRect(self._rect)
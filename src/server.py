@@ -0,0 +1,481 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+from backends import POTRACE_BACKENDS, normalized_potrace_parameters
+from batch import preprocess_from_arguments
+from export import LAYER_WRITERS, WRITERS
+from main import BezierTracing
+from preprocess import THRESHOLD_METHODS, Posterize
+
+CONTENT_TYPES = {"svg": "image/svg+xml", "pdf": "application/pdf", "json": "application/json"}
+# Requests with bodies up to this size are traced together, several per trip to a worker process
+DEFAULT_SMALL_BYTES = 256 * 1024
+DEFAULT_MAX_BODY_BYTES = 64 * 1024 * 1024
+# Latencies kept for the percentiles of /stats
+LATENCY_WINDOW = 10000
+MAX_HEADER_LINES = 100
+# Signals that stop serve() and shut the worker processes down
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+_backend = "subprocess"
+
+
+def request_options(query: Dict[str, str]) -> dict:
+    """Trace options of a request from its query parameters, named like the options of batch.py.
+
+    threshold, despeckle and scale set the preprocessing, turdsize, alphamax, opttolerance, turnpolicy and
+    opticurve (0 or 1) the potrace parameters, simplify the tolerance in pixels of the node reduction, format is
+    svg, pdf or json, decimals and merge (0 or 1) shape the output and layers traces that many color layers
+    instead of a threshold. A json output of a simplified trace has its simplification stats.
+
+    Raises:
+        ValueError: for unknown options and invalid values.
+    """
+    query = dict(query)
+    unknown = set(query) - {
+        "threshold",
+        "despeckle",
+        "scale",
+        "turdsize",
+        "alphamax",
+        "opttolerance",
+        "turnpolicy",
+        "opticurve",
+        "simplify",
+        "format",
+        "decimals",
+        "merge",
+        "layers",
+    }
+    if unknown:
+        raise ValueError(f"Unknown options: {', '.join(sorted(unknown))}")
+    threshold = query.get("threshold", "120")
+    if threshold not in THRESHOLD_METHODS:
+        int(threshold)
+    output_format = query.get("format", "svg")
+    if output_format not in CONTENT_TYPES:
+        raise ValueError(f"Unknown format: {output_format}")
+    potrace = {name: convert(query[name]) for name, convert in (("turdsize", int), ("alphamax", float), ("opttolerance", float)) if name in query}
+    if "turnpolicy" in query:
+        potrace["turnpolicy"] = query["turnpolicy"]
+    if "opticurve" in query:
+        potrace["opticurve"] = query["opticurve"] not in ("0", "false")
+    layers = int(query["layers"]) if "layers" in query else None
+    if layers is not None and layers < 2:
+        raise ValueError("layers must be at least 2")
+    simplify = float(query["simplify"]) if "simplify" in query else None
+    if simplify is not None and not simplify >= 0:
+        raise ValueError("simplify must not be negative")
+    return {
+        "preprocess": {"threshold": threshold, "despeckle": int(query.get("despeckle", 1)), "scale": float(query.get("scale", 1.0))},
+        "potrace": normalized_potrace_parameters(potrace),
+        "format": output_format,
+        "export": {"decimals": int(query["decimals"]) if "decimals" in query else None, "merge": query.get("merge", "0") not in ("0", "false")},
+        "layers": layers,
+        "simplify": simplify,
+    }
+
+
+def _json_curves(curves) -> dict:
+    return {name: array.tolist() for name, array in curves.to_arrays().items()}
+
+
+def trace_image(image_data: bytes, options: dict) -> bytes:
+    """Trace encoded image bytes with request_options() and return the output file content. Runs in a worker process."""
+    bezier_tracing = BezierTracing(
+        "request",
+        _backend,
+        preprocess=preprocess_from_arguments(argparse.Namespace(**options["preprocess"])),
+        potrace_parameters=options["potrace"],
+        image_data=image_data,
+        simplify=options["simplify"],
+    )
+    output_format = options["format"]
+    if options["layers"] is not None:
+        # One process per request already, so the layers are not traced in parallel
+        layers = bezier_tracing.trace_layers(Posterize(levels=options["layers"]), workers=1)
+    else:
+        layers = None
+        curves = bezier_tracing.curves
+    width, height = bezier_tracing.image_size
+    if output_format == "json":
+        result = {"width": width, "height": height}
+        if layers is not None:
+            result["layers"] = [dict(color=list(color), **_json_curves(curves)) for color, curves in layers]
+        else:
+            result.update(_json_curves(curves))
+        if bezier_tracing.simplify_stats is not None:
+            result["simplify"] = bezier_tracing.simplify_stats
+        return json.dumps(result).encode("utf-8")
+    extension = "." + output_format
+    output = io.BytesIO() if output_format == "pdf" else io.StringIO()
+    if layers is not None:
+        LAYER_WRITERS[extension](layers, width, height, output, **options["export"])
+    else:
+        WRITERS[extension](curves, width, height, output, **options["export"])
+    data = output.getvalue()
+    return data if isinstance(data, bytes) else data.encode("utf-8")
+
+
+def trace_batch(requests: List[Tuple[bytes, dict]]) -> List[Tuple[bool, bytes, float]]:
+    """Trace several requests in one call of a worker process.
+
+    Returns:
+        List[Tuple[bool, bytes, float]]: per request whether it succeeded, the output or the error message and the
+            trace time in seconds.
+    """
+    results = []
+    for image_data, options in requests:
+        start = time.perf_counter()
+        try:
+            results.append((True, trace_image(image_data, options), time.perf_counter() - start))
+        except Exception as e:
+            results.append((False, str(e).encode("utf-8"), time.perf_counter() - start))
+    return results
+
+
+def warm_worker(backend: str):
+    """Worker process initializer: load the modules and run the potrace executable once on a small image."""
+    global _backend
+    _backend = backend
+    bitmap = np.full((32, 32), 255, np.uint8)
+    bitmap[8:24, 8:24] = 0
+    POTRACE_BACKENDS[backend](bitmap)
+
+
+def percentiles(values, quantiles=(50, 90, 99)) -> dict:
+    """Percentiles in milliseconds of durations in seconds."""
+    if not values:
+        return {}
+    values = np.array(values) * 1000
+    summary = {f"p{q}": float(np.percentile(values, q)) for q in quantiles}
+    summary["max"] = float(values.max())
+    return summary
+
+
+class TraceRequest:
+    def __init__(self, image_data: bytes, options: dict, future: asyncio.Future):
+        self.image_data = image_data
+        self.options = options
+        self.future = future
+        self.received = time.perf_counter()
+        self.queue_seconds = 0.0
+
+
+class TraceServer:
+    def __init__(
+        self,
+        workers: int = None,
+        backend: str = "subprocess",
+        queue_size: int = 64,
+        batch_size: int = 8,
+        batch_window: float = 0.005,
+        small_bytes: int = DEFAULT_SMALL_BYTES,
+        max_body_bytes: int = DEFAULT_MAX_BODY_BYTES,
+    ):
+        """HTTP tracing service on asyncio, tracing in a pool of warm worker processes.
+
+        POST /trace takes the encoded image as the request body and the options of request_options() as query
+        parameters, and answers with the traced file. Nothing is written to disk. Requests wait in a queue of
+        queue_size and are answered with 503 and Retry-After once it is full, so a burst is turned away instead
+        of piling up in memory. Small requests are handed to the workers batch_size at a time, which saves the
+        round trips to the worker processes when many small images come in at once. GET /stats reports the
+        counters and the latency percentiles, GET /health whether the server is up.
+
+        Args:
+            workers (int, optional): worker processes. Defaults to the CPU count.
+            backend (str, optional): potrace backend, one of POTRACE_BACKENDS. Defaults to "subprocess".
+            queue_size (int, optional): requests waiting for a worker before new ones are rejected. Defaults to 64.
+            batch_size (int, optional): small requests traced in one call of a worker. Defaults to 8.
+            batch_window (float, optional): seconds a lone small request waits for others to batch with.
+                Defaults to 0.005.
+            small_bytes (int, optional): largest body that is batched. Defaults to 256 KiB.
+            max_body_bytes (int, optional): largest accepted body, larger ones get 413. Defaults to 64 MiB.
+        """
+        if backend not in POTRACE_BACKENDS:
+            raise ValueError(f"Unknown potrace backend: {backend}")
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.backend = backend
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.small_bytes = small_bytes
+        self.max_body_bytes = max_body_bytes
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.started = None
+        self.counters = {"requests": 0, "traced": 0, "failed": 0, "rejected": 0, "batches": 0, "in_flight": 0}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.queue_latencies = deque(maxlen=LATENCY_WINDOW)
+        self.trace_latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000):
+        """Start the worker processes, wait until all of them are warm and listen on host:port."""
+        loop = asyncio.get_running_loop()
+        self.executor = self._new_executor()
+        # The pool only starts a process when every running one is busy, so keep them all busy at once
+        await asyncio.gather(*(loop.run_in_executor(self.executor, time.sleep, 0.05) for _ in range(self.workers)))
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._dispatcher = loop.create_task(self._dispatch())
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        self.started = time.perf_counter()
+        return self.server
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker, initargs=(self.backend,))
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self._dispatcher.cancel()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        return {
+            **self.counters,
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue_size,
+            "uptime_seconds": elapsed,
+            "throughput": self.counters["traced"] / elapsed if elapsed > 0 else 0.0,
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            "latency_ms": percentiles(self.latencies),
+            "queue_ms": percentiles(self.queue_latencies),
+            "trace_ms": percentiles(self.trace_latencies),
+        }
+
+    async def _dispatch(self):
+        """Take requests off the queue in batches and hand every batch to a free worker."""
+        loop = asyncio.get_running_loop()
+        # Requests only leave the queue for a free worker, so the queue is what fills up under load
+        slots = asyncio.Semaphore(self.workers)
+        pending = None
+        while True:
+            first = pending if pending is not None else await self.queue.get()
+            pending = None
+            await slots.acquire()
+            batch = [first]
+            if len(first.image_data) <= self.small_bytes:
+                if self.queue.qsize() < self.batch_size - 1 and self.batch_window > 0:
+                    await asyncio.sleep(self.batch_window)
+                # A batch is answered when its last request is traced, so take no more than a fair share of the
+                # waiting requests and leave the rest to the other workers
+                limit = min(self.batch_size, -(-(self.queue.qsize() + 1) // self.workers))
+                while len(batch) < limit and not self.queue.empty():
+                    request = self.queue.get_nowait()
+                    if len(request.image_data) > self.small_bytes:
+                        pending = request
+                        break
+                    batch.append(request)
+            task = loop.create_task(self._run_batch(batch))
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _run_batch(self, batch: List[TraceRequest]):
+        loop = asyncio.get_running_loop()
+        now = time.perf_counter()
+        for request in batch:
+            request.queue_seconds = now - request.received
+        self.counters["batches"] += 1
+        self.counters["in_flight"] += len(batch)
+        self.batch_sizes.append(len(batch))
+        executor = self.executor
+        try:
+            results = await loop.run_in_executor(executor, trace_batch, [(request.image_data, request.options) for request in batch])
+        except BrokenProcessPool as e:
+            # A worker process died, e.g. killed for running out of memory, which breaks the whole pool
+            results = [(False, f"Worker failed: {e}".encode("utf-8"), 0.0)] * len(batch)
+            # Every batch in flight on the broken pool fails, only the first one replaces it
+            if self.executor is executor:
+                self.executor = self._new_executor()
+                executor.shutdown(wait=False, cancel_futures=True)
+        finally:
+            self.counters["in_flight"] -= len(batch)
+        for request, result in zip(batch, results):
+            if not request.future.done():
+                request.future.set_result(result)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                except ValueError:
+                    # StreamReader.readline() reports a line longer than its limit as ValueError
+                    self._respond(writer, HTTPStatus.REQUEST_URI_TOO_LONG, b"Request line too long\n", keep_alive=False)
+                    await writer.drain()
+                    break
+                if not request_line:
+                    break
+                keep_alive = await self._handle_request(request_line, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, request_line: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """Answer one request and return whether the connection stays open."""
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            self._respond(writer, HTTPStatus.BAD_REQUEST, b"Malformed request line\n", keep_alive=False)
+            return False
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            try:
+                line = await reader.readline()
+            except ValueError:
+                self._respond(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, b"Header line too long\n", keep_alive=False)
+                return False
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+        url = urlsplit(target)
+
+        if method == "GET" and url.path == "/health":
+            self._respond(writer, HTTPStatus.OK, b"ok\n", keep_alive=keep_alive)
+        elif method == "GET" and url.path == "/stats":
+            self._respond(writer, HTTPStatus.OK, json.dumps(self.stats(), indent=2).encode("utf-8"), "application/json", keep_alive)
+        elif url.path == "/trace":
+            if method != "POST":
+                self._respond(writer, HTTPStatus.METHOD_NOT_ALLOWED, b"POST the image to /trace\n", keep_alive=keep_alive, headers={"Allow": "POST"})
+                return keep_alive
+            if "content-length" not in headers:
+                self._respond(writer, HTTPStatus.LENGTH_REQUIRED, b"Content-Length is required\n", keep_alive=False)
+                return False
+            try:
+                length = int(headers["content-length"])
+            except ValueError:
+                length = -1
+            if length < 0:
+                self._respond(writer, HTTPStatus.BAD_REQUEST, b"Invalid Content-Length\n", keep_alive=False)
+                return False
+            if length > self.max_body_bytes:
+                self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b"Image too large\n", keep_alive=False)
+                return False
+            image_data = await reader.readexactly(length)
+            await self._trace(writer, image_data, dict(parse_qsl(url.query)), keep_alive)
+        else:
+            self._respond(writer, HTTPStatus.NOT_FOUND, b"Not found\n", keep_alive=keep_alive)
+        return keep_alive
+
+    async def _trace(self, writer: asyncio.StreamWriter, image_data: bytes, query: dict, keep_alive: bool):
+        self.counters["requests"] += 1
+        try:
+            options = request_options(query)
+        except ValueError as e:
+            self.counters["failed"] += 1
+            self._respond(writer, HTTPStatus.BAD_REQUEST, f"{e}\n".encode("utf-8"), keep_alive=keep_alive)
+            return
+        request = TraceRequest(image_data, options, asyncio.get_running_loop().create_future())
+        try:
+            self.queue.put_nowait(request)
+        except asyncio.QueueFull:
+            self.counters["rejected"] += 1
+            self._respond(writer, HTTPStatus.SERVICE_UNAVAILABLE, b"Queue full, retry later\n", keep_alive=keep_alive, headers={"Retry-After": "1"})
+            return
+        ok, body, trace_seconds = await request.future
+        if ok:
+            self.counters["traced"] += 1
+            self.latencies.append(time.perf_counter() - request.received)
+            self.queue_latencies.append(request.queue_seconds)
+            self.trace_latencies.append(trace_seconds)
+            self._respond(writer, HTTPStatus.OK, body, CONTENT_TYPES[options["format"]], keep_alive)
+        else:
+            self.counters["failed"] += 1
+            self._respond(writer, HTTPStatus.UNPROCESSABLE_ENTITY, body + b"\n", keep_alive=keep_alive)
+
+    @staticmethod
+    def _respond(
+        writer: asyncio.StreamWriter,
+        status: HTTPStatus,
+        body: bytes,
+        content_type: str = "text/plain; charset=utf-8",
+        keep_alive: bool = True,
+        headers: dict = None,
+    ):
+        lines = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+
+async def serve(server: TraceServer, host: str, port: int):
+    """Run server until SIGTERM or SIGINT, then close it so that its worker processes exit too."""
+    await server.start(host, port)
+    print(f"Listening on http://{host}:{server.port} with {server.workers} workers", flush=True)
+    loop = asyncio.get_running_loop()
+    serving = asyncio.ensure_future(server.server.serve_forever())
+    for signum in STOP_SIGNALS:
+        loop.add_signal_handler(signum, serving.cancel)
+    try:
+        await serving
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for signum in STOP_SIGNALS:
+            loop.remove_signal_handler(signum)
+        await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve traces over HTTP: POST an image to /trace, GET /stats for latency percentiles.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on, 0 picks a free one")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes. Defaults to the CPU count")
+    parser.add_argument("-b", "--backend", choices=sorted(POTRACE_BACKENDS), default="subprocess", help="potrace backend")
+    parser.add_argument("--queue-size", type=int, default=64, help="waiting requests before new ones get 503")
+    parser.add_argument("--batch-size", type=int, default=8, help="small requests traced in one call of a worker")
+    parser.add_argument("--batch-window-ms", type=float, default=5.0, help="time a lone small request waits for others to batch with")
+    parser.add_argument("--small-kb", type=int, default=DEFAULT_SMALL_BYTES // 1024, help="largest request body that is batched, in KiB")
+    parser.add_argument("--max-body-mb", type=int, default=DEFAULT_MAX_BODY_BYTES // (1024 * 1024), help="largest accepted request body, in MiB")
+    args = parser.parse_args()
+
+    server = TraceServer(
+        args.workers,
+        args.backend,
+        args.queue_size,
+        args.batch_size,
+        args.batch_window_ms / 1000,
+        args.small_kb * 1024,
+        args.max_body_mb * 1024 * 1024,
+    )
+    try:
+        asyncio.run(serve(server, args.host, args.port))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+
+from curves import CURVE_TO, CURVE_TO_DATA, LINE_TO, MOVE_TO, CurveStore
+
+# Largest distance in pixels that a simplified segment may stray from the segments it replaces
+DEFAULT_SIMPLIFY_TOLERANCE = 0.5
+# Contours smaller than this in pixels in both directions are dropped, with the holes of an outer contour
+MIN_CONTOUR_SIZE = 1.0
+# Largest angle in degrees between the tangents of two cubic segments at their common point for them to be joined
+DEFAULT_JOIN_ANGLE = 15.0
+# Points sampled inside each of two cubic segments when fitting the one that replaces them
+JOIN_SAMPLES = 5
+MAX_SIMPLIFY_ROUNDS = 32
+
+
+def node_count(curves: CurveStore) -> int:
+    """On-curve points of a store: the start of every contour and the end of every segment."""
+    return int(np.count_nonzero(curves.codes != CURVE_TO_DATA))
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    lengths = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, lengths, out=np.zeros_like(vectors), where=lengths > 0)
+
+
+def _segments(curves: CurveStore) -> Dict[str, np.ndarray]:
+    """The segments of every contour as flat arrays of their start, control and end points."""
+    first = np.flatnonzero((curves.codes == LINE_TO) | (curves.codes == CURVE_TO))
+    is_curve = curves.codes[first] == CURVE_TO
+    points = curves.points
+    return {
+        "contour": np.searchsorted(curves.contour_offsets, first, side="right") - 1,
+        "is_curve": is_curve,
+        "start": points[first - 1],
+        "c1": points[first],
+        "c2": points[np.where(is_curve, first + 1, first)],
+        "end": points[np.where(is_curve, first + 2, first)],
+        "error": np.zeros(len(first)),
+    }
+
+
+def _taken(segments: Dict[str, np.ndarray], indices: np.ndarray) -> Dict[str, np.ndarray]:
+    return {key: segments[key][indices] for key in ("start", "c1", "c2", "end")}
+
+
+def _store(segments: Dict[str, np.ndarray], contour_shapes: np.ndarray) -> CurveStore:
+    """Curve arrays of the segments, with a MOVE_TO opening every contour.
+
+    Args:
+        segments (Dict[str, np.ndarray]): segments of _segments(), ordered by contour.
+        contour_shapes (np.ndarray): shape of every contour that has segments, in order.
+    """
+    contour, is_curve = segments["contour"], segments["is_curve"]
+    if len(contour) == 0:
+        return CurveStore.empty()
+    firsts = np.flatnonzero(np.diff(contour, prepend=-1) != 0)
+    rank = np.cumsum(np.diff(contour, prepend=-1) != 0) - 1
+    lengths = np.where(is_curve, 3, 1)
+    before = np.cumsum(lengths) - lengths
+    positions = before + rank + 1
+    contour_offsets = before[firsts] + np.arange(len(firsts))
+    codes = np.empty(len(firsts) + lengths.sum(), np.uint8)
+    points = np.empty((len(codes), 2))
+    codes[contour_offsets] = MOVE_TO
+    points[contour_offsets] = segments["start"][firsts]
+    lines, cubics = positions[~is_curve], positions[is_curve]
+    codes[lines] = LINE_TO
+    points[lines] = segments["end"][~is_curve]
+    codes[cubics] = CURVE_TO
+    codes[cubics + 1] = CURVE_TO_DATA
+    codes[cubics + 2] = CURVE_TO_DATA
+    points[cubics] = segments["c1"][is_curve]
+    points[cubics + 1] = segments["c2"][is_curve]
+    points[cubics + 2] = segments["end"][is_curve]
+    shape_offsets = np.flatnonzero(np.diff(contour_shapes, prepend=-1) != 0)
+    return CurveStore(codes, points, contour_offsets, shape_offsets)
+
+
+def _line_deviations(start: np.ndarray, middle: np.ndarray, end: np.ndarray) -> np.ndarray:
+    """Distance of every middle point from the line segment between its start and end point."""
+    chord = end - start
+    length2 = np.einsum("ij,ij->i", chord, chord)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.clip(np.einsum("ij,ij->i", middle - start, chord) / length2, 0, 1)
+    t = np.where(length2 > 0, t, 0)
+    return np.linalg.norm(start + t[:, None] * chord - middle, axis=1)
+
+
+def _bernstein(u: np.ndarray) -> Tuple[np.ndarray, ...]:
+    v = 1 - u
+    return v**3, 3 * u * v**2, 3 * u**2 * v, u**3
+
+
+def _cubic_points(weights: Tuple[np.ndarray, ...], p0: np.ndarray, c1: np.ndarray, c2: np.ndarray, p3: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """x and y of every cubic at the parameters of the Bernstein weights, one row per cubic."""
+    return tuple(sum(weight * point[:, axis, None] for weight, point in zip(weights, (p0, c1, c2, p3))) for axis in (0, 1))
+
+
+def _fit_joins(u, x, y, p0, p3, t1, t2) -> Tuple[np.ndarray, np.ndarray]:
+    """Control points of the least squares cubic through the samples of every row, along the given end tangents.
+
+    The linear system of fitting._fit_cubics(), for the same number of samples in every row, so that the sums
+    run over dense (pairs, samples) blocks of x and y instead of the segments of a flat array.
+    """
+    b0, b1, b2, b3 = _bernstein(u)
+    rest_x = x - p0[:, 0, None] * (b0 + b1) - p3[:, 0, None] * (b2 + b3)
+    rest_y = y - p0[:, 1, None] * (b0 + b1) - p3[:, 1, None] * (b2 + b3)
+    c00 = (b1 * b1).sum(axis=1)
+    c01 = (b1 * b2).sum(axis=1) * np.einsum("ij,ij->i", t1, t2)
+    c11 = (b2 * b2).sum(axis=1)
+    x0 = (b1 * (rest_x * t1[:, 0, None] + rest_y * t1[:, 1, None])).sum(axis=1)
+    x1 = (b2 * (rest_x * t2[:, 0, None] + rest_y * t2[:, 1, None])).sum(axis=1)
+    det = c00 * c11 - c01 * c01
+    chord = np.linalg.norm(p3 - p0, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha1 = (x0 * c11 - x1 * c01) / det
+        alpha2 = (c00 * x1 - c01 * x0) / det
+    # Degenerate or backwards fits fall back to control points a third of the chord along the tangents
+    fallback = ~(np.abs(det) > 1e-12) | ~(alpha1 > 1e-6 * chord) | ~(alpha2 > 1e-6 * chord)
+    alpha1 = np.where(fallback, chord / 3, alpha1)
+    alpha2 = np.where(fallback, chord / 3, alpha2)
+    return p0 + alpha1[:, None] * t1, p3 + alpha2[:, None] * t2
+
+
+def _reparameterized(u, x, y, p0, c1, c2, p3) -> np.ndarray:
+    """One Newton step towards the parameter of the point of every row's cubic closest to each sample."""
+    v = 1 - u
+    numerator = denominator = 0
+    for axis, samples in ((0, x), (1, y)):
+        a, b, c, d = (point[:, axis, None] for point in (p0, c1, c2, p3))
+        difference = v**3 * a + 3 * u * v**2 * b + 3 * u**2 * v * c + u**3 * d - samples
+        first = 3 * (v**2 * (b - a) + 2 * u * v * (c - b) + u**2 * (d - c))
+        second = 6 * (v * (c - 2 * b + a) + u * (d - 2 * c + b))
+        numerator = numerator + difference * first
+        denominator = denominator + first * first + difference * second
+    step = np.divide(numerator, denominator, out=np.zeros_like(u), where=np.abs(denominator) > 1e-12)
+    return np.clip(u - step, 0, 1)
+
+
+def _joined_cubics(first: Dict[str, np.ndarray], second: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """One cubic in place of every pair of consecutive cubics, along the outer tangents of the pair.
+
+    Returns:
+        The control points of the joined cubics and the largest distance of the points sampled on the pair from them.
+    """
+    count = len(first["start"])
+    t = np.arange(1, JOIN_SAMPLES + 1) / (JOIN_SAMPLES + 1)
+    inside = [_cubic_points(_bernstein(t[None]), *(segment[key] for key in ("start", "c1", "c2", "end"))) for segment in (first, second)]
+    # Start point, samples of the first cubic, common point, samples of the second cubic, end point
+    x, y = (
+        np.concatenate([first["start"][:, axis, None], inside[0][axis], first["end"][:, axis, None], inside[1][axis], second["end"][:, axis, None]], axis=1)
+        for axis in (0, 1)
+    )
+    # Every sample keeps its parameter on its own cubic, scaled onto the joined one in proportion to the arc lengths
+    arc = np.hypot(np.diff(x, axis=1), np.diff(y, axis=1)).cumsum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        split = np.where(arc[:, -1] > 0, arc[:, JOIN_SAMPLES] / arc[:, -1], 0.5)[:, None]
+    u = np.concatenate([np.zeros((count, 1)), split * t, split, split + (1 - split) * t, np.ones((count, 1))], axis=1)
+    p0, p3 = first["start"], second["end"]
+    # A handle on top of its end point leaves the tangent to the other control point
+    t1 = _normalized(np.where((first["c1"] == p0).all(axis=1)[:, None], first["c2"], first["c1"]) - p0)
+    t2 = _normalized(np.where((second["c2"] == p3).all(axis=1)[:, None], second["c1"], second["c2"]) - p3)
+    c1, c2 = _fit_joins(u, x, y, p0, p3, t1, t2)
+    u = _reparameterized(u, x, y, p0, c1, c2, p3)
+    c1, c2 = _fit_joins(u, x, y, p0, p3, t1, t2)
+    fitted_x, fitted_y = _cubic_points(_bernstein(u), p0, c1, c2, p3)
+    return c1, c2, np.hypot(fitted_x - x, fitted_y - y).max(axis=1)
+
+
+def _tangents_aligned(first: Dict[str, np.ndarray], second: Dict[str, np.ndarray], angle: float) -> np.ndarray:
+    """Whether two consecutive cubics leave their common point in directions at most angle degrees apart."""
+    point = first["end"]
+    incoming = _normalized(np.where((first["c2"] == point).all(axis=1)[:, None], point - first["c1"], point - first["c2"]))
+    outgoing = _normalized(np.where((second["c1"] == point).all(axis=1)[:, None], second["c2"] - point, second["c1"] - point))
+    cosine = np.einsum("ij,ij->i", incoming, outgoing)
+    return cosine >= np.cos(np.radians(angle))
+
+
+def simplify_curves(
+    curves: CurveStore, tolerance: float = DEFAULT_SIMPLIFY_TOLERANCE, min_size: float = MIN_CONTOUR_SIZE, join_angle: float = DEFAULT_JOIN_ANGLE
+) -> Tuple[CurveStore, Dict[str, float]]:
+    """Reduce the nodes of traced curves while keeping them within tolerance pixels of the trace.
+
+    Contours smaller than min_size are dropped, consecutive line segments that are nearly collinear are merged,
+    and consecutive cubics that meet with nearly the same tangent are refitted as one. Every round merges an
+    independent set of the cheapest junctions over all contours at once, and every segment keeps a bound of its
+    distance from the segments it replaced, so merges never add up past the tolerance. The start point of
+    every contour is kept.
+
+    Returns:
+        The simplified store and its stats: nodes before and after, the reduction ratio, the largest deviation
+        in pixels (measured on points sampled along joined cubics) and the number of dropped contours.
+    """
+    nodes_before = node_count(curves)
+    contours = curves.contour_count
+    contour_shapes = np.repeat(np.arange(len(curves)), np.diff(np.append(curves.shape_offsets, contours)))
+
+    bounds = curves.contour_bounds()
+    kept = (bounds[:, 2] - bounds[:, 0] >= min_size) | (bounds[:, 3] - bounds[:, 1] >= min_size)
+    # An outer contour takes its holes along
+    kept &= np.repeat(kept[curves.shape_offsets], np.diff(np.append(curves.shape_offsets, contours)))
+
+    segments = _segments(curves)
+    alive = kept[segments["contour"]]
+    segments = {key: value[alive] for key, value in segments.items()}
+
+    # The merge of every segment with the next one, worked out again only once either of them has changed
+    segments["cost"] = np.full(len(segments["contour"]), np.inf)
+    segments["control"] = np.zeros((len(segments["contour"]), 2, 2))
+    segments["stale"] = np.ones(len(segments["contour"]), bool)
+
+    for _ in range(MAX_SIMPLIFY_ROUNDS):
+        contour, is_curve, error, cost, stale = (segments[key] for key in ("contour", "is_curve", "error", "cost", "stale"))
+        inner = np.append(contour[:-1] == contour[1:], False)
+        cost[stale] = np.inf
+
+        lines = np.flatnonzero(stale & inner & ~is_curve & ~np.roll(is_curve, -1))
+        carried = np.maximum(error[lines], error[lines + 1])
+        cost[lines] = _line_deviations(segments["start"][lines], segments["end"][lines], segments["end"][lines + 1]) + carried
+
+        # A pair that already carries the whole tolerance cannot merge, whatever the fit
+        cubics = np.flatnonzero(stale & inner & is_curve & np.roll(is_curve, -1) & (np.maximum(error, np.roll(error, -1)) < tolerance))
+        cubics = cubics[_tangents_aligned(_taken(segments, cubics), _taken(segments, cubics + 1), join_angle)]
+        if len(cubics):
+            c1, c2, deviation = _joined_cubics(_taken(segments, cubics), _taken(segments, cubics + 1))
+            carried = np.maximum(error[cubics], error[cubics + 1])
+            cost[cubics] = np.where(np.isfinite(c1).all(axis=1) & np.isfinite(c2).all(axis=1), deviation, np.inf) + carried
+            segments["control"][cubics, 0], segments["control"][cubics, 1] = c1, c2
+        stale[:] = False
+
+        # A junction merges when it is cheaper than both neighbours, so no segment takes part in two merges
+        padded = np.concatenate([[np.inf], cost, [np.inf]])
+        merged = (cost <= tolerance) & (cost < padded[:-2]) & (cost <= padded[2:])
+        if not merged.any():
+            break
+        at = np.flatnonzero(merged)
+        curved = at[is_curve[at]]
+        segments["end"][at] = segments["end"][at + 1]
+        error[at] = cost[at]
+        segments["c1"][curved] = segments["control"][curved, 0]
+        segments["c2"][curved] = segments["control"][curved, 1]
+        stale[at] = True
+        stale[at - 1] = True
+        alive = np.ones(len(contour), bool)
+        alive[at + 1] = False
+        segments = {key: value[alive] for key, value in segments.items()}
+
+    with_segments = np.unique(segments["contour"])
+    simplified = _store(segments, contour_shapes[with_segments])
+    nodes_after = node_count(simplified)
+    return simplified, {
+        "nodes_before": nodes_before,
+        "nodes_after": nodes_after,
+        "reduction": 1 - nodes_after / nodes_before if nodes_before else 0.0,
+        "max_deviation": float(segments["error"].max()) if len(segments["error"]) else 0.0,
+        "dropped_contours": contours - len(with_segments),
+    }
+
+
+def combined_stats(stats: Iterable[Dict[str, float]]) -> Dict[str, float]:
+    """Stats of simplify_curves() over several stores, e.g. the layers of an image or the images of a batch."""
+    stats = list(stats)
+    nodes_before = sum(entry["nodes_before"] for entry in stats)
+    nodes_after = sum(entry["nodes_after"] for entry in stats)
+    return {
+        "nodes_before": nodes_before,
+        "nodes_after": nodes_after,
+        "reduction": 1 - nodes_after / nodes_before if nodes_before else 0.0,
+        "max_deviation": max((entry["max_deviation"] for entry in stats), default=0.0),
+        "dropped_contours": sum(entry["dropped_contours"] for entry in stats),
+    }
@@ -0,0 +1,144 @@
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from backends import POTRACE_BACKENDS, normalized_potrace_parameters
+from batch import add_potrace_arguments, add_preprocess_arguments, preprocess_from_arguments
+from curves import CURVE_TO, LINE_TO
+from export import WRITERS
+from main import BezierTracing
+from nesting import nest_curves
+
+# Backends that run the potrace executable, which threads wait for without holding the GIL
+SUBPROCESS_BACKENDS = {"subprocess", "geojson"}
+
+# Arguments of trace_setting() besides the parameters, set once in every worker process by _init_worker()
+_job = None
+
+
+def parameter_grid(values: Dict[str, list]) -> List[dict]:
+    """Every combination of the values of each potrace parameter, e.g. {"turdsize": [0, 2], "alphamax": [1.0]}."""
+    names = list(values)
+    return [normalized_potrace_parameters(dict(zip(names, combination))) for combination in itertools.product(*(values[name] for name in names))]
+
+
+def settings_name(parameters: dict) -> str:
+    name = f"t{parameters['turdsize']}-a{parameters['alphamax']:g}-z{parameters['turnpolicy']}"
+    return name + (f"-O{parameters['opttolerance']:g}" if parameters["opticurve"] else "-n")
+
+
+def trace_setting(backend: str, bitmap: np.ndarray, size: Tuple[int, int], output_stem: str, extension: str, parameters: dict) -> dict:
+    """Trace bitmap with one potrace setting and write the result, see sweep()."""
+    width, height = size
+    start = time.perf_counter()
+    curves = POTRACE_BACKENDS[backend](bitmap, None, parameters)
+    if bitmap.shape[:2] != (height, width):
+        curves = curves.transformed((width / bitmap.shape[1], height / bitmap.shape[0]))
+    curves = nest_curves(curves)
+    seconds = time.perf_counter() - start
+    output_path = f"{output_stem}-{settings_name(parameters)}{extension}"
+    WRITERS[extension](curves, width, height, output_path)
+    return {
+        "parameters": parameters,
+        "output_path": output_path,
+        "shapes": len(curves),
+        "nodes": int(np.count_nonzero((curves.codes == LINE_TO) | (curves.codes == CURVE_TO))),
+        "bytes": os.path.getsize(output_path),
+        "seconds": seconds,
+    }
+
+
+def _init_worker(*job):
+    """Worker process initializer: keep the bitmap and the output settings shared by every setting."""
+    global _job
+    _job = job
+
+
+def _trace_job_setting(parameters: dict) -> dict:
+    return trace_setting(*_job, parameters)
+
+
+def sweep(bezier_tracing: BezierTracing, settings: List[dict], output_dir: str, extension: str = ".svg", workers: int = None) -> List[dict]:
+    """Trace the preprocessed bitmap of bezier_tracing with every potrace setting and write the results.
+
+    The image is read and preprocessed once. The settings are traced workers at a time: in threads that wait
+    for the potrace executable with the subprocess backends, in worker processes with the in-process backends,
+    which hold the GIL, so that the settings do not slow each other down.
+
+    Args:
+        bezier_tracing (BezierTracing): image and preprocessing. Tiling is not supported.
+        settings (List[dict]): potrace parameters, e.g. from parameter_grid().
+        output_dir (str): directory the traced files are written to, named after the image and the setting.
+        extension (str, optional): output format, a key of export.WRITERS. Defaults to ".svg".
+        workers (int, optional): settings traced at once. Defaults to the CPU count.
+
+    Returns:
+        List[dict]: per setting, in order, its parameters, output path, shape count, node count (segment end
+            points), output size in bytes and trace time in seconds including nesting.
+    """
+    if bezier_tracing.tile_size is not None:
+        raise ValueError("Parameter sweeps trace the whole bitmap and cannot be tiled")
+    name = os.path.splitext(os.path.basename(bezier_tracing.image_path))[0]
+    job = (bezier_tracing.backend, bezier_tracing.opencv_image, bezier_tracing.image_size, os.path.join(output_dir, name), extension)
+    if bezier_tracing.backend in SUBPROCESS_BACKENDS:
+        executor, trace = ThreadPoolExecutor(max_workers=workers), partial(trace_setting, *job)
+    else:
+        # The bitmap goes to every worker process once, instead of being pickled with every setting
+        executor, trace = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=job), _trace_job_setting
+    with executor:
+        return list(executor.map(trace, settings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace one image with every combination of the given potrace parameters.")
+    parser.add_argument("image", help="image file")
+    parser.add_argument("-o", "--output-dir", default=None, help="directory for the traced files. Defaults to a temporary directory")
+    parser.add_argument("-f", "--format", choices=["svg", "pdf"], default="svg", help="output format")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="settings traced at once. Defaults to the CPU count")
+    parser.add_argument("-b", "--backend", choices=sorted(POTRACE_BACKENDS), default="subprocess", help="potrace backend")
+    add_preprocess_arguments(parser)
+    add_potrace_arguments(parser, nargs="+")
+    args = parser.parse_args()
+
+    settings = parameter_grid(
+        {
+            "turdsize": args.turdsize,
+            "alphamax": args.alphamax,
+            "opttolerance": args.opttolerance,
+            "turnpolicy": args.turnpolicy,
+            "opticurve": [not args.no_opticurve],
+        }
+    )
+    bezier_tracing = BezierTracing(args.image, args.backend, preprocess=preprocess_from_arguments(args))
+    with tempfile.TemporaryDirectory() as directory:
+        output_dir = args.output_dir if args.output_dir is not None else directory
+        os.makedirs(output_dir, exist_ok=True)
+        start = time.perf_counter()
+        try:
+            results = sweep(bezier_tracing, settings, output_dir, "." + args.format, args.jobs)
+        except Exception as e:
+            print(f"Failed to sweep {args.image}: {e}", file=sys.stderr)
+            sys.exit(1)
+        elapsed = time.perf_counter() - start
+
+    print(f"{'turdsize':>8} {'alphamax':>8} {'opttol':>7} {'turnpolicy':>10} {'shapes':>7} {'nodes':>8} {'KB':>8} {'trace ms':>9}")
+    for result in results:
+        parameters = result["parameters"]
+        opttolerance = f"{parameters['opttolerance']:g}" if parameters["opticurve"] else "off"
+        print(
+            f"{parameters['turdsize']:>8} {parameters['alphamax']:>8g} {opttolerance:>7} {parameters['turnpolicy']:>10} "
+            f"{result['shapes']:>7} {result['nodes']:>8} {result['bytes'] / 1024:>8.1f} {result['seconds'] * 1000:>9.1f}"
+        )
+    print(f"Traced {len(results)} settings in {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+import io
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+import profiling
+from backends import TraceCancelled
+from curves import CURVE_TO, CURVE_TO_DATA, LINE_TO, MOVE_TO, CurveStore
+from preprocess import PreprocessPipeline
+
+DEFAULT_TILE_SIZE = 2048
+DEFAULT_TILE_OVERLAP = 64
+# Channels of the binary PNM formats that can be memory mapped
+PNM_CHANNELS = {b"P5": 1, b"P6": 3}
+# Points sampled on every segment of a shape crossing a seam to find where it crosses
+SEAM_SAMPLES = 16
+# Halvings of the sampling interval that locate a crossing, to well below float precision of a pixel coordinate
+SEAM_BISECTIONS = 40
+# Largest distance of a chain end from the seam it was cut at (px)
+SEAM_TOLERANCE = 1e-6
+# Largest gap between a chain end and the start of the chain of the neighbouring tile that continues it (px)
+SEAM_LINK_TOLERANCE = 1.0
+# Contours joined from seam chains that are narrower than this in x or y (px), or have less area than its
+# square, are slivers of an outline that one tile fitted a hair across the seam
+SLIVER_SIZE = 1e-2
+
+
+def _read_pnm_header(f) -> Tuple[bytes, int, int, int]:
+    """Read a PNM header and return (magic, width, height, maxval), leaving f at the first pixel byte."""
+    magic = f.read(2)
+    fields = []
+    while len(fields) < 3:
+        c = f.read(1)
+        if not c:
+            raise ValueError("Truncated PNM header")
+        if c == b"#":
+            f.readline()
+        elif not c.isspace():
+            token = c
+            while True:
+                c = f.read(1)
+                if not c or c.isspace():
+                    break
+                token += c
+            fields.append(int(token))
+    return (magic, *fields)
+
+
+def decode_image(buffer) -> Optional[np.ndarray]:
+    """Decode an encoded image held in memory, e.g. a memory mapped file, to 8-bit gray or BGR.
+
+    8-bit binary PGM is not decoded at all: the array is a read-only view of the pixels in buffer. Other formats
+    are decoded by OpenCV straight from buffer, gray images to one channel. Returns None if decoding fails.
+    """
+    if bytes(buffer[:2]) == b"P5":
+        f = buffer if isinstance(buffer, mmap.mmap) else io.BytesIO(buffer)
+        f.seek(0)
+        _, width, height, maxval = _read_pnm_header(f)
+        if maxval < 256 and len(buffer) >= f.tell() + width * height:
+            return np.frombuffer(buffer, np.uint8, count=width * height, offset=f.tell()).reshape(height, width)
+    return cv2.imdecode(np.frombuffer(buffer, np.uint8), cv2.IMREAD_ANYCOLOR)
+
+
+def open_tile_source(image_path: Union[str, bytes]) -> np.ndarray:
+    """Image as an array that tiles are sliced from.
+
+    Encoded image bytes are decoded whole to grayscale. Binary 8-bit PGM/PPM files are memory mapped, so only the rows of the tiles being traced are paged in.
+    OpenCV cannot decode a region of the compressed formats, so those are decoded whole, but to grayscale
+    to keep it to one byte per pixel.
+    """
+    if isinstance(image_path, (bytes, bytearray, memoryview)):
+        source = cv2.imdecode(np.frombuffer(image_path, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if source is None:
+            raise ValueError("Failed to decode image data")
+        return source
+    with open(image_path, mode="rb") as f:
+        if f.read(2) in PNM_CHANNELS:
+            f.seek(0)
+            magic, width, height, maxval = _read_pnm_header(f)
+            offset = f.tell()
+        else:
+            maxval = None
+    if maxval is not None and maxval < 256:
+        channels = PNM_CHANNELS[magic]
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        source = np.memmap(image_path, dtype=np.uint8, mode="r", offset=offset, shape=shape)
+        # PPM is RGB, the preprocess stages expect OpenCV's BGR
+        return source if channels == 1 else source[:, :, ::-1]
+    source = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if source is None:
+        raise ValueError(f"Failed to read image: {image_path}")
+    return source
+
+
+def tile_grid(width: int, height: int, tile_size: int) -> List[Tuple[int, int, int, int]]:
+    """Row-major (x0, y0, x1, y1) tiles that cover the image without overlapping."""
+    return [(x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height)) for y0 in range(0, height, tile_size) for x0 in range(0, width, tile_size)]
+
+
+def _segments(shape: CurveStore) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Segments of every contour of a shape, including the line that closes it, in order.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: S x 4 x 2 cubic control points (a line has its control points
+            at its thirds), whether each segment is a line, and the contour of each segment.
+    """
+    codes, points = shape.codes, shape.points
+    contours = np.repeat(np.arange(shape.contour_count), shape.contour_ends - shape.contour_offsets)
+    lines, curves = np.flatnonzero(codes == LINE_TO), np.flatnonzero(codes == CURVE_TO)
+    # Contours whose last point is not their first are closed by a line
+    last = shape.contour_ends - 1
+    closing = np.flatnonzero(np.any(points[last] != points[shape.contour_offsets], axis=1))
+    line_ends = np.concatenate([points[lines], points[shape.contour_offsets[closing]]])
+    line_starts = np.concatenate([points[lines - 1], points[last[closing]]])
+    line_controls = line_starts[:, None] + (line_ends - line_starts)[:, None] * (np.arange(4) / 3)[:, None]
+    curve_controls = np.stack([points[curves - 1], points[curves], points[curves + 1], points[curves + 2]], axis=1)
+    # Sorted by element, the closing line after the last element of its contour
+    keys = np.concatenate([lines, last[closing] + 0.5, curves])
+    order = np.argsort(keys, kind="stable")
+    controls = np.concatenate([line_controls, curve_controls]).reshape(-1, 4, 2)[order]
+    is_line = np.repeat([True, False], [len(line_ends), len(curves)])[order]
+    segment_contours = np.concatenate([contours[lines], closing, contours[curves]])[order]
+    return controls, is_line, segment_contours
+
+
+def _bezier(controls: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """Points at parameters t (S x T) of the cubics with S x 4 x 2 controls."""
+    t = t[..., None]
+    p0, p1, p2, p3 = (controls[:, i, None] for i in range(4))
+    return (1 - t) ** 3 * p0 + 3 * (1 - t) ** 2 * t * p1 + 3 * (1 - t) * t**2 * p2 + t**3 * p3
+
+
+def _bezier_derivative(controls: np.ndarray, t: np.ndarray) -> np.ndarray:
+    t = t[..., None]
+    p0, p1, p2, p3 = (controls[:, i, None] for i in range(4))
+    return 3 * (1 - t) ** 2 * (p1 - p0) + 6 * (1 - t) * t * (p2 - p1) + 3 * t**2 * (p3 - p2)
+
+
+def _clip_shape(shape: CurveStore, clip_lines: List[Tuple[int, float, bool]]) -> Tuple[list, list]:
+    """Cut a shape at the seams of a tile core and keep what lies inside the core.
+
+    A point on a seam belongs to the tile the seam starts, so an edge along a seam is kept by exactly one tile.
+
+    Args:
+        shape (CurveStore): a single shape.
+        clip_lines (List[Tuple[int, float, bool]]): (axis, coordinate, whether the core lies at or above it) of
+            every seam around the core.
+
+    Returns:
+        Tuple[list, list]: (codes, points) chains of outline that begin and end on a seam, each beginning with a
+            MOVE_TO, and (codes, points) contours that lie entirely inside.
+    """
+    controls, is_line, contours = _segments(shape)
+
+    def inside(p: np.ndarray) -> np.ndarray:
+        result = np.ones(p.shape[:-1], bool)
+        for axis, coordinate, above in clip_lines:
+            result &= (p[..., axis] >= coordinate) == above
+        return result
+
+    # Parameters where the segments cross a seam: sampled, then bisected on the seam coordinate of the cubic
+    samples = np.linspace(0.0, 1.0, SEAM_SAMPLES + 1)
+    sampled = _bezier(controls, np.broadcast_to(samples, (len(controls), len(samples))))
+    crossings = []
+    for axis, coordinate, above in clip_lines:
+        side = (sampled[..., axis] >= coordinate) == above
+        segments, intervals = np.nonzero(side[:, 1:] != side[:, :-1])
+        crossings.append((segments, intervals, np.full(len(segments), axis), np.full(len(segments), coordinate), np.full(len(segments), above)))
+    cut_segments, intervals, cut_axes, cut_coordinates, cut_above = (np.concatenate(arrays) for arrays in zip(*crossings))
+    q0, q1, q2, q3 = controls[cut_segments, :, cut_axes].T
+    # Power basis of the seam coordinate relative to the seam
+    c3, c2, c1, c0 = q3 - q0 + 3 * (q1 - q2), 3 * (q0 + q2) - 6 * q1, 3 * (q1 - q0), q0 - cut_coordinates
+    low, high = samples[intervals], samples[intervals + 1]
+    low_side = (((c3 * low + c2) * low + c1) * low + c0 >= 0) == cut_above
+    for _ in range(SEAM_BISECTIONS):
+        middle = (low + high) / 2
+        same = ((((c3 * middle + c2) * middle + c1) * middle + c0 >= 0) == cut_above) == low_side
+        low, high = np.where(same, middle, low), np.where(same, high, middle)
+    cut_params = (low + high) / 2
+    # A crossing at the very end of a segment is its end point
+    keep = (cut_params > 1e-9) & (cut_params < 1 - 1e-9)
+    cut_segments, cut_params, cut_axes, cut_coordinates = cut_segments[keep], cut_params[keep], cut_axes[keep], cut_coordinates[keep]
+    count = len(controls)
+    # Break points of every segment: its ends and its crossings, the seam a crossing is snapped onto or -1
+    segments = np.concatenate([np.arange(count), np.arange(count), cut_segments])
+    params = np.concatenate([np.zeros(count), np.ones(count), cut_params])
+    axes = np.concatenate([np.full(2 * count, -1), cut_axes])
+    coordinates = np.concatenate([np.zeros(2 * count), cut_coordinates])
+    order = np.lexsort((params, segments))
+    segments, params, axes, coordinates = segments[order], params[order], axes[order], coordinates[order]
+    # Pieces between consecutive break points of the same segment
+    first = np.flatnonzero(segments[1:] == segments[:-1])
+    piece_segments = segments[first]
+    a, b = params[first], params[first + 1]
+    piece_controls = controls[piece_segments]
+    ends = _bezier(piece_controls, np.stack([a, b], axis=1))
+    tangents = _bezier_derivative(piece_controls, np.stack([a, b], axis=1)) * ((b - a) / 3)[:, None, None]
+    for k, break_point in enumerate((first, first + 1)):
+        snapped = axes[break_point] >= 0
+        ends[np.flatnonzero(snapped), k, axes[break_point][snapped]] = coordinates[break_point][snapped]
+    pieces = np.stack([ends[:, 0], ends[:, 0] + tangents[:, 0], ends[:, 1] - tangents[:, 1], ends[:, 1]], axis=1)
+    piece_lines = is_line[piece_segments]
+    piece_inside = inside(_bezier(piece_controls, ((a + b) / 2)[:, None])[:, 0])
+    piece_contours = contours[piece_segments]
+
+    # Elements of every piece: the end of a line, the three points of a cubic
+    piece_codes = np.tile(np.array([CURVE_TO, CURVE_TO_DATA, CURVE_TO_DATA], np.uint8), (len(pieces), 1))
+    piece_codes[piece_lines, 0] = LINE_TO
+    element_mask = np.ones((len(pieces), 3), bool)
+    element_mask[piece_lines, 1:] = False
+    piece_points = pieces[:, 1:].copy()
+    piece_points[piece_lines, 0] = pieces[piece_lines, 3]
+    element_codes, element_points = piece_codes[element_mask], piece_points[element_mask]
+    element_counts = element_mask.sum(axis=1)
+    element_offsets = np.cumsum(element_counts) - element_counts
+
+    chains, closed = [], []
+    contour_starts = np.searchsorted(piece_contours, np.arange(shape.contour_count))
+    contour_ends = np.append(contour_starts[1:], len(pieces))
+    for contour, (start, end) in enumerate(zip(contour_starts.tolist(), contour_ends.tolist())):
+        kept = piece_inside[start:end]
+        if not kept.any():
+            continue
+        if kept.all():
+            closed.append(shape.contour(contour))
+            continue
+        # Rotate so that the contour begins with the first kept piece after one that is not
+        n = end - start
+        first_kept = int(np.flatnonzero(kept & ~np.roll(kept, 1))[0])
+        order = (np.arange(n) + first_kept) % n
+        runs = np.split(order, np.flatnonzero(np.diff(kept[order].astype(np.int8)) != 0) + 1)
+        for run in runs:
+            if not kept[run[0]]:
+                continue
+            run = run + start
+            counts = element_counts[run]
+            elements = np.repeat(element_offsets[run] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+            codes = np.concatenate([[MOVE_TO], element_codes[elements]]).astype(np.uint8)
+            chains.append((codes, np.concatenate([pieces[run[:1], 0], element_points[elements]])))
+    return chains, closed
+
+
+def _trace_tile(
+    source: np.ndarray,
+    core: Tuple[int, int, int, int],
+    overlap: int,
+    preprocess: PreprocessPipeline,
+    trace: Callable,
+    nest: Callable[[CurveStore], CurveStore],
+    cancel_event: threading.Event,
+) -> Tuple[CurveStore, List[Tuple[list, list]]]:
+    """Trace the tile core plus its overlap and keep what lies inside the core.
+
+    Returns:
+        Tuple[CurveStore, List[Tuple[list, list]]]: shapes entirely inside the core, and the (chains, closed
+            contours) that _clip_shape() kept of every shape that crosses a seam.
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise TraceCancelled()
+    height, width = source.shape[:2]
+    x0, y0, x1, y1 = core
+    px0, py0, px1, py1 = max(0, x0 - overlap), max(0, y0 - overlap), min(width, x1 + overlap), min(height, y1 + overlap)
+    with profiling.stage("preprocess"):
+        bitmap = preprocess.run(np.ascontiguousarray(source[py0:py1, px0:px1]))
+    curves = trace(bitmap, cancel_event).transformed(((px1 - px0) / bitmap.shape[1], (py1 - py0) / bitmap.shape[0]), (px0, py0))
+    with profiling.stage("nesting"):
+        shapes = nest(curves)
+
+    # Only seams are clipped at. Curve control points may stick out of the image border.
+    sides = [(0, x0, True, x0 > 0), (1, y0, True, y0 > 0), (0, x1, False, x1 < width), (1, y1, False, y1 < height)]
+    clip_lines = [(axis, float(coordinate), above) for axis, coordinate, above, seam in sides if seam]
+    cx0, cy0 = (x0 if x0 > 0 else -np.inf), (y0 if y0 > 0 else -np.inf)
+    cx1, cy1 = (x1 if x1 < width else np.inf), (y1 if y1 < height else np.inf)
+    bx0, by0, bx1, by1 = shapes.shape_bounds().T
+    # Shapes outside the core are traced again by the tile that owns them
+    outside = (bx1 <= cx0) | (bx0 >= cx1) | (by1 <= cy0) | (by0 >= cy1)
+    inside = (bx0 >= cx0) & (bx1 <= cx1) & (by0 >= cy0) & (by1 <= cy1)
+    pieces = []
+    for i in np.flatnonzero(~outside & ~inside).tolist():
+        chains, closed = _clip_shape(shapes.shape(i), clip_lines)
+        if chains or closed:
+            pieces.append((chains, closed))
+    return shapes.take(np.flatnonzero(inside)), pieces
+
+
+def _is_sliver(codes: np.ndarray, points: np.ndarray) -> bool:
+    """Whether a contour is narrower than SLIVER_SIZE in x or y or has less area than its square."""
+    if np.ptp(points, axis=0).min() < SLIVER_SIZE:
+        return True
+    x, y = CurveStore(codes, points, np.zeros(1, np.int64)).contour_polygon(0).T
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2 < SLIVER_SIZE**2
+
+
+def _stitch(tile_pieces: List[List[Tuple[list, list]]], seams: List[Tuple[int, float]], nest: Callable[[CurveStore], CurveStore]) -> CurveStore:
+    """Join the pieces that clipping cut out of shapes crossing seams back into whole shapes.
+
+    Every chain of outline that ends at a seam is continued by the chain of the neighbouring tile that starts
+    closest to that point on the same seam. Both tiles fit the outline with the same surroundings, so these
+    points are within SEAM_LINK_TOLERANCE of each other. Joined contours that are slivers along a seam are
+    dropped, and the rest are grouped into shapes with nest, together with the contours that clipping kept
+    whole, e.g. a hole inside a core whose outer contour crosses a seam.
+
+    Raises:
+        ValueError: if a chain ends off the seams or no chain continues it, i.e. the tiles disagree about
+            the outline beyond the tolerance.
+    """
+    pieces = [piece for tile_piece_list in tile_pieces for piece in tile_piece_list]
+    chains = [chain for piece_chains, _ in pieces for chain in piece_chains]
+    contours = [contour for _, closed in pieces for contour in closed]
+
+    ends = np.array([points[-1] for _, points in chains]).reshape(-1, 2)
+    starts = np.array([points[0] for _, points in chains]).reshape(-1, 2)
+    # The seams every chain end and start lies on, more than one at a corner of the tiles
+    axes = np.array([axis for axis, _ in seams], np.int64)
+    coordinates = np.array([coordinate for _, coordinate in seams], np.float64)
+    end_seams = np.abs(ends[:, axes] - coordinates) <= SEAM_TOLERANCE
+    start_seams = np.abs(starts[:, axes] - coordinates) <= SEAM_TOLERANCE
+    for points, on_seams in ((ends, end_seams), (starts, start_seams)):
+        off = np.flatnonzero(~on_seams.any(axis=1))
+        if len(off):
+            x, y = points[off[0]]
+            raise ValueError(f"Failed to stitch tiles: an outline was cut off the seams at ({x:.2f}, {y:.2f})")
+
+    # Greedily link every chain end to the nearest free chain start on the same seam
+    cells = {}
+    for j, cell in enumerate(map(tuple, np.floor(starts / SEAM_LINK_TOLERANCE).astype(np.int64).tolist())):
+        cells.setdefault(cell, []).append(j)
+    candidates = []
+    for i, (cx, cy) in enumerate(np.floor(ends / SEAM_LINK_TOLERANCE).astype(np.int64).tolist()):
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for j in cells.get((cx + dx, cy + dy), ()):
+                    distance = float(np.hypot(*(ends[i] - starts[j])))
+                    if distance <= SEAM_LINK_TOLERANCE and (end_seams[i] & start_seams[j]).any():
+                        candidates.append((distance, i, j))
+    following = np.full(len(chains), -1)
+    free = np.ones(len(chains), bool)
+    for _, i, j in sorted(candidates):
+        if following[i] < 0 and free[j]:
+            following[i] = j
+            free[j] = False
+    unlinked = np.flatnonzero(following < 0)
+    if len(unlinked):
+        x, y = ends[unlinked[0]]
+        raise ValueError(
+            f"Failed to stitch tiles: no outline continues the one ending at ({x:.2f}, {y:.2f}) within {SEAM_LINK_TOLERANCE:g} px, "
+            "trace with a larger tile overlap"
+        )
+
+    visited = np.zeros(len(chains), bool)
+    for first in range(len(chains)):
+        if visited[first]:
+            continue
+        cycle, i = [], first
+        while not visited[i]:
+            visited[i] = True
+            cycle.append(i)
+            i = following[i]
+        codes = [chains[i][0] for i in cycle]
+        # Every chain after the first is joined to the end of the previous one with a line
+        codes = [codes[0]] + [np.concatenate([[LINE_TO], chain_codes[1:]]).astype(np.uint8) for chain_codes in codes[1:]]
+        contour = (np.concatenate(codes), np.concatenate([chains[i][1] for i in cycle]))
+        if not _is_sliver(*contour):
+            contours.append(contour)
+
+    if not contours:
+        return CurveStore.empty()
+    lengths = np.array([len(codes) for codes, _ in contours])
+    curves = CurveStore(
+        np.concatenate([codes for codes, _ in contours]),
+        np.concatenate([points for _, points in contours]),
+        np.cumsum(lengths) - lengths,
+    )
+    return nest(curves)
+
+
+def trace_tiled(
+    source: np.ndarray,
+    trace: Callable,
+    preprocess: PreprocessPipeline,
+    nest: Callable[[CurveStore], CurveStore],
+    tile_size: int = DEFAULT_TILE_SIZE,
+    overlap: int = DEFAULT_TILE_OVERLAP,
+    workers: int = None,
+    cancel_event: threading.Event = None,
+) -> CurveStore:
+    """Trace an image tile by tile and stitch the shapes that cross tile seams.
+
+    Every tile is traced with an overlap margin, so curves near a seam are fitted with their surroundings,
+    and is then clipped to its own core. The outlines of shapes that were clipped are joined with the matching
+    pieces of the neighbouring tiles. Only `workers` tiles and their bitmaps are in memory at a time.
+
+    Thresholds computed from the image content (otsu) are computed per tile. Adaptive thresholds match an
+    untiled trace as long as their block size is smaller than the overlap.
+
+    Args:
+        source (np.ndarray): image, e.g. from open_tile_source().
+        trace (Callable): a POTRACE_BACKENDS function.
+        preprocess (PreprocessPipeline): turns a tile into its bitmap. Copied for every tile.
+        nest (Callable[[CurveStore], CurveStore]): groups the traced contours of a tile into filled shapes.
+        tile_size (int, optional): edge length of a tile core in image pixels. Defaults to DEFAULT_TILE_SIZE.
+        overlap (int, optional): margin traced around every core. Defaults to DEFAULT_TILE_OVERLAP.
+        workers (int, optional): tiles traced at once. Defaults to the CPU count.
+        cancel_event (threading.Event, optional): stops the trace with TraceCancelled when set. Defaults to None.
+
+    Returns:
+        CurveStore: filled shapes in image coordinates, ordered by their left edge.
+
+    Raises:
+        ValueError: if the tiles disagree about an outline at a seam, which a larger overlap avoids.
+    """
+    height, width = source.shape[:2]
+    tiles = tile_grid(width, height, tile_size)
+    workers = min(workers or os.cpu_count() or 1, len(tiles))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_trace_tile, source, core, overlap, preprocess.copy(), trace, nest, cancel_event) for core in tiles]
+        try:
+            results = [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    seams = [(0, float(x0)) for x0 in sorted({x0 for x0, _, _, _ in tiles} - {0})]
+    seams += [(1, float(y0)) for y0 in sorted({y0 for _, y0, _, _ in tiles} - {0})]
+    curves = CurveStore.concatenate([inner for inner, _ in results])
+    if any(pieces for _, pieces in results):
+        with profiling.stage("stitch"):
+            stitched = _stitch([pieces for _, pieces in results], seams, nest)
+        curves = CurveStore.concatenate([curves, stitched])
+    return curves.take(np.argsort(curves.shape_bounds()[:, 0], kind="stable"))
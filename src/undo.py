@@ -0,0 +1,98 @@
+import os
+from typing import Dict, Sequence
+
+import numpy as np
+from PyQt6.QtCore import pyqtSignal
+from PyQt6.QtGui import QUndoCommand, QUndoStack
+
+# Set to the number of edits that can be undone, 0 for no limit
+UNDO_DEPTH_ENV = "PYQT_POTRACE_UNDO_DEPTH"
+DEFAULT_UNDO_DEPTH = 100
+
+MOVE_COMMAND_ID = 1
+
+
+class ShapesMoveCommand(QUndoCommand):
+    def __init__(self, batch, indices: Sequence[int], offset: np.ndarray):
+        """Move of traced shapes, by one (dx, dy) for all of them or by one row per shape.
+
+        Consecutive moves of the same shapes merge into a single step.
+        """
+        super().__init__(f"Move {len(indices)} shapes")
+        self.batch = batch
+        self.indices = np.asarray(indices, np.int64)
+        self.offset = np.asarray(offset, np.float64)
+
+    @property
+    def nbytes(self) -> int:
+        return self.indices.nbytes + self.offset.nbytes
+
+    def id(self) -> int:
+        return MOVE_COMMAND_ID
+
+    def mergeWith(self, other: QUndoCommand) -> bool:
+        if not isinstance(other, ShapesMoveCommand) or other.batch is not self.batch or not np.array_equal(other.indices, self.indices):
+            return False
+        self.offset = self.offset + other.offset
+        return True
+
+    def undo(self):
+        self.batch.move_shapes(self.indices, -self.offset)
+
+    def redo(self):
+        self.batch.move_shapes(self.indices, self.offset)
+
+    def expire(self):
+        pass
+
+
+class ShapesDeleteCommand(QUndoCommand):
+    def __init__(self, batch, indices: Sequence[int]):
+        super().__init__(f"Delete {len(indices)} shapes")
+        self.batch = batch
+        self.indices = np.asarray(indices, np.int64)
+
+    @property
+    def nbytes(self) -> int:
+        return self.indices.nbytes
+
+    def undo(self):
+        self.batch.set_deleted(self.indices, False)
+
+    def redo(self):
+        self.batch.set_deleted(self.indices, True)
+
+    def expire(self):
+        # Out of reach of undo: the geometry of the shapes can go
+        self.batch.remove_shapes(self.indices.tolist())
+
+
+class EditHistory(QUndoStack):
+    # Emitted once the oldest command fell off the stack and was made permanent
+    expired = pyqtSignal()
+
+    def __init__(self, depth: int = None, parent=None):
+        """Undo stack of shape edits which keeps the last `depth` of them.
+
+        The edit that falls off the bottom of the stack is made permanent, so a deletion frees its shapes.
+
+        Args:
+            depth (int, optional): number of edits that can be undone, 0 for no limit. Defaults to $PYQT_POTRACE_UNDO_DEPTH or DEFAULT_UNDO_DEPTH.
+        """
+        super().__init__(parent)
+        if depth is None:
+            depth = int(os.environ.get(UNDO_DEPTH_ENV, DEFAULT_UNDO_DEPTH))
+        self.setUndoLimit(depth)
+
+    def push(self, command: QUndoCommand):
+        # A full stack drops its oldest command to make room, unless every command was undone and is discarded
+        oldest = self.command(0) if self.undoLimit() and self.index() == self.undoLimit() else None
+        super().push(command)
+        if oldest is not None and self.command(0) is not oldest:
+            oldest.expire()
+            self.expired.emit()
+
+    def footprint(self) -> Dict[str, int]:
+        """Number of commands on the stack and the bytes of the index and offset arrays they hold."""
+        commands = [self.command(i) for i in range(self.count())]
+        return {"commands": len(commands), "bytes": sum(command.nbytes for command in commands)}
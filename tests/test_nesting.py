@@ -0,0 +1,28 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from curves import LINE_TO, MOVE_TO, CurveStore  # noqa: E402
+from nesting import nest_curves  # noqa: E402
+
+SQUARE = [(0, 0), (10, 0), (10, 10), (0, 10)]
+# Inscribed in SQUARE, so both have the same bounding box
+DIAMOND = [(5, 0), (10, 5), (5, 10), (0, 5)]
+ISLAND = [(4, 4), (6, 4), (6, 6), (4, 6)]
+
+
+def polygons(contours) -> CurveStore:
+    codes = [MOVE_TO] + [LINE_TO] * 3
+    return CurveStore(np.array(codes * len(contours), np.uint8), np.array(sum(contours, []), np.float64), np.arange(0, 4 * len(contours), 4), np.array([0]))
+
+
+@pytest.mark.parametrize("contours", [[SQUARE, DIAMOND, ISLAND], [DIAMOND, SQUARE, ISLAND], [ISLAND, DIAMOND, SQUARE]])
+def test_equal_boxes_nest_by_containment(contours):
+    shapes = nest_curves(polygons(contours))
+    # The square with the diamond as its hole, and the island filled again
+    assert np.diff(np.append(shapes.shape_offsets, shapes.contour_count)).tolist() == [2, 1]
+    assert shapes.points[shapes.contour_offsets].tolist() == [[0, 0], [5, 0], [4, 4]]
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from curves import CURVE_TO, CURVE_TO_DATA, LINE_TO, MOVE_TO  # noqa: E402
+from main import BezierTracing  # noqa: E402
+from nesting import nest_curves  # noqa: E402
+from tiling import _stitch  # noqa: E402
+
+
+@pytest.fixture
+def square_with_hole(tmp_path):
+    """A black square crossing several seams, with a round hole inside the core of one tile."""
+    image = np.full((700, 700), 255, np.uint8)
+    cv2.rectangle(image, (50, 50), (650, 650), 0, -1)
+    cv2.circle(image, (350, 350), 30, 255, -1)
+    path = str(tmp_path / "square.png")
+    cv2.imwrite(path, image)
+    return path
+
+
+def test_hole_inside_a_tile_stays_with_its_shape(square_with_hole):
+    untiled = BezierTracing(square_with_hole, "fitter").curves
+    tiled = BezierTracing(square_with_hole, "fitter", tile_size=200, tile_overlap=16).curves
+    assert len(untiled) == len(tiled) == 1
+    assert tiled.contour_count == 2
+    # The outer contour first, the hole second
+    np.testing.assert_allclose(tiled.contour_bounds(), untiled.contour_bounds(), atol=1.0)
+
+
+def test_stitch_rejects_chains_that_do_not_meet():
+    # Two halves of an outline cut at x=100, whose ends on the seam are 5 px apart
+    left = (np.array([MOVE_TO, LINE_TO, LINE_TO], np.uint8), np.array([[100.0, 10.0], [50.0, 30.0], [100.0, 50.0]]))
+    right = (np.array([MOVE_TO, CURVE_TO, CURVE_TO_DATA, CURVE_TO_DATA], np.uint8), np.array([[100.0, 55.0], [150.0, 50.0], [150.0, 10.0], [100.0, 10.0]]))
+    with pytest.raises(ValueError, match="larger tile overlap"):
+        _stitch([[([left], [])], [([right], [])]], [(0, 100.0)], nest_curves)
+    right[1][0] = [100.0, 50.0]
+    stitched = _stitch([[([left], [])], [([right], [])]], [(0, 100.0)], nest_curves)
+    assert len(stitched) == 1 and stitched.contour_count == 1
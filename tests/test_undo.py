@@ -0,0 +1,102 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtCore import QRectF, Qt  # noqa: E402
+from PyQt6.QtGui import QBrush, QColor, QImage, QPainter, QPen  # noqa: E402
+from PyQt6.QtWidgets import QApplication, QGraphicsScene  # noqa: E402
+
+from main import BezierTracing  # noqa: E402
+from scene_items import BatchedCurvesItem, PathStyle  # noqa: E402
+from undo import EditHistory, ShapesDeleteCommand, ShapesMoveCommand  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QApplication.instance() or QApplication(sys.argv)
+
+
+@pytest.fixture
+def squares(tmp_path):
+    """A row of six black squares, 40 pixels apart."""
+    image = np.full((100, 260), 255, np.uint8)
+    for i in range(6):
+        cv2.rectangle(image, (10 + 40 * i, 40), (30 + 40 * i, 60), 0, -1)
+    path = str(tmp_path / "squares.png")
+    cv2.imwrite(path, image)
+    return path
+
+
+def test_retrace_after_expired_delete(app, squares):
+    bezier_tracing = BezierTracing(squares, "fitter")
+    batch = BatchedCurvesItem(PathStyle(QPen(QColor(Qt.GlobalColor.black)), QBrush(QColor(Qt.GlobalColor.black))), 1.0)
+    batch.add_curves(bezier_tracing.curves)
+    history = EditHistory(1)
+    x = bezier_tracing.curves.shape_bounds()[:, 0]
+    left = np.argsort(x)
+
+    history.push(ShapesDeleteCommand(batch, [left[0]]))
+    chunk_bytes = batch.footprint()["chunk_bytes"]
+    # The move pushes the deletion off the history, which removes the shape from the batch
+    history.push(ShapesMoveCommand(batch, [left[3]], np.array([1.0, 0.0])))
+    assert left[0] in batch.removed
+    assert batch.footprint()["chunk_bytes"] < chunk_bytes
+    # and from the trace, once handed over
+    bezier_tracing.remove_shapes(batch.take_expired())
+    assert len(bezier_tracing.curves) == 5
+
+    # Around the fifth square
+    removed, added = bezier_tracing.retrace_region((170, 45, 10, 10))
+    batch.replace_shapes(removed, added)
+
+    live = batch.live_indices()
+    assert len(live) == len(bezier_tracing.curves)
+    np.testing.assert_allclose(batch.curves().take(live).shape_bounds(), bezier_tracing.curves.shape_bounds())
+    # The re-traced square is shown once, the deleted one not at all and the others as they were
+    shown = np.setdiff1d(np.arange(len(batch)), batch._removed_indices())
+    shown_x = np.sort(batch.curves().take(shown).shape_bounds()[:, 0] + batch.offsets[shown, 0])
+    np.testing.assert_allclose(shown_x, x[left[1:]] + [0, 0, 1, 0, 0], atol=0.5)
+
+
+def test_delete_expiring_during_retrace(app, squares):
+    bezier_tracing = BezierTracing(squares, "fitter")
+    batch = BatchedCurvesItem(PathStyle(QPen(QColor(Qt.GlobalColor.black)), QBrush(QColor(Qt.GlobalColor.black))), 1.0)
+    batch.add_curves(bezier_tracing.curves)
+    history = EditHistory(1)
+    x = bezier_tracing.curves.shape_bounds()[:, 0]
+    left = np.argsort(x)
+
+    history.push(ShapesDeleteCommand(batch, [left[0]]))
+    # The re-trace runs on a worker while the deletion expires, and the trace is only compacted after it
+    removed, added = bezier_tracing.retrace_region((170, 45, 10, 10))
+    history.push(ShapesMoveCommand(batch, [left[3]], np.array([1.0, 0.0])))
+    batch.replace_shapes(removed, added)
+    bezier_tracing.remove_shapes(batch.take_expired())
+
+    live = batch.live_indices()
+    assert len(live) == len(bezier_tracing.curves) == 5
+    np.testing.assert_allclose(batch.curves().take(live).shape_bounds(), bezier_tracing.curves.shape_bounds())
+
+
+def test_moved_shape_overlap_stays_filled(app, squares):
+    bezier_tracing = BezierTracing(squares, "fitter")
+    batch = BatchedCurvesItem(PathStyle(QPen(Qt.PenStyle.NoPen), QBrush(QColor(Qt.GlobalColor.black))), 1.0)
+    batch.add_curves(bezier_tracing.curves)
+    scene = QGraphicsScene()
+    scene.addItem(batch)
+    left = np.argsort(bezier_tracing.curves.shape_bounds()[:, 0])
+
+    # The first square, x 10 to 30, half covers the second one, x 50 to 70
+    ShapesMoveCommand(batch, [left[0]], np.array([30.0, 0.0])).redo()
+    image = QImage(260, 100, QImage.Format.Format_RGB32)
+    image.fill(Qt.GlobalColor.white)
+    painter = QPainter(image)
+    scene.render(painter, QRectF(0, 0, 260, 100), QRectF(0, 0, 260, 100))
+    painter.end()
+    assert [QColor(image.pixel(x, 50)).black() for x in (45, 55, 65)] == [255, 255, 255]